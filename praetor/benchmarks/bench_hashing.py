@@ -0,0 +1,64 @@
+"""
+Throughput of the persistent id hash algorithms on typical argument sizes
+
+With praetor installed (pip install -e .) run from the praetor directory:
+    python benchmarks/bench_hashing.py
+"""
+import time
+
+from praetor.hashing import HASH_ALGORITHM_NAMES, get_hash_factory
+from praetor.praetor import CallTracer
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def typical_arguments():
+    arguments = {
+        "int": 42,
+        "short str": "observation_0001.fits",
+        "dict (100 keys)": {"key_{}".format(i): i * 0.5 for i in range(100)},
+        "list (10k floats)": [i * 0.5 for i in range(10000)],
+        "bytes (1 MB)": bytes(1024 * 1024),
+    }
+    if np is not None:
+        arguments["ndarray (8 MB)"] = np.random.rand(1024 * 1024)
+        arguments["ndarray (128 MB)"] = np.random.rand(16 * 1024 * 1024)
+    return arguments
+
+
+def time_hash(obj, hash_factory, min_time=0.2):
+    """Repeat the hash until min_time has passed
+    :return: Seconds per hash"""
+    repeats = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < min_time:
+        CallTracer.generate_persistent_id(obj, hash_factory=hash_factory)
+        repeats += 1
+        elapsed = time.perf_counter() - start
+    return elapsed / repeats
+
+
+def main():
+    algorithms = []
+    for name in HASH_ALGORITHM_NAMES:
+        try:
+            algorithms.append((name, get_hash_factory(name)))
+        except ImportError:
+            print("skipping {}, xxhash is not installed".format(name))
+
+    print("persistent ids per second")
+    print("{:<20}".format("argument") + "".join("{:>14}".format(name) for name, _ in algorithms))
+    for label, obj in typical_arguments().items():
+        row = "{:<20}".format(label)
+        for name, factory in algorithms:
+            seconds = time_hash(obj, factory)
+            row += "{:>12.0f}/s".format(1.0 / seconds)
+        print(row)
+
+
+if __name__ == "__main__":
+    main()
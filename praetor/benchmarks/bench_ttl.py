@@ -0,0 +1,62 @@
+"""
+Turtle conversion time of activities with many inputs, the time per input should stay flat as activities grow
+
+With praetor installed (pip install -e .) run from the praetor directory:
+    python benchmarks/bench_ttl.py
+"""
+import io
+import time
+
+from praetor.json_to_ttl import Converter
+
+INPUT_COUNTS = (1, 10, 100, 1000, 10000)
+
+
+def activity_bindings(inputs, with_values):
+    """Flattened json record of one activity
+    :param inputs: Number of inputs
+    :param with_values: Carry the entity values with the inputs, as traces recorded without entity deduplication do
+    :return: Bindings"""
+    bindings = {
+        "message": {"@id": "run:activity_0"},
+        "messageStartTime": {"@type": "xsd:dateTime", "@value": "2024-01-01T00:00:00.000000"},
+        "messageEndTime": {"@type": "xsd:dateTime", "@value": "2024-01-01T00:00:01.000000"},
+        "activityName": {"@type": "xsd:string", "@value": "many_inputs"},
+        "moduleName": {"@type": "xsd:string", "@value": "bench_ttl"},
+        "output_0": {"@id": "urn_uuid:output_0"},
+    }
+    for i in range(inputs):
+        binding = {"@id": "urn_uuid:entity_{}".format(i), "@role": "arg_{}".format(i)}
+        if with_values:
+            binding.update({"@type": "xsd:string", "@value": "value {}".format(i) * 10})
+        bindings["input_{}".format(i)] = binding
+    return bindings
+
+
+def time_conversion(bindings, min_time=0.2):
+    """Repeat the conversion of one record until min_time has passed
+    :return: Seconds per conversion"""
+    converter = Converter(bindings)
+    repeats = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < min_time:
+        converter.write_line_triples(io.StringIO())
+        repeats += 1
+        elapsed = time.perf_counter() - start
+    return elapsed / repeats
+
+
+def main():
+    print("microseconds per input")
+    print("{:<10}{:>16}{:>16}".format("inputs", "ids only", "with values"))
+    for inputs in INPUT_COUNTS:
+        row = "{:<10}".format(inputs)
+        for with_values in (False, True):
+            seconds = time_conversion(activity_bindings(inputs, with_values))
+            row += "{:>16.2f}".format(seconds / inputs * 1e6)
+        print(row)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+import sys
+import threading
+import types
+
+from praetor.tasks import COROUTINE_FLAGS
+
+
+def monitoring_available():
+    """Check whether the sys.monitoring (PEP 669) api is available, i.e. python 3.12+
+    :return: True if sys.monitoring can be used"""
+    return hasattr(sys, "monitoring")
+
+
+class SetProfileBackend:
+    """Install a CallTracer with sys.setprofile, every call and return goes through the tracer. Threads started while
+    tracing, and on python 3.12+ the threads already running, are traced as well through threading.setprofile"""
+
+    name = "setprofile"
+
+    def __init__(self, tracer):
+        self.tracer = tracer
+
+    def start(self):
+        # from python 3.12 the returns of the functions installing the profiler are reported to it
+        recording = self.tracer.record_prov
+        self.tracer.record_prov = False
+        try:
+            if hasattr(threading, "setprofile_all_threads"):
+                threading.setprofile_all_threads(self.start_thread)
+            else:
+                threading.setprofile(self.start_thread)
+            sys.setprofile(self.tracer)
+        finally:
+            self.tracer.record_prov = recording
+
+    def start_thread(self, frame, event, arg):
+        """Profile function of other threads for their first event, hands the thread over to the tracer unless it is
+        one of praetor's own threads"""
+        if threading.get_ident() in self.tracer.ignored_threads:
+            sys.setprofile(None)
+            return None
+        sys.setprofile(self.tracer)
+        return self.tracer(frame, event, arg)
+
+    def stop(self):
+        if hasattr(threading, "setprofile_all_threads"):
+            threading.setprofile_all_threads(None)
+        else:
+            threading.setprofile(None)
+        sys.setprofile(None)
+
+
+class MonitoringBackend:
+    """Drive a CallTracer from sys.monitoring events. Code objects rejected by the tracer filters are disabled after
+    their first event so they no longer cost anything. Recording C functions (cpython) needs the CALL event, which
+    fires at every call site, so call sites are disabled the first time they call anything but a builtin function"""
+
+    name = "monitoring"
+
+    def __init__(self, tracer, tool_id=None):
+        self.tracer = tracer
+        self.monitoring = sys.monitoring
+        if tool_id is None:
+            tool_id = self.monitoring.PROFILER_ID
+        self.tool_id = tool_id
+        self.disable = self.monitoring.DISABLE
+        self.claimed = False
+        self.callbacks = {}
+        self.active = False
+
+    def claim(self):
+        """Claim the tool id
+        :return: False if another tool already uses it"""
+        try:
+            self.monitoring.use_tool_id(self.tool_id, "praetor")
+        except ValueError:
+            return False
+        self.claimed = True
+        return True
+
+    def start(self):
+        """Register the callbacks, claiming the tool id first unless claim was called. Raises ValueError if the tool id
+        is already in use, if registering fails the tool id is released again before the error is raised"""
+        if not self.claimed and not self.claim():
+            raise ValueError("sys.monitoring tool id {} is already in use".format(self.tool_id))
+        try:
+            self.register()
+        except BaseException:
+            self.release()
+            raise
+        self.active = True
+
+    def register(self):
+        """Register the callbacks of the events the tracer needs and switch those events on"""
+        mon = self.monitoring
+        events = mon.events
+        callbacks = {events.PY_START: self.py_start,
+                     events.PY_RESUME: self.py_start,
+                     events.PY_RETURN: self.py_return,
+                     events.PY_YIELD: self.py_return,
+                     events.PY_UNWIND: self.py_unwind}
+        if self.tracer.tasks is not None:
+            callbacks[events.PY_RESUME] = self.py_resume
+            callbacks[events.PY_YIELD] = self.py_yield
+        if self.tracer.cpython:
+            # C_RETURN and C_RAISE can only be enabled together, and only fire where CALL is enabled
+            callbacks[events.CALL] = self.c_call
+            callbacks[events.C_RETURN] = self.c_return
+            callbacks[events.C_RAISE] = self.c_return
+        event_set = 0
+        for event, callback in callbacks.items():
+            mon.register_callback(self.tool_id, event, callback)
+            self.callbacks[event] = callback
+            event_set |= event
+        mon.set_events(self.tool_id, event_set)
+
+    def release(self):
+        """Switch the events off, unregister the callbacks and free the tool id, python 3.12 and 3.13 keep the
+        callbacks of a freed tool id registered"""
+        mon = self.monitoring
+        mon.set_events(self.tool_id, 0)
+        for event in self.callbacks:
+            mon.register_callback(self.tool_id, event, None)
+        self.callbacks = {}
+        mon.free_tool_id(self.tool_id)
+        self.claimed = False
+
+    def stop(self):
+        if not self.active:
+            return
+        self.active = False
+        self.release()
+
+    def filtered(self, code, frame):
+        """Look up the cached filter decision for a code object, running the filters on first sight"""
+        filtered = self.tracer.filter_cache.get(code)
+        if filtered is None:
+            filtered = self.tracer.cache_filter(code, frame)
+        return filtered
+
+    def recording(self):
+        """Whether events should be recorded, sys.monitoring reports events of every thread including praetor's own"""
+        return self.tracer.record_prov and threading.get_ident() not in self.tracer.ignored_threads
+
+    def py_start(self, code, instruction_offset):
+        frame = sys._getframe(1)
+        if self.filtered(code, frame):
+            return self.disable
+        if self.recording():
+            self.tracer.record_event(frame, "call", None, code.co_name, frame.f_globals.get("__name__", None))
+
+    def py_return(self, code, instruction_offset, retval):
+        frame = sys._getframe(1)
+        if self.filtered(code, frame):
+            return self.disable
+        if self.recording():
+            self.tracer.record_event(frame, "return", retval, code.co_name, frame.f_globals.get("__name__", None))
+
+    def py_resume(self, code, instruction_offset):
+        # asyncio mode, a coroutine carries on with the activity it started rather than opening a new one
+        frame = sys._getframe(1)
+        if self.filtered(code, frame):
+            return self.disable
+        if self.recording():
+            event = "resume" if code.co_flags & COROUTINE_FLAGS else "call"
+            self.tracer.record_event(frame, event, None, code.co_name, frame.f_globals.get("__name__", None))
+
+    def py_yield(self, code, instruction_offset, retval):
+        frame = sys._getframe(1)
+        if self.filtered(code, frame):
+            return self.disable
+        if self.recording():
+            event = "yield" if code.co_flags & COROUTINE_FLAGS else "return"
+            self.tracer.record_event(frame, event, retval, code.co_name, frame.f_globals.get("__name__", None))
+
+    def py_unwind(self, code, instruction_offset, exception):
+        # PY_UNWIND cannot be disabled, sys.setprofile reports these as a return of None
+        frame = sys._getframe(1)
+        if self.recording() and not self.filtered(code, frame):
+            self.tracer.record_event(frame, "return", None, code.co_name, frame.f_globals.get("__name__", None))
+
+    def c_call(self, code, instruction_offset, callable_, arg0):
+        # calls of python functions are reported by PY_START, and sys.setprofile only reports builtin functions as C
+        # calls. A call site calling builtins only some of the time is missed after its first other call
+        if not isinstance(callable_, types.BuiltinFunctionType):
+            return self.disable
+        if self.recording():
+            self.tracer(sys._getframe(1), "c_call", callable_)
+
+    def c_return(self, code, instruction_offset, callable_, arg0):
+        # also C_RAISE, a C call which raised is closed like one which returned
+        if isinstance(callable_, types.BuiltinFunctionType) and self.recording():
+            self.tracer(sys._getframe(1), "c_return", callable_)
+
+
+def install_tracer(tracer, backend=None):
+    """Start tracing with the fastest backend available, sys.monitoring on python 3.12+ and sys.setprofile otherwise
+    :param tracer: CallTracer instance
+    :param backend: Force a backend, either "monitoring" or "setprofile"
+    :return: The started backend"""
+    if backend is None:
+        backend = "monitoring" if monitoring_available() else "setprofile"
+
+    if backend == "monitoring":
+        started = MonitoringBackend(tracer)
+        # a tool id owned by another profiler leaves sys.setprofile
+        if started.claim():
+            try:
+                started.start()
+            except Exception as error:
+                # start released the tool id and callbacks again
+                print("praetor: sys.monitoring could not be started ({}), tracing with sys.setprofile".format(error))
+            else:
+                tracer.backend = started
+                return started
+
+    started = SetProfileBackend(tracer)
+    started.start()
+    tracer.backend = started
+    return started
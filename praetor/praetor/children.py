@@ -0,0 +1,127 @@
+import json
+import os
+import re
+import sys
+import threading
+
+# Child processes of a traced script are traced as shards of its session. Each child writes its own raw trace,
+# json/<session>_p<pid>.json (or .prtr), under the output directory of the session, with its activities associated
+# with an agent of its own, urn_uuid:<session>_p<pid>, which acts on behalf of the agent of the process that started it.
+#
+# - forked children carry on with the tracer of the parent, which re-opens itself as a shard after the fork
+# - spawned children (spawn and forkserver start methods, or any python process started with the environment of the
+#   session) import praetor again with the script and find the session in the PARENT_ENV environment variable
+#
+# The activity which started a child is recorded as a spawn record, by the parent for processes started through
+# multiprocessing (including process pools) and by the child itself for plain os.fork calls.
+
+PARENT_ENV = "PRAETOR_PARENT"
+PROCESS_MODE = "process"
+SPAWN_MODE = "spawn"
+
+local = threading.local()
+
+
+def shard_session(session_id, pid):
+    """Session id of the shard of a child process
+    :param session_id: Session id of the traced script
+    :param pid: Process id of the child
+    :return: Session id"""
+    return "{}_p{}".format(session_id, pid)
+
+
+def shard_paths(main_json):
+    """Raw traces of the child processes of a session, in the directory of the trace of the session
+    :param main_json: Path of the raw trace of the session
+    :return: Sorted list of paths"""
+    directory, name = os.path.split(main_json)
+    pattern = re.compile(re.escape(os.path.splitext(name)[0]) + r"_p\d+\.(json|prtr)$")
+    return sorted(os.path.join(directory, file_name) for file_name in os.listdir(directory or ".")
+                  if pattern.match(file_name))
+
+
+def parent_session():
+    """Session this process is a child of, from the environment inherited from a traced process
+    :return: Dictionary with the session id, agent id and output directory of the session, None if there is none"""
+    value = os.environ.get(PARENT_ENV)
+    if not value:
+        return None
+    return json.loads(value)
+
+
+def export_session(session_id, agent_id, output_directory):
+    """Make the session known to processes started from this one, through their inherited environment
+    :param session_id: Session id of the traced script
+    :param agent_id: ID of the agent the children act on behalf of, the agent of this process
+    :param output_directory: Output directory of the session"""
+    os.environ[PARENT_ENV] = json.dumps({"session": session_id, "agent": agent_id, "output": output_directory})
+
+
+def process_record(agent_id, parent_agent_id):
+    """Record declaring the agent of a child process, the first record of its shard
+    :param agent_id: ID of the agent of the child
+    :param parent_agent_id: ID of the agent of the process which started it
+    :return: Record"""
+    return {"@id": PROCESS_MODE, "@mode": PROCESS_MODE,
+            "@data": {"process": {"@id": agent_id, "processId": os.getpid(), "parentAgent": parent_agent_id}}}
+
+
+def spawn_record(agent_id, parent_agent_id, activity_id):
+    """Record linking the agent of a child process to the activity which started it
+    :param agent_id: ID of the agent of the child
+    :param parent_agent_id: ID of the agent of the process which started it
+    :param activity_id: Message id of the activity
+    :return: Record"""
+    return {"@id": SPAWN_MODE, "@mode": SPAWN_MODE,
+            "@data": {"spawn": {"@id": agent_id, "parentAgent": parent_agent_id, "parentActivity": activity_id}}}
+
+
+def forked_by_process_start():
+    """Whether this forked child was forked inside multiprocessing's Process.start, whose caller records the activity
+    which started the child. The flag the child inherits from the parent thread is cleared
+    :return: True if the parent records the spawn"""
+    starting = getattr(local, "starting", False)
+    local.starting = False
+    return starting
+
+
+def patch_process_start(tracer):
+    """Record the activity starting a multiprocessing process in the trace of the tracer, once the child has a
+    process id. Process pools start their workers through Process.start as well
+    :param tracer: CallTracer of this process"""
+    # multiprocessing.process does not import multiprocessing.util, whose atexit handler joins the children, so that
+    # handler still runs before the one closing the tracer
+    from multiprocessing import process
+    if hasattr(process.BaseProcess.start, "tracer"):
+        process.BaseProcess.start.tracer = tracer
+        return
+    original = process.BaseProcess.start
+
+    def start(self):
+        activity_id = start.tracer.current_activity()
+        local.starting = True
+        try:
+            original(self)
+        finally:
+            local.starting = False
+        if activity_id is not None and self.pid is not None:
+            start.tracer.record_spawn(self.pid, activity_id)
+
+    start.tracer = tracer
+    process.BaseProcess.start = start
+
+
+def finalize_tracer(tracer):
+    """Close a tracer with the multiprocessing finalizers, which processes started by multiprocessing run at exit"""
+    util = sys.modules["multiprocessing.util"]
+    util.Finalize(tracer, tracer.close, exitpriority=0)
+
+
+def close_with_process(tracer):
+    """Close the tracer of a forked child when it exits. Processes forked by multiprocessing leave with os._exit and
+    skip atexit handlers, and their finalizers are cleared after the fork, so the finalizer is registered once the
+    child process has been set up
+    :param tracer: CallTracer of the child"""
+    util = sys.modules.get("multiprocessing.util")
+    if util is not None:
+        util.register_after_fork(tracer, finalize_tracer)
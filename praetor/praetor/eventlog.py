@@ -0,0 +1,285 @@
+import json
+import re
+import struct
+import threading
+
+# Binary raw trace format
+#
+# The file starts with MAGIC and is followed by frames, each a one byte kind and a four byte payload length:
+# - STRING frames define the next entry of the string table, strings are numbered in the order they are defined
+# - RECORD frames hold one record of the trace, the same {"@id", "@mode", "@data"} dictionaries as the JSON lines
+#   format. A record is its tagged id and the string number of its mode, then the number of bindings followed by each
+#   binding as its name and a list of (key, value) pairs.
+#
+# Values are tagged with one byte. Numbers are fixed width. Only strings which repeat go through the string table:
+# binding names, keys, modes, types, roles and module, function and task names. Other strings, such as rendered
+# values, are written inline. Ids are mostly used once, an id ending in a counter, like activity and message ids, is
+# written as the string number of the rest of it and the counter as a varint, an id ending in a hex digest, like
+# entity ids, as the string number of the rest of it and the raw bytes of the digest.
+# A truncated final frame, e.g. from a killed process, is ignored by the reader.
+
+MAGIC = b"PRTRLOG2"
+
+FRAME_HEADER = struct.Struct("<BI")
+STRING_FRAME = 1
+RECORD_FRAME = 2
+
+COUNT = struct.Struct("<H")
+REF = struct.Struct("<I")
+INT = struct.Struct("<q")
+FLOAT = struct.Struct("<d")
+
+NONE_TAG = b"n"
+TRUE_TAG = b"t"
+FALSE_TAG = b"f"
+INT_TAG = b"i"
+FLOAT_TAG = b"d"
+SYMBOL_TAG = b"s"
+TEXT_TAG = b"u"
+JSON_TAG = b"j"
+COUNTER_TAG = b"c"
+DIGEST_TAG = b"h"
+
+INTERN_MAX_LEN = 128
+# keys whose values are ids, and the keys and name bindings whose string values repeat
+ID_KEYS = frozenset(("@id", "@derivedFrom", "parentAgent", "parentActivity"))
+INTERNED_KEYS = frozenset(("@type", "@role"))
+NAME_BINDINGS = frozenset(("moduleName", "activityName", "task", "summaryOf"))
+# a counter is written without leading zeros, so the split gives back the same string
+COUNTER_ID = re.compile(r"(.*?)(0|[1-9][0-9]*)\Z", re.DOTALL)
+DIGEST_ID = re.compile(r"(.*:)((?:[0-9a-f]{2}){8,})\Z", re.DOTALL)
+INT_MIN = -2 ** 63
+INT_MAX = 2 ** 63 - 1
+
+
+def pack_varint(number):
+    """Little endian base 128 encoding of a non-negative integer, seven bits per byte"""
+    encoded = bytearray()
+    while number > 0x7F:
+        encoded.append(number & 0x7F | 0x80)
+        number >>= 7
+    encoded.append(number)
+    return bytes(encoded)
+
+
+def unpack_varint(payload, position):
+    """Decode a varint
+    :return: The integer and the position after it"""
+    number = shift = 0
+    while True:
+        byte = payload[position]
+        position += 1
+        number |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return number, position
+        shift += 7
+
+
+def is_event_log(path):
+    """Check whether a raw trace is a binary event log rather than JSON lines
+    :param path: Path of the raw trace
+    :return: True for a binary event log"""
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class EventLogEncoder:
+    """Encode trace records into frames of the binary event log. The encoder keeps the string table of the file, so one
+    encoder has to encode all records of a file. The header and string frames are written straight away through
+    write, under a lock, so strings are defined in the order of their numbers and ahead of any record using them,
+    whichever thread's buffer the record ends up in"""
+
+    def __init__(self, write):
+        """
+        :param write: Function writing bytes to the log straight away, ahead of buffered records
+        """
+        self.symbols = {}
+        self.write = write
+        self.lock = threading.Lock()
+        write(MAGIC)
+
+    def symbol(self, string):
+        """Number of an interned string, defining it first if it is new
+        :param string: String to intern
+        :return: Packed string number"""
+        number = self.symbols.get(string)
+        if number is None:
+            with self.lock:
+                number = self.symbols.get(string)
+                if number is None:
+                    number = len(self.symbols)
+                    encoded = string.encode("utf-8")
+                    self.write(FRAME_HEADER.pack(STRING_FRAME, len(encoded)) + encoded)
+                    self.symbols[string] = number
+        return REF.pack(number)
+
+    def identifier(self, value, parts):
+        """Append a tagged id to a record, the counter or digest ending it is written in place so ids used once do
+        not grow the string table
+        :param value: Id string
+        :param parts: Parts of the record"""
+        match = DIGEST_ID.match(value)
+        if match is not None:
+            digest = bytes.fromhex(match.group(2))
+            parts.append(DIGEST_TAG + self.symbol(match.group(1)) + pack_varint(len(digest)) + digest)
+            return
+        match = COUNTER_ID.match(value)
+        if match is not None:
+            parts.append(COUNTER_TAG + self.symbol(match.group(1)) + pack_varint(int(match.group(2))))
+        else:
+            self.value(value, parts, True)
+
+    def value(self, value, parts, intern=False):
+        """Append a tagged value to a record
+        :param value: str, int, float, bool, None or any JSON serialisable value
+        :param parts: Parts of the record
+        :param intern: Whether a string value repeats, and is worth putting in the string table"""
+        if value is None:
+            parts.append(NONE_TAG)
+        elif value is True:
+            parts.append(TRUE_TAG)
+        elif value is False:
+            parts.append(FALSE_TAG)
+        elif isinstance(value, int) and INT_MIN <= value <= INT_MAX:
+            parts.append(INT_TAG + INT.pack(value))
+        elif isinstance(value, float):
+            parts.append(FLOAT_TAG + FLOAT.pack(value))
+        elif intern and isinstance(value, str) and len(value) <= INTERN_MAX_LEN:
+            parts.append(SYMBOL_TAG + self.symbol(value))
+        else:
+            tag = TEXT_TAG
+            if not isinstance(value, str):
+                tag = JSON_TAG
+                value = json.dumps(value)
+            encoded = value.encode("utf-8")
+            parts.append(tag + REF.pack(len(encoded)))
+            parts.append(encoded)
+
+    def encode(self, record):
+        """Encode a record, the strings it introduces are written first
+        :param record: Dictionary with @id, @mode and @data, where @data maps binding names to dictionaries
+        :return: bytes of the record frame"""
+        parts = []
+        self.identifier(str(record["@id"]), parts)
+        parts.append(self.symbol(record["@mode"]))
+        data = record["@data"]
+        if data is None:
+            parts.append(COUNT.pack(0xFFFF))
+        else:
+            parts.append(COUNT.pack(len(data)))
+            for name, binding in data.items():
+                parts.append(self.symbol(name))
+                parts.append(COUNT.pack(len(binding)))
+                names = name in NAME_BINDINGS
+                for key, value in binding.items():
+                    parts.append(self.symbol(key))
+                    if key in ID_KEYS and isinstance(value, str):
+                        self.identifier(value, parts)
+                    else:
+                        self.value(value, parts, key in INTERNED_KEYS or names and key == "@value")
+
+        payload = b"".join(parts)
+        return FRAME_HEADER.pack(RECORD_FRAME, len(payload)) + payload
+
+
+def decode_value(payload, position, symbols):
+    """Decode a tagged value
+    :param payload: bytes of the record frame
+    :param position: Position of the tag
+    :param symbols: String table read so far
+    :return: The value and the position after it"""
+    tag = payload[position:position + 1]
+    position += 1
+    if tag == SYMBOL_TAG:
+        return symbols[REF.unpack_from(payload, position)[0]], position + 4
+    if tag == INT_TAG:
+        return INT.unpack_from(payload, position)[0], position + 8
+    if tag == FLOAT_TAG:
+        return FLOAT.unpack_from(payload, position)[0], position + 8
+    if tag == COUNTER_TAG:
+        prefix = symbols[REF.unpack_from(payload, position)[0]]
+        number, position = unpack_varint(payload, position + 4)
+        return prefix + str(number), position
+    if tag == DIGEST_TAG:
+        prefix = symbols[REF.unpack_from(payload, position)[0]]
+        length, position = unpack_varint(payload, position + 4)
+        return prefix + payload[position:position + length].hex(), position + length
+    if tag == NONE_TAG:
+        return None, position
+    if tag == TRUE_TAG:
+        return True, position
+    if tag == FALSE_TAG:
+        return False, position
+    length = REF.unpack_from(payload, position)[0]
+    position += 4
+    value = payload[position:position + length].decode("utf-8")
+    if tag == JSON_TAG:
+        value = json.loads(value)
+    return value, position + length
+
+
+def decode_record(payload, symbols):
+    """Decode the payload of a record frame
+    :param payload: bytes of the frame
+    :param symbols: String table read so far
+    :return: Dictionary with @id, @mode and @data"""
+    unpack_ref = REF.unpack_from
+    unpack_count = COUNT.unpack_from
+
+    record_id, position = decode_value(payload, 0, symbols)
+    mode = symbols[unpack_ref(payload, position)[0]]
+    bindings = unpack_count(payload, position + 4)[0]
+    position += 6
+    if bindings == 0xFFFF:
+        return {"@id": record_id, "@mode": mode, "@data": None}
+
+    data = {}
+    for _ in range(bindings):
+        name = symbols[unpack_ref(payload, position)[0]]
+        pairs = unpack_count(payload, position + 4)[0]
+        position += 6
+        binding = {}
+        for _ in range(pairs):
+            key = symbols[unpack_ref(payload, position)[0]]
+            binding[key], position = decode_value(payload, position + 4, symbols)
+        data[name] = binding
+    return {"@id": record_id, "@mode": mode, "@data": data}
+
+
+def read_frames(f, symbols):
+    """Read frames from the current position of an event log until the end of the file or an incomplete frame, which
+    is left unread, e.g. while the log is still being written
+    :param f: Event log opened in binary mode, positioned at the start of a frame
+    :param symbols: String table read so far, extended with the strings the frames define
+    :return: Generator of the record of each record frame and None for any other frame, f is positioned after the
+    frame when it is yielded"""
+    header_size = FRAME_HEADER.size
+    while True:
+        start = f.tell()
+        header = f.read(header_size)
+        if len(header) < header_size:
+            f.seek(start)
+            return
+        kind, length = FRAME_HEADER.unpack(header)
+        payload = f.read(length)
+        if len(payload) < length:
+            f.seek(start)
+            return
+        if kind == RECORD_FRAME:
+            yield decode_record(payload, symbols)
+            continue
+        if kind == STRING_FRAME:
+            symbols.append(payload.decode("utf-8"))
+        yield None
+
+
+def read_event_log(path):
+    """Read the records of a binary event log in the order they were written
+    :param path: Path of the event log
+    :return: Generator of dictionaries with @id, @mode and @data"""
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a praetor event log".format(path))
+        for record in read_frames(f, []):
+            if record is not None:
+                yield record
@@ -0,0 +1,335 @@
+from collections import OrderedDict
+import functools
+import hashlib
+import sys
+import weakref
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# values of these types can not change so their persistent id can be cached against the value itself, strings and
+# bytes longer than IMMUTABLE_MAX_LEN are left out so a full cache keeps at most a few tens of MB of values alive
+IMMUTABLE_TYPES = (str, bytes, int, bool, type(None))
+IMMUTABLE_TYPE_SET = frozenset(IMMUTABLE_TYPES)
+IMMUTABLE_MAX_LEN = 4 * 1024
+# lists, tuples and dicts of at most this many immutable values are cached against their contents as well
+CONTAINER_MAX_ITEMS = 256
+# mutable values of events queued for the background writer are copied up to this size, see snapshot
+SNAPSHOT_MAX_BYTES = 64 * 1024
+SNAPSHOT_TYPES = IMMUTABLE_TYPE_SET | {float}
+
+# sampled fingerprints of very large buffers hash this many evenly spaced chunks
+FINGERPRINT_CHUNKS = 256
+FINGERPRINT_CHUNK_BYTES = 4096
+
+
+# hashlib style constructors for the persistent id algorithms, the xxhash ones are non-cryptographic and need the
+# optional xxhash package
+HASH_ALGORITHMS = {
+    "sha256": hashlib.sha256,
+    "blake2b": functools.partial(hashlib.blake2b, digest_size=16),
+}
+if xxhash is not None:
+    HASH_ALGORITHMS["xxh64"] = xxhash.xxh3_64
+    HASH_ALGORITHMS["xxh128"] = xxhash.xxh3_128
+
+HASH_ALGORITHM_NAMES = ("sha256", "blake2b", "xxh64", "xxh128")
+
+
+def get_hash_factory(algorithm):
+    """Find the hash constructor for the name of a persistent id algorithm
+    :param algorithm: One of HASH_ALGORITHM_NAMES
+    :return: hashlib style hash constructor"""
+    try:
+        return HASH_ALGORITHMS[algorithm]
+    except KeyError:
+        if algorithm in HASH_ALGORITHM_NAMES:
+            raise ImportError("The {} hash algorithm requires the xxhash package, pip install xxhash".format(algorithm))
+        raise ValueError("Unknown hash algorithm {}, choose from {}".format(algorithm, ", ".join(HASH_ALGORITHM_NAMES)))
+
+
+def byte_view(obj):
+    """Get a flat, zero-copy byte view of an object supporting the buffer protocol
+    :param obj: python object
+    :return: 1-D unsigned byte memoryview, or None if the object does not expose a contiguous buffer"""
+    try:
+        view = memoryview(obj)
+    except (TypeError, ValueError):
+        # ValueError for buffers of formats memoryview does not support, e.g. numpy datetime64 arrays
+        return None
+    try:
+        return view.cast("B")
+    except TypeError:
+        # non-contiguous buffers can not be flattened without a copy
+        return None
+
+
+def sampled_chunks(view, chunks, chunk_bytes):
+    """Yield evenly spaced zero-copy slices of a byte view, always including the first and last bytes
+    :param view: 1-D unsigned byte memoryview
+    :param chunks: Number of slices
+    :param chunk_bytes: Size of each slice in bytes
+    :return: Generator of memoryview slices"""
+    nbytes = view.nbytes
+    if nbytes <= chunks * chunk_bytes:
+        yield view
+        return
+    step = (nbytes - chunk_bytes) // (chunks - 1)
+    for start in range(0, step * chunks, step):
+        yield view[start:start + chunk_bytes]
+
+
+def buffer_digest(obj, sample_above=None, hash_factory=hashlib.sha256):
+    """Hash the raw memory of an object supporting the buffer protocol (ndarray, bytes, bytearray, memoryview,
+    array.array) together with its type, format and shape, without copying it. Buffers larger than sample_above are
+    fingerprinted from evenly spaced chunks instead of hashed completely
+    :param obj: python object
+    :param sample_above: Size in bytes above which a sampled fingerprint is used, None always hashes everything
+    :param hash_factory: Constructor of a hashlib style hash object
+    :return: Hex digest, or None if the object has no contiguous buffer of plain values"""
+    try:
+        view = memoryview(obj)
+    except (TypeError, ValueError):
+        return None
+    if "O" in view.format:
+        # object arrays export pointers, not values
+        return None
+    flat = byte_view(view)
+    if flat is None:
+        return None
+
+    header = "{}|{}|{}|{}".format(type(obj).__qualname__, view.format, view.shape, getattr(obj, "dtype", ""))
+    hasher = hash_factory()
+    if sample_above is not None and flat.nbytes > sample_above:
+        hasher.update("{}|sampled|{}".format(header, flat.nbytes).encode("utf-8"))
+        for chunk in sampled_chunks(flat, FINGERPRINT_CHUNKS, FINGERPRINT_CHUNK_BYTES):
+            hasher.update(chunk)
+    else:
+        hasher.update(header.encode("utf-8"))
+        hasher.update(flat)
+    return hasher.hexdigest()
+
+
+def immutable_values(obj, max_items, value_types=IMMUTABLE_TYPE_SET):
+    """Contents of a list, tuple or dict holding nothing but values of immutable types
+    :param obj: python object
+    :param max_items: Maximum length of the container
+    :param value_types: Set of the types allowed
+    :return: Tuple of the values (keys first for dicts) and tuple of their types, or None if the object is not such a
+    container"""
+    obj_type = type(obj)
+    if obj_type is not list and obj_type is not dict and obj_type is not tuple:
+        return None
+    if len(obj) > max_items:
+        return None
+    values = (*obj.keys(), *obj.values()) if obj_type is dict else tuple(obj)
+    types = tuple(map(type, values))
+    if not value_types.issuperset(types):
+        return None
+    return values, types
+
+
+def content_key(obj):
+    """Cache key made of the contents of a short list, tuple or dict of immutable values. A shallow copy of such a
+    container is all of its contents, so it is cached against them like an immutable value
+    :param obj: python object
+    :return: Hashable key, or None if the object is not such a container"""
+    contents = immutable_values(obj, CONTAINER_MAX_ITEMS)
+    if contents is None:
+        return None
+    values, types = contents
+    if str in types or bytes in types:
+        if sum(len(value) for value in values if type(value) in (str, bytes)) > IMMUTABLE_MAX_LEN:
+            return None
+    # equal values of different types (1 and True) have different ids
+    return type(obj), types, values
+
+
+def snapshot(obj, max_bytes=SNAPSHOT_MAX_BYTES):
+    """Cheap stand-in for a mutable object with the persistent id the object has when it is taken, so it can be hashed
+    later on another thread: a shallow copy of a container of immutable values, the object itself if it can not be
+    written in place, or a read only copy of a small contiguous array or bytearray
+    :param obj: python object
+    :param max_bytes: Size in bytes up to which buffers are copied, and containers of up to an eighth as many values
+    :return: Stand-in object, or None if the object has no cheap snapshot and has to be hashed when it is taken"""
+    obj_type = type(obj)
+    if immutable_values(obj, max_bytes // 8, SNAPSHOT_TYPES) is not None:
+        return obj if obj_type is tuple else obj_type(obj)
+    if frozen_version(obj) is not None:
+        return obj
+    if obj_type is bytearray:
+        return bytearray(obj) if len(obj) <= max_bytes else None
+    numpy = sys.modules.get("numpy")
+    if numpy is not None and isinstance(obj, numpy.ndarray) and obj.nbytes <= max_bytes and obj.flags.c_contiguous \
+            and not obj.dtype.hasobject:
+        copy = obj.copy()
+        # read only, so the hash cache keeps its id while it waits to be compared with the one at the return
+        copy.flags.writeable = False
+        return copy
+    return None
+
+
+def frozen_version(obj):
+    """Version stamp of an object whose contents can not be written in place: a numpy array which is not writeable and
+    only a view of memory which is not writeable either, a read only memoryview of bytes, or a DataFrame whose blocks
+    are all such arrays. Nothing cheaper than hashing tells whether other objects were changed.
+    Turning a read only array writeable again, writing to it and back to read only between two events is not noticed
+    :param obj: python object
+    :return: Tuple of the stamp, which changes when the object is reshaped or rebuilt, and the objects the stamp refers
+    to by id, or None if the object can be written to"""
+    if type(obj) is memoryview:
+        try:
+            if obj.readonly and type(obj.obj) is bytes:
+                return (obj.format, obj.shape, obj.strides), ()
+        except ValueError:
+            # released
+            pass
+        return None
+    numpy = sys.modules.get("numpy")
+    if numpy is not None and isinstance(obj, numpy.ndarray):
+        if not frozen_array(obj, numpy):
+            return None
+        return (obj.shape, obj.strides, obj.dtype), ()
+    pandas = sys.modules.get("pandas")
+    if pandas is not None and numpy is not None and isinstance(obj, pandas.DataFrame):
+        try:
+            return frame_version(obj, numpy)
+        except AttributeError:
+            # internals of a pandas version without a block manager
+            return None
+    return None
+
+
+def frozen_array(array, numpy):
+    """Whether the memory of a numpy array can not be written through it or any array it is a view of
+    :param array: numpy array
+    :param numpy: numpy module
+    :return: True if the array is read only down to memory it owns or to bytes"""
+    while isinstance(array, numpy.ndarray):
+        if array.flags.writeable:
+            return False
+        array = array.base
+    # memory mapped files and other exporters may be written by someone else
+    return array is None or type(array) is bytes
+
+
+def frame_version(frame, numpy):
+    """Version stamp of a DataFrame from its block buffers, cached only when all blocks are read only arrays of plain
+    values. Adding, removing or replacing columns, index or blocks replaces objects of the block manager, renaming
+    the axes changes their names
+    :param frame: pandas DataFrame
+    :param numpy: numpy module
+    :return: Tuple of stamp and the objects it refers to by id, or None"""
+    if frame.attrs:
+        return None
+    manager = frame._mgr
+    blocks = getattr(manager, "blocks", None)
+    if blocks is None:
+        return None
+    pinned = [manager, blocks]
+    stamp = []
+    for axis in manager.axes:
+        pinned.append(axis)
+        stamp.append(axis.names)
+    for block in blocks:
+        values = block.values
+        if not isinstance(values, numpy.ndarray) or values.dtype.hasobject or not frozen_array(values, numpy):
+            return None
+        pinned.extend((block, block.mgr_locs, values))
+        stamp.append((values.shape, values.strides, values.dtype))
+    return (tuple(map(id, pinned)), tuple(stamp), frame.flags.allows_duplicate_labels), tuple(pinned)
+
+
+class HashCache:
+    """Bounded LRU cache of persistent ids so unchanged objects are not re-serialised and re-hashed on every event.
+
+    Immutable values, and short containers of them, are keyed by their type and value. Objects which can not be
+    written in place, see frozen_version, are keyed by id(obj), guarded by a weak reference so a recycled id is never
+    mistaken for the original object, and stored with a version stamp so a reshaped or rebuilt object is hashed again.
+    Everything else (writeable arrays, nested containers, ...) is always hashed, as telling whether it changed would
+    cost about as much as hashing it."""
+
+    def __init__(self, hash_function, max_size=4096):
+        """
+        :param hash_function: Function creating the persistent id of an object
+        :param max_size: Maximum number of cached ids, 0 disables the cache
+        """
+        self.hash_function = hash_function
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def persistent_id(self, obj):
+        """Get the persistent id of an object, hashing it only if it is not cached or may have changed
+        :param obj: python object
+        :return: persistent id"""
+        if not self.max_size:
+            return self.hash_function(obj)
+
+        obj_type = type(obj)
+        if obj_type in IMMUTABLE_TYPES:
+            if obj_type in (str, bytes) and len(obj) > IMMUTABLE_MAX_LEN:
+                self.misses += 1
+                return self.hash_function(obj)
+            return self.value_id((obj_type, obj), obj)
+        key = content_key(obj)
+        if key is not None:
+            return self.value_id(key, obj)
+
+        version = frozen_version(obj)
+        if version is None:
+            self.misses += 1
+            return self.hash_function(obj)
+
+        version, pinned = version
+        key = id(obj)
+        entry = self.entries.get(key)
+        if entry is not None:
+            ref, cached_version, digest, _ = entry
+            if ref() is obj and cached_version == version:
+                self.touch(key)
+                self.hits += 1
+                return digest
+
+        self.misses += 1
+        digest = self.hash_function(obj)
+        # the pinned objects stay alive with the entry, so their ids in the version are not reused
+        self.store(key, (weakref.ref(obj), version, digest, pinned))
+        return digest
+
+    def value_id(self, key, obj):
+        """Persistent id of an object cached against its value
+        :param key: Hashable key of the type and value
+        :param obj: python object
+        :return: persistent id"""
+        digest = self.entries.get(key)
+        if digest is not None:
+            self.touch(key)
+            self.hits += 1
+            return digest
+        self.misses += 1
+        digest = self.hash_function(obj)
+        self.store(key, digest)
+        return digest
+
+    def touch(self, key):
+        """Mark an entry as most recently used, another traced thread may have evicted it since it was read"""
+        try:
+            self.entries.move_to_end(key)
+        except KeyError:
+            pass
+
+    def store(self, key, value):
+        self.entries[key] = value
+        self.touch(key)
+        if len(self.entries) > self.max_size:
+            try:
+                self.entries.popitem(last=False)
+            except KeyError:
+                pass
+
+    def clear(self):
+        self.entries.clear()
@@ -0,0 +1,211 @@
+import json
+
+from praetor.json_to_ttl import Converter, format_time_stamp
+
+# Line oriented output: every statement is one self contained line, the vocabulary is expanded to full IRIs and ids are
+# written as they are in the turtle, so files can be split anywhere between lines, loaded in parallel and uploaded in
+# chunks. Blank nodes would be scoped to the chunk they end up in, they are replaced by skolem IRIs (RDF 1.1,
+# section 3.5) under the IRI of the session.
+
+# "@prefix prov: <http://www.w3.org/ns/prov#> ." lines of the turtle context
+PREFIXES = {name[:-1]: namespace[1:-1] for _, name, namespace, _ in (line.split() for line in Converter.context.splitlines())}
+
+LITERAL_ESCAPES = str.maketrans({"\\": "\\\\", "\"": "\\\"", "\n": "\\n", "\r": "\\r"})
+
+
+def expand(name):
+    """Full IRI of a prefixed name, names without a prefix are put in the prtr namespace
+    :param name: Prefixed name, e.g. run:1234
+    :return: IRI in angle brackets"""
+    prefix, separator, local = name.partition(":")
+    if not separator:
+        return "<{}{}>".format(PREFIXES["prtr"], name)
+    namespace = PREFIXES.get(prefix)
+    if namespace is None:
+        return "<{}>".format(name)
+    return "<{}{}>".format(namespace, local)
+
+
+def iri(identifier):
+    """IRI of an activity, entity or agent id, written as it is like in the turtle
+    :param identifier: ID, e.g. run:1234
+    :return: IRI in angle brackets"""
+    return "<" + identifier + ">"
+
+
+def literal(value, datatype=None):
+    """Escaped literal, typed if a datatype is given
+    :param value: Value of the literal, converted to a string
+    :param datatype: Prefixed name of the datatype, e.g. xsd:string
+    :return: Literal"""
+    escaped = '"{}"'.format(str(value).translate(LITERAL_ESCAPES))
+    if datatype is None:
+        return escaped
+    return escaped + "^^" + expand(datatype)
+
+
+A = expand("rdf:type")
+ACTIVITY = expand("prov:Activity")
+ENTITY = expand("prov:Entity")
+USAGE = expand("prov:Usage")
+START = expand("prov:Start")
+COMMUNICATION = expand("prov:Communication")
+AGENT = expand("prov:Agent")
+STARTED_AT = expand("prov:startedAtTime")
+ENDED_AT = expand("prov:endedAtTime")
+DURATION_NS = expand("prtr:durationNs")
+MEMORY_CALL = expand("prtr:memoryCall")
+MEMORY_RETURN = expand("prtr:memoryReturn")
+FILE_ACCESS = expand("prtr:fileAccess")
+THREAD_ID = expand("prtr:threadId")
+TASK_NAME = expand("prtr:taskName")
+YIELD_COUNT = expand("prtr:yieldCount")
+XSD_LONG = expand("xsd:long")
+XSD_DOUBLE = expand("xsd:double")
+
+ACTIVITY_TEMPLATE = ("{0} " + A + " " + ACTIVITY + "{e}"
+                     "{0} " + expand("prtr:activityName") + " {1}{e}"
+                     "{0} " + expand("prtr:activitySource") + " {2}{e}"
+                     "{0} " + expand("prov:wasAssociatedWith") + " {3}{e}").format
+ENTITY_TEMPLATE = ("{0} " + A + " " + ENTITY + "{e}"
+                   "{0} " + expand("prov:value") + " {1}{e}").format
+INPUT_TEMPLATE = ("{1} " + A + " " + USAGE + "{e}"
+                  "{1} " + expand("prov:entity") + " {0}{e}"
+                  "{3} " + expand("prov:qualifiedUsage") + " {1}{e}"
+                  "{1} " + expand("prov:hadRole") + " {2}{e}").format
+OUTPUT_TEMPLATE = ("{0} " + expand("prov:wasGeneratedBy") + " {1}{e}").format
+MUTATED_TEMPLATE = ("{0} " + expand("prov:wasGeneratedBy") + " {1}{e}"
+                    "{0} " + expand("prov:wasDerivedFrom") + " {2}{e}").format
+SUMMARY_TEMPLATE = ("{0} " + A + " " + ACTIVITY + "{e}"
+                    "{0} " + expand("prtr:activityName") + " {1}{e}"
+                    "{0} " + expand("prtr:activitySource") + " {2}{e}"
+                    "{0} " + expand("prtr:summaryOf") + " {3}{e}"
+                    "{0} " + expand("prtr:callCount") + " {4}{e}"
+                    "{0} " + expand("prtr:totalDuration") + " {5}{e}"
+                    "{0} " + expand("prtr:minDuration") + " {6}{e}"
+                    "{0} " + expand("prtr:maxDuration") + " {7}{e}"
+                    "{0} " + expand("prtr:durationHistogram") + " {9}{e}"
+                    "{0} " + expand("prov:wasAssociatedWith") + " {8}{e}").format
+CALLER_TEMPLATE = ("{0} " + A + " " + COMMUNICATION + "{e}"
+                   "{0} " + expand("prov:activity") + " {1}{e}"
+                   "{0} " + expand("prtr:callCount") + " {2}{e}"
+                   "{0} " + expand("prtr:totalDuration") + " {3}{e}"
+                   "{4} " + expand("prov:qualifiedCommunication") + " {0}{e}"
+                   "{4} " + expand("prov:wasInformedBy") + " {1}{e}").format
+STARTED_TEMPLATE = ("{0} " + A + " " + START + "{e}"
+                    "{1} " + expand("prov:qualifiedStart") + " {0}{e}"
+                    "{0} " + expand("prov:hadActivity") + " {2}{e}").format
+PROCESS_TEMPLATE = ("{0} " + A + " " + AGENT + "{e}"
+                    "{0} " + expand("prtr:processId") + " {1}{e}"
+                    "{0} " + expand("prov:actedOnBehalfOf") + " {2}{e}").format
+SPAWN_TEMPLATE = ("{0} " + A + " " + expand("prov:Delegation") + "{e}"
+                  "{0} " + expand("prov:agent") + " {2}{e}"
+                  "{0} " + expand("prov:hadActivity") + " {3}{e}"
+                  "{1} " + expand("prov:qualifiedDelegation") + " {0}{e}").format
+STATEMENT_TEMPLATE = "{} {} {}{}".format
+
+
+class QuadConverter(Converter):
+    """Convert flattened json provenance to N-Triples or N-Quads, the same statements as the turtle of Converter"""
+
+    def __init__(self, bindings, session_iri, quads=True):
+        """
+        :param bindings: Bindings of the first record
+        :param session_iri: IRI of the session, the graph name of the quads and the base of the skolem IRIs
+        :param quads: Write N-Quads with the session as graph name, N-Triples if False
+        """
+        super().__init__(bindings)
+        self.session_iri = session_iri
+        self.statement_end = " <{}> .\n".format(session_iri) if quads else " .\n"
+
+    def blank_label(self):
+        """Skolem IRI standing in for the next blank node"""
+        return "<{}/.well-known/genid/{}>".format(self.session_iri, super().blank_label())
+
+    def generate_agent_triple(self, agent_file):
+        """Statements of the agent of the session
+        :param agent_file: agent_json.json of the session
+        :return: String of statements"""
+        with open(agent_file, 'r') as f:
+            agent_var = json.load(f)["agent"]["var"]
+
+        end = self.statement_end
+        agent = iri(agent_var["lifeline"])
+        statements = [STATEMENT_TEMPLATE(agent, A, AGENT, end),
+                      STATEMENT_TEMPLATE(agent, expand("prtr:pythonVersion"), literal(agent_var["python_version"]), end)]
+        for key, value in agent_var.items():
+            if key not in ["lifeline", "python_version"]:
+                statements.append(STATEMENT_TEMPLATE(agent, expand(key), literal(value), end))
+        return "".join(statements)
+
+    def generate_activity_triple(self):
+        bindings = self.bindings
+        end = self.statement_end
+        activity = iri(bindings['message']["@id"])
+        start_time = bindings['messageStartTime']['@value']
+        end_time = bindings['messageEndTime']['@value']
+
+        triples = ACTIVITY_TEMPLATE(activity, literal(bindings['activityName']["@value"]),
+                                    literal(bindings['moduleName']["@value"]), iri(self.agent_id), e=end)
+        if start_time != "-":
+            triples += STATEMENT_TEMPLATE(activity, STARTED_AT, literal(
+                format_time_stamp(start_time, self.clock_anchor), bindings['messageStartTime']['@type']), end)
+        if end_time != "-":
+            triples += STATEMENT_TEMPLATE(activity, ENDED_AT, literal(
+                format_time_stamp(end_time, self.clock_anchor), bindings['messageEndTime']['@type']), end)
+        if isinstance(start_time, int) and isinstance(end_time, int):
+            triples += STATEMENT_TEMPLATE(activity, DURATION_NS, '"{}"^^{}'.format(end_time - start_time, XSD_LONG), end)
+        for key, predicate in (("memory_call", MEMORY_CALL), ("memory_return", MEMORY_RETURN),
+                               ("file_access", FILE_ACCESS), ("thread", THREAD_ID), ("task", TASK_NAME),
+                               ("yields", YIELD_COUNT)):
+            if key in bindings:
+                triples += STATEMENT_TEMPLATE(activity, predicate,
+                                              literal(bindings[key]['@value'], bindings[key]['@type']), end)
+        return triples
+
+    def generate_entity_triple(self, entity_object):
+        return ENTITY_TEMPLATE(iri(entity_object["@id"]), literal(entity_object["@value"], entity_object["@type"]),
+                               e=self.statement_end)
+
+    def generate_input_triple(self, input_object, activity_id):
+        return INPUT_TEMPLATE(iri(input_object["@id"]), self.blank_label(), literal(input_object["@role"]),
+                              iri(activity_id), e=self.statement_end)
+
+    def generate_output_triple(self, output_object, activity_id):
+        return OUTPUT_TEMPLATE(iri(output_object["@id"]), iri(activity_id), e=self.statement_end)
+
+    def generate_mutated_triple(self, mutated_object, activity_id):
+        return MUTATED_TEMPLATE(iri(mutated_object["@id"]), iri(activity_id),
+                                iri(mutated_object["@derivedFrom"]), e=self.statement_end)
+
+    def generate_summary_triple(self):
+        bindings = self.bindings
+        return SUMMARY_TEMPLATE(iri(bindings['message']["@id"]), literal(bindings['activityName']["@value"]),
+                                literal(bindings['moduleName']["@value"]), literal(bindings['summaryOf']["@value"]),
+                                literal(bindings['callCount']["@value"], "xsd:long"),
+                                literal(bindings['totalDuration']["@value"], "xsd:double"),
+                                literal(bindings['minDuration']["@value"], "xsd:double"),
+                                literal(bindings['maxDuration']["@value"], "xsd:double"), iri(self.agent_id),
+                                literal(bindings['durationHistogram']["@value"]), e=self.statement_end)
+
+    def generate_caller_triple(self, caller_object, activity_id):
+        return CALLER_TEMPLATE(self.blank_label(), iri(caller_object["@id"]),
+                               '"{}"^^{}'.format(caller_object["callCount"], XSD_LONG),
+                               '"{}"^^{}'.format(caller_object["totalDuration"], XSD_DOUBLE), iri(activity_id),
+                               e=self.statement_end)
+
+    def generate_process_triple(self, process_object):
+        return PROCESS_TEMPLATE(iri(process_object["@id"]), '"{}"^^{}'.format(process_object["processId"], XSD_LONG),
+                                iri(process_object["parentAgent"]), e=self.statement_end)
+
+    def generate_spawn_triple(self, spawn_object):
+        return SPAWN_TEMPLATE(self.blank_label(), iri(spawn_object["@id"]), iri(spawn_object["parentAgent"]),
+                              iri(spawn_object["parentActivity"]), e=self.statement_end)
+
+    def generate_started_string(self):
+        return STARTED_TEMPLATE(self.blank_label(), iri(self.bindings["message2"]["@id"]),
+                                iri(self.bindings["message"]["@id"]), e=self.statement_end)
+
+    def generate_started_by_string(self):
+        return STARTED_TEMPLATE(self.blank_label(), iri(self.bindings["message"]["@id"]),
+                                iri(self.bindings["startedBy"]["@id"]), e=self.statement_end)
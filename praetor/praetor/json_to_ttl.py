@@ -1,3 +1,4 @@
+import datetime
 import json
 
 # change to output dir and session id ?
@@ -20,7 +21,108 @@ def generate_agent_triple(agent_file):
     return agent_string, agent_id
 
 
+def read_clock_anchor(agent_file):
+    """Read the wall clock/monotonic clock pair recorded at the start of the session
+    :param agent_file: agent_json.json of the session
+    :return: Dictionary with wall_ns and monotonic_ns, None for sessions recorded with date strings"""
+    with open(agent_file, 'r') as f:
+        agent_json = json.load(f)
+    return agent_json.get("clock")
+
+
+def format_time_stamp(time_stamp, clock_anchor):
+    """Convert a monotonic nanosecond time stamp into an xsd:dateTime string with nanosecond precision, date strings
+    from older traces are returned as they are
+    :param time_stamp: time.perf_counter_ns() reading or date string
+    :param clock_anchor: Dictionary with wall_ns and monotonic_ns readings taken at the same moment
+    :return: Date string"""
+    if not isinstance(time_stamp, int) or clock_anchor is None:
+        return time_stamp
+    wall_ns = clock_anchor["wall_ns"] + time_stamp - clock_anchor["monotonic_ns"]
+    seconds, nanoseconds = divmod(wall_ns, 1000000000)
+    date_time = datetime.datetime.fromtimestamp(seconds, datetime.timezone.utc)
+    return "{}.{:09d}".format(date_time.strftime('%Y-%m-%dT%H:%M:%S'), nanoseconds)
+
+
+# turtle templates, bound to their format method once rather than parsed again for every fragment
+ACTIVITY_TEMPLATE = """
+<{0}> a prov:Activity ;{1}{2}{6}{7}{8}{9}{10}
+    prtr:activityName "{3}" ;
+    prtr:activitySource "{4}" .
+
+<{0}> prov:wasAssociatedWith <{5}> .""".format
+START_TIME_TEMPLATE = '\n    prov:startedAtTime "{0}"^^{1} ;\n'.format
+END_TIME_TEMPLATE = '\n    prov:endedAtTime "{0}"^^{1} ;\n'.format
+DURATION_TEMPLATE = '\n    prtr:durationNs "{0}"^^xsd:long ;'.format
+MEMORY_CALL_TEMPLATE = '\n    prtr:memoryCall "{0}"^^{1};'.format
+MEMORY_RETURN_TEMPLATE = '\n    prtr:memoryReturn "{0}"^^{1};'.format
+FILE_ACCESS_TEMPLATE = '\n    prtr:fileAccess "{0}"^^{1};'.format
+THREAD_TEMPLATE = '\n    prtr:threadId "{0}"^^{1} ;'.format
+TASK_TEMPLATE = '\n    prtr:taskName "{0}"^^{1} ;'.format
+YIELDS_TEMPLATE = '\n    prtr:yieldCount "{0}"^^{1} ;'.format
+ENTITY_TEMPLATE = """
+<{0}> a prov:Entity ;
+    prov:value "{1}"^^{2} .
+""".format
+INPUT_TEMPLATE = """
+_:{1} a prov:Usage ;
+    prov:entity <{0}> .
+
+<{3}> prov:qualifiedUsage _:{1} . 
+
+_:{1} prov:hadRole "{2}" .
+        """.format
+OUTPUT_TEMPLATE = """
+<{0}> prov:wasGeneratedBy <{1}> .""".format
+MUTATED_TEMPLATE = """
+<{0}> prov:wasGeneratedBy <{1}> .
+
+<{0}> prov:wasDerivedFrom <{2}> .""".format
+SUMMARY_TEMPLATE = """
+<{0}> a prov:Activity ;
+    prtr:activityName "{1}" ;
+    prtr:activitySource "{2}" ;
+    prtr:summaryOf "{3}" ;
+    prtr:callCount "{4}"^^xsd:long ;
+    prtr:totalDuration "{5}"^^xsd:double ;
+    prtr:minDuration "{6}"^^xsd:double ;
+    prtr:maxDuration "{7}"^^xsd:double ;
+    prtr:durationHistogram "{9}" .
+
+<{0}> prov:wasAssociatedWith <{8}> .""".format
+CALLER_TEMPLATE = """
+
+_:{0} a prov:Communication ;
+    prov:activity <{1}> ;
+    prtr:callCount "{2}"^^xsd:long ;
+    prtr:totalDuration "{3}"^^xsd:double .
+
+<{4}> prov:qualifiedCommunication _:{0} .
+
+<{4}> prov:wasInformedBy <{1}> .""".format
+PROCESS_TEMPLATE = """
+<{0}> a prov:Agent ;
+    prtr:processId "{1}"^^xsd:long ;
+    prov:actedOnBehalfOf <{2}> .""".format
+SPAWN_TEMPLATE = """
+
+_:{0} a prov:Delegation ;
+    prov:agent <{2}> ;
+    prov:hadActivity <{3}> .
+
+<{1}> prov:qualifiedDelegation _:{0} .""".format
+STARTED_TEMPLATE = """
+_:{0} a prov:Start .
+
+<{1}> prov:qualifiedStart _:{0} .
+
+_:{0} prov:hadActivity <{2}> .""".format
+
+
 class Converter:
+    """Convert flattened json provenance to turtle one record at a time. The triples of a record are streamed into
+    the output as fragments rather than concatenated into one string first"""
+
     context = """@prefix prov: <http://www.w3.org/ns/prov#> .
 @prefix run: <http://example.org/> .
 @prefix urn_uuid: <urn:uuid:> .
@@ -34,103 +136,159 @@ class Converter:
 """
     # agent_triple, agent_id = generate_agent_triple(agent_dictionary)
     agent_id = "agent_id"
+    clock_anchor = None
+    # shards of a parallel conversion each use their own prefix so blank node labels never collide
+    blank_prefix = "blank"
 
     def __init__(self, bindings):
-        self.triple_string = ""
         self.bindings = bindings
         self.blank_counter = 0
 
+    def blank_label(self):
+        """Next blank node label, unique within the output of this converter"""
+        label = "{}{}".format(self.blank_prefix, self.blank_counter)
+        self.blank_counter += 1
+        return label
+
     def generate_activity_triple(self):
+        bindings = self.bindings
+        start_time = bindings['messageStartTime']['@value']
+        end_time = bindings['messageEndTime']['@value']
 
-        if self.bindings['messageStartTime']['@value'] == "-":
+        if start_time == "-":
             start_time_line = ""
         else:
-            start_time_line = '\n    prov:startedAtTime "{0}"^^{1} ;\n'.format(self.bindings['messageStartTime']['@value'],
-                                                                           self.bindings['messageStartTime']['@type'])
+            start_time_line = START_TIME_TEMPLATE(format_time_stamp(start_time, self.clock_anchor),
+                                                  bindings['messageStartTime']['@type'])
 
-        if self.bindings['messageEndTime']['@value'] == "-":
+        if end_time == "-":
             end_time_line = ""
         else:
-            end_time_line = '\n    prov:endedAtTime "{0}"^^{1} ;\n'.format(self.bindings['messageEndTime']['@value'],
-                                                                       self.bindings['messageEndTime']['@type'])
-        if "memory_call" in self.bindings:
-            memory_call_line = '\n    prtr:memoryCall "{0}"^^{1};'.format(self.bindings['memory_call']['@value'],self.bindings['memory_call']['@type'])
+            end_time_line = END_TIME_TEMPLATE(format_time_stamp(end_time, self.clock_anchor),
+                                              bindings['messageEndTime']['@type'])
+        if isinstance(start_time, int) and isinstance(end_time, int):
+            end_time_line += DURATION_TEMPLATE(end_time - start_time)
+        if "memory_call" in bindings:
+            memory_call_line = MEMORY_CALL_TEMPLATE(bindings['memory_call']['@value'], bindings['memory_call']['@type'])
         else:
             memory_call_line = ''
-        if "memory_return" in self.bindings:
-            memory_return_line = '\n    prtr:memoryReturn "{0}"^^{1};'.format(self.bindings['memory_return']['@value'],self.bindings['memory_return']['@type'])
+        if "memory_return" in bindings:
+            memory_return_line = MEMORY_RETURN_TEMPLATE(bindings['memory_return']['@value'],
+                                                        bindings['memory_return']['@type'])
         else:
             memory_return_line = ''
-        if "file_access" in self.bindings:
-            file_access_line = '\n    prtr:fileAccess "{0}"^^{1};'.format(self.bindings['file_access']['@value'],self.bindings['file_access']['@type'])
+        if "file_access" in bindings:
+            file_access_line = FILE_ACCESS_TEMPLATE(bindings['file_access']['@value'], bindings['file_access']['@type'])
         else:
             file_access_line = ''
-        act_string = """
-<{0}> a prov:Activity ;{1}{2}{6}{7}{8}
-    prtr:activityName "{3}" ;
-    prtr:activitySource "{4}" .
+        # traces recorded before threads were traced have no thread binding
+        if "thread" in bindings:
+            thread_line = THREAD_TEMPLATE(bindings['thread']['@value'], bindings['thread']['@type'])
+        else:
+            thread_line = ''
+        # coroutines recorded in asyncio mode
+        task_line = ''
+        if "task" in bindings:
+            task_line += TASK_TEMPLATE(bindings['task']['@value'], bindings['task']['@type'])
+        if "yields" in bindings:
+            task_line += YIELDS_TEMPLATE(bindings['yields']['@value'], bindings['yields']['@type'])
+        return ACTIVITY_TEMPLATE(bindings['message']["@id"], start_time_line, end_time_line,
+                                 bindings['activityName']["@value"], bindings['moduleName']["@value"], self.agent_id,
+                                 memory_call_line, memory_return_line, file_access_line, thread_line, task_line)
 
-<{0}> prov:wasAssociatedWith <{5}> .""".format(self.bindings['message']["@id"],
-                                                       start_time_line,
-                                                       end_time_line,
-                                                       self.bindings['activityName']["@value"],
-                                                       self.bindings['moduleName']["@value"],
-                                                       self.agent_id,
-                                                       memory_call_line,
-                                                       memory_return_line,
-                                                       file_access_line)
-        self.triple_string += act_string
+    def generate_entity_triple(self, entity_object):
+        """Entity with its value, written once per entity"""
+        return ENTITY_TEMPLATE(entity_object["@id"], entity_object["@value"], entity_object["@type"])
 
     def generate_input_triple(self, input_object, activity_id):
-        in_string = """
-<{0}> a prov:Entity ;
-    prov:value "{1}"^^{2} .
+        return INPUT_TEMPLATE(input_object["@id"], self.blank_label(), input_object["@role"], activity_id)
 
-_:blank{3} a prov:Usage ;
-    prov:entity <{0}> .
-
-<{5}> prov:qualifiedUsage _:blank{3} . 
+    def generate_output_triple(self, output_object, activity_id):
+        return OUTPUT_TEMPLATE(output_object["@id"], activity_id)
 
-_:blank{3} prov:hadRole "{4}" .
-        """.format(input_object["@id"], input_object["@value"], input_object["@type"], self.blank_counter, input_object["@role"],
-                   activity_id)
-        self.blank_counter += 1
-        self.triple_string += in_string
+    def generate_mutated_triple(self, mutated_object, activity_id):
+        """Input which was changed in place by the activity, a new entity derived from the one which was passed in"""
+        return MUTATED_TEMPLATE(mutated_object["@id"], activity_id, mutated_object["@derivedFrom"])
 
+    def generate_summary_triple(self):
+        """Summary activity standing in for calls of a function which were aggregated rather than recorded"""
+        bindings = self.bindings
+        return SUMMARY_TEMPLATE(bindings['message']["@id"], bindings['activityName']["@value"],
+                                bindings['moduleName']["@value"], bindings['summaryOf']["@value"],
+                                bindings['callCount']["@value"], bindings['totalDuration']["@value"],
+                                bindings['minDuration']["@value"], bindings['maxDuration']["@value"], self.agent_id,
+                                bindings['durationHistogram']["@value"])
 
-    def generate_output_triple(self, output_object, activity_id):
-        out_string = """
-<{0}> a prov:Entity ;
-    prov:value "{1}"^^{2} .
+    def generate_caller_triple(self, caller_object, activity_id):
+        """Qualified communication from the summary activity of a caller, with the number and duration of the calls"""
+        return CALLER_TEMPLATE(self.blank_label(), caller_object["@id"], caller_object["callCount"],
+                               caller_object["totalDuration"], activity_id)
 
-<{0}> prov:wasGeneratedBy <{3}> .""".format(output_object["@id"], output_object["@value"], output_object["@type"],
-                                              activity_id)
+    def generate_process_triple(self, process_object):
+        """Agent of a child process of the session, acting on behalf of the agent of the process which started it"""
+        return PROCESS_TEMPLATE(process_object["@id"], process_object["processId"], process_object["parentAgent"])
 
-        self.triple_string += out_string
+    def generate_spawn_triple(self, spawn_object):
+        """Qualified delegation of a child process, with the activity of the parent which started it"""
+        return SPAWN_TEMPLATE(self.blank_label(), spawn_object["@id"], spawn_object["parentAgent"],
+                              spawn_object["parentActivity"])
 
     def generate_started_string(self):
-        start_triples = """
-_:blank{0} a prov:Start .
+        return STARTED_TEMPLATE(self.blank_label(), self.bindings["message2"]["@id"], self.bindings["message"]["@id"])
 
-<{1}> prov:qualifiedStart _:blank{0} .
-
-_:blank{0} prov:hadActivity <{2}> .""".format(self.blank_counter, self.bindings["message2"]["@id"],
-                                              self.bindings["message"]["@id"])
-        self.blank_counter += 1
-        self.triple_string += start_triples
+    def generate_started_by_string(self):
+        """Qualified start of a coroutine by the coroutine awaiting it, or which created the task running it"""
+        return STARTED_TEMPLATE(self.blank_label(), self.bindings["message"]["@id"], self.bindings["startedBy"]["@id"])
 
     def generate_line_triples(self):
-        self.generate_activity_triple()
-        activity_id = self.bindings['message']["@id"]
-        inputs = [x for x in self.bindings if x.startswith('input_')]
-        for input_key in inputs:
-            self.generate_input_triple(self.bindings[input_key], activity_id)
+        """Triples of the current record, one fragment per statement group so the cost is linear in the number of
+        bindings however large the activity is
+        :return: Generator of turtle fragments"""
+        bindings = self.bindings
+        activity_id = bindings['message']["@id"] if 'message' in bindings else None
+        if "callCount" in bindings:
+            yield self.generate_summary_triple()
+            for key, caller_object in bindings.items():
+                if key.startswith('caller_'):
+                    yield self.generate_caller_triple(caller_object, activity_id)
+            return
+        if "entity" in bindings:
+            yield self.generate_entity_triple(bindings["entity"])
+            return
+        if "process" in bindings:
+            yield self.generate_process_triple(bindings["process"])
+            return
+        if "spawn" in bindings:
+            yield self.generate_spawn_triple(bindings["spawn"])
+            return
+
+        yield self.generate_activity_triple()
+        # traces recorded without entity deduplication carry the value with every binding
+        for key, input_object in bindings.items():
+            if key.startswith('input_'):
+                if "@value" in input_object:
+                    yield self.generate_entity_triple(input_object)
+                yield self.generate_input_triple(input_object, activity_id)
+
+        for key, output_object in bindings.items():
+            if key.startswith('output_'):
+                if "@value" in output_object:
+                    yield self.generate_entity_triple(output_object)
+                yield self.generate_output_triple(output_object, activity_id)
+
+        for key, mutated_object in bindings.items():
+            if key.startswith('mutated_'):
+                if "@value" in mutated_object:
+                    yield self.generate_entity_triple(mutated_object)
+                yield self.generate_mutated_triple(mutated_object, activity_id)
 
-        outputs = [x for x in self.bindings if x.startswith('output_')]
-        for output_key in outputs:
-            self.generate_output_triple(self.bindings[output_key], activity_id)
+        if "message2" in bindings:
+            yield self.generate_started_string()
 
-        if "message2" in self.bindings.keys():
-            self.generate_started_string()
+        if "startedBy" in bindings:
+            yield self.generate_started_by_string()
 
-        return self.triple_string
+    def write_line_triples(self, write_to):
+        """Stream the triples of the current record into a file
+        :param write_to: Open text file"""
+        write_to.writelines(self.generate_line_triples())
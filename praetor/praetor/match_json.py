@@ -1,113 +1,140 @@
 import json
 
-def json_concat(input_json):
-    id_dict = {}
-    with open(input_json, "r") as to_read:
-        counter = 0
+from praetor.eventlog import MAGIC, is_event_log, read_event_log, read_frames
+from praetor.symbols import resolve_symbols
+
+
+def read_json_lines(input_path):
+    with open(input_path, "r", encoding='utf-8') as to_read:
         for line in to_read:
             line = line.strip()
             if not line:
                 continue
-            json_line = json.loads(line)
-            id_ = json_line["@id"]
-            mode_ = json_line["@mode"]
-            try:
-                id_dict[id_][mode_] = counter
-            except KeyError:
-                id_dict[id_] = {mode_: counter}
-            counter += 1
-
-    return id_dict
-
-
-
-def read_pairs_adaptive_return(file_path, output_path, line_index_dict):
-    """
-    Automatically adapts return format based on call/return presence:
-    - Only call: returns just the call line as string
-    - Only return: returns just the return line as string
-    - Both: returns combined string "call_data | return_data"
-    """
-    # 1. Analyze structure first
-    print("=== STRUCTURE ANALYSIS ===")
-    status_map = {}
-    needed_lines = set()
-
-    for key, info in line_index_dict.items():
-        has_call = "call" in info
-        has_return = "return" in info
-        status_map[
-            key] = "both" if has_call and has_return else "call" if has_call else "return" if has_return else "empty"
-
-        if has_call:
-            needed_lines.add(info["call"])
-        if has_return:
-            needed_lines.add(info["return"])
-
-        status_name = {"both": "CALL AND RETURN", "call": "CALL only", "return": "RETURN only", "empty": "EMPTY"}[
-            status_map[key]]
-        print(f"Key '{key}': {status_name}")
-
-
-    if not needed_lines:
-        print("No valid line numbers - returning empty dict")
-        return {}
-
-    # 2. Read only needed lines (single sequential pass)
-    print("Reading file...")
-    needed_lines = sorted(needed_lines)
-    lines_cache = {}
-    current_needed_idx = 0
-
+            yield json.loads(line)
+
+
+def read_records(input_path):
+    """Read the records of a raw trace, either JSON lines, with or without a symbol table, or a binary event log
+    :param input_path: Path of the raw trace
+    :return: Generator of dictionaries with @id, @mode and @data"""
+    if is_event_log(input_path):
+        yield from read_event_log(input_path)
+        return
+    yield from resolve_symbols(read_json_lines(input_path))
+
+
+def merge_pair(call_data, return_data):
+    """Combine the provenance of a call and its return, the call side wins where both have a binding
+    :param call_data: @data of the call record
+    :param return_data: @data of the return record
+    :return: Merged bindings"""
+    merged = dict(return_data)
+    merged.update(call_data)
+    return merged
+
+
+class TraceTail:
+    """Read a raw trace while it is still being written. Each read returns the records completed since the previous
+    one, a partly written last line or frame is left for the next read"""
+
+    def __init__(self, input_path):
+        """
+        :param input_path: Path of the raw trace, JSON lines or binary event log
+        """
+        self.input_path = input_path
+        self.position = 0
+        self.binary = None
+        self.symbols = []
+
+    def read(self):
+        """Records appended since the last read, in the order they were written
+        :return: Generator of dictionaries with @id, @mode and @data, to be consumed completely"""
+        with open(self.input_path, "rb") as f:
+            if self.binary is None:
+                start = f.read(len(MAGIC))
+                if len(start) < len(MAGIC) and MAGIC.startswith(start):
+                    # too short to tell the format yet
+                    return
+                self.binary = start == MAGIC
+                self.position = len(MAGIC) if self.binary else 0
+            f.seek(self.position)
+            if self.binary:
+                for record in read_frames(f, self.symbols):
+                    self.position = f.tell()
+                    if record is not None:
+                        yield record
+            else:
+                yield from resolve_symbols(self.read_lines(f), self.symbols)
+
+    def read_lines(self, f):
+        """Complete JSON lines from the current position"""
+        for line in f:
+            if not line.endswith(b"\n"):
+                return
+            self.position += len(line)
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+class PairMerger:
+    """Pair the call and return records of a raw trace in a single pass. Activity ids are unique, so open calls are kept
+    in a dictionary by id and memory is bounded by the call depth rather than the size of the trace:
+    - call and return: the merged bindings
+    - only call (still open at the end of the trace): the call bindings without an end time
+    - only return: the return bindings without a start time
+    - summary and entity records: passed on as they are"""
+
+    def __init__(self):
+        self.open_calls = {}
+
+    def add(self, record):
+        """Add the next record of the trace
+        :param record: Dictionary with @id, @mode and @data
+        :return: Bindings to write, None if there is nothing to write yet"""
+        data = record["@data"]
+        if data is None:
+            return None
+        mode = record["@mode"]
+        key = record["@id"]
+        if mode == "call":
+            self.open_calls[key] = data
+            return None
+
+        if mode == "return":
+            call_data = self.open_calls.pop(key, None)
+            if call_data is not None:
+                return merge_pair(call_data, data)
+            data["messageStartTime"] = {"@type": "xsd:dateTime", "@value": "-"}
+        return data
+
+    def finish(self):
+        """Calls which never returned, at the end of the trace
+        :return: Generator of bindings"""
+        for data in self.open_calls.values():
+            data["messageEndTime"] = {"@type": "xsd:dateTime", "@value": "-"}
+            yield data
+        self.open_calls = {}
+
+
+def stream_pairs(file_path, output_path):
+    """Pair the call and return records of a raw trace with PairMerger and write each merged activity as soon as its
+    return is read
+    :param file_path: Path of the raw trace
+    :param output_path: Path of the flattened json lines file
+    :return: Number of records written"""
+    merger = PairMerger()
+    written = 0
     with open(output_path, "w", encoding='utf-8') as out_file:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            for line_num, line in enumerate(f):
-                while (current_needed_idx < len(needed_lines) and
-                       needed_lines[current_needed_idx] < line_num):
-                    current_needed_idx += 1
-
-                if (current_needed_idx < len(needed_lines) and
-                        needed_lines[current_needed_idx] == line_num):
-                    lines_cache[line_num] = line.rstrip()
-                    current_needed_idx += 1
-                    if current_needed_idx >= len(needed_lines):
-                        break
-
-        print(f"Read {len(lines_cache)} unique lines\n")
-
-        # 3. Adaptive return based on what's present for each key
-
-        for key, info in line_index_dict.items():
-            status = status_map[key]
-
-            if status == "both":
-                call_line = info["call"]
-                return_line = info["return"]
-                if call_line in lines_cache and return_line in lines_cache:
-                    json_line_call = json.loads(lines_cache[call_line])["@data"]
-                    json_line_return = json.loads(lines_cache[return_line])["@data"]
-                    merged = json_line_return | json_line_call # need to change for earlier python versions
-                    result_line = merged
-                else:
-                    result_line = "MISSING_LINE_DATA"
-
-            elif status == "call":
-                call_line = info["call"]
-                if call_line in lines_cache:
-                    json_line = json.loads(lines_cache[call_line])["@data"]
-                    json_line["messageEndTime"] = {"@type": "xsd:dateTime", "@value": "-"}
-                    result_line = json_line
-                else:
-                    result_line = "MISSING_LINE_DATA"
-
-            elif status == "return":
-                return_line = info["return"]
-                if return_line in lines_cache:
-                    json_line = json.loads(lines_cache[return_line])["@data"]
-                    json_line["messageStartTime"] = {"@type": "xsd:dateTime", "@value": "-"}
-                    result_line = json_line
-                else:
-                    result_line = "MISSING_LINE_DATA"
-
-            out_file.write(json.dumps(result_line) + "\n")
-            out_file.flush()
+        for record in read_records(file_path):
+            data = merger.add(record)
+            if data is not None:
+                out_file.write(json.dumps(data) + "\n")
+                written += 1
+
+        for data in merger.finish():
+            out_file.write(json.dumps(data) + "\n")
+            written += 1
+
+    print(f"Merged {written} records")
+    return written
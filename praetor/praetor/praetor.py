@@ -1,7 +1,6 @@
 import os.path
 from collections import Counter
 import inspect
-import datetime
 import uuid
 
 import json
@@ -10,12 +9,32 @@ import os
 import shutil
 import sysconfig
 import reprlib
+import re
 
+import functools
 import hashlib
+import itertools
 import pickle
+import threading
+import time
+import weakref
 
-from praetor.transform_output import create_full_json
+from praetor.transform_output import (RDF_FORMATS, create_full_json, create_full_json_subprocess,
+                                      finish_rolling_conversion, start_rolling_conversion)
 from praetor.process_monitor import DynamicProcessMonitor
+from praetor.hashing import IMMUTABLE_TYPES, HashCache, buffer_digest, get_hash_factory, snapshot
+from praetor.writers import BackgroundWriter, BufferedLineWriter, flush_on_exit
+from praetor.sampling import CallSampler, CallStatistics, summary_bindings
+from praetor.rendering import RenderCache, encode_if_larger, remove_quotes
+from praetor.eventlog import EventLogEncoder
+from praetor.symbols import SymbolTable
+from praetor import children
+from praetor.tasks import COROUTINE_FLAGS, TaskTracker
+
+TRACE_FORMATS = ("json", "binary")
+# filter decisions kept before the cache is cleared, code objects created at runtime, e.g. by exec, are not
+# accumulated without limit
+FILTER_CACHE_MAX_SIZE = 65536
 
 custom_repr = reprlib.Repr()
 custom_repr.maxlist = 80
@@ -41,10 +60,21 @@ def generate_pipeline_id():
     pipeline_id = "{}_provenance_{}".format(get_caller_script_name(), uuid.uuid4())
     return pipeline_id
 
-def get_modules(pipeline_id, out_directory, modules):
+def get_clock_anchor():
+    """
+    Pair a wall clock reading with a reading of the monotonic clock used for the event time stamps, so the time stamps
+    can be converted to dates when the provenance is finalised
+    :return: Dictionary of the wall clock and monotonic clock in nanoseconds
+    """
+    return {"wall_ns": time.time_ns(), "monotonic_ns": time.perf_counter_ns()}
+
+
+def get_modules(pipeline_id, out_directory, modules, hash_algorithm="sha256", clock_anchor=None):
     '''
     Function to create the agent_json.json file, including creating a unique id for the agent, determining all modules
     imported, find their versions, structure and input all infroamtion into agent_json.json
+    :param hash_algorithm: Name of the algorithm used for the entity ids
+    :param clock_anchor: Wall clock and monotonic clock reading taken at the start of the session
     :return: agent_json.json
     '''
     bindings = {
@@ -60,10 +90,12 @@ def get_modules(pipeline_id, out_directory, modules):
     bindings['var']['python_version'] = py_version
     bindings['var']['lifeline'] = 'urn_uuid:{}'.format(pipeline_id)
     bindings['var']['run_cmd'] = f"{sys.executable} {' '.join(sys.argv)}"
+    bindings['var']['prtr:hashAlgorithm'] = hash_algorithm
 
     json_dir = out_directory + '/json/'
 
     json_total['agent'] = bindings
+    json_total['clock'] = clock_anchor if clock_anchor is not None else get_clock_anchor()
 
     agent_json = json_dir + "agent_json.json"
 
@@ -126,6 +158,50 @@ def get_non_builtin_modules_versions():
     return modules_versions
 
 
+def compile_block_list(block_list_mod):
+    """
+    Compile a block list of module names into a single prefix matching regex so the cost of checking a module does not
+    grow with the length of the block list
+    :param block_list_mod: Iterable of module names (or module name prefixes)
+    :return: Compiled regex, or None if the block list is empty
+    """
+    if not block_list_mod:
+        return None
+    # longest first so the alternation never stops on a shorter prefix of the same module
+    prefixes = sorted(set(block_list_mod), key=len, reverse=True)
+    return re.compile("|".join(re.escape(prefix) for prefix in prefixes))
+
+
+class ThreadState:
+    """State of a CallTracer with a separate value in every thread, the call stack and last activity of a traced thread
+    and the event being formatted, so events of different threads formatted at the same time do not overwrite each
+    other's name, inputs or times. An event fetches the state of its thread once and then uses plain attributes"""
+
+    __slots__ = ("stack", "last_activity", "name", "module_name", "stack_id", "inputs", "output", "input_captures",
+                 "changed_inputs", "output_capture", "start_time", "end_time", "thread_id", "process_count",
+                 "total_memory", "files_opened", "coroutine")
+
+    def __init__(self):
+        self.stack = []
+        # last activity of the traced thread, the previous activity of the next call or return on that thread
+        self.last_activity = {"id": None, "end": None, "start": None, "name": None}
+        self.name = None
+        self.module_name = None
+        self.stack_id = None
+        self.inputs = None
+        self.output = None
+        self.input_captures = None
+        self.changed_inputs = None
+        self.output_capture = None
+        # times of the last call and return formatted on the thread
+        self.start_time = "-"
+        self.end_time = "-"
+        self.thread_id = None
+        self.process_count = None
+        self.total_memory = None
+        self.files_opened = None
+        self.coroutine = None
+
 
 class CallTracer:
 
@@ -135,26 +211,97 @@ class CallTracer:
 
     def __init__(self, output_directory="./output/", block_list_mod=None, block_list_func=None, cpython=False,
                  bootstrap=False, store_large_values=False, only_main=False, slim=False, monitor_interval=1.0,
-                 process_monitor=False):
+                 process_monitor=False, hash_cache_size=4096, sample_hash_above=None,
+                 hash_algorithm="sha256", write_buffer_bytes=1024 * 1024, write_interval=1.0,
+                 background_writer=False, writer_queue_size=100000, backpressure="block", backpressure_sample=10,
+                 sampling=None, sample_every=100, sample_limit=100, sample_window=1.0, statistics=False,
+                 large_value_size=1024, render_cache_size=4096, deduplicate_entities=True, trace_format="json",
+                 intern_symbols=True, ttl_workers=1, rdf_format="turtle", rolling_interval=None,
+                 trace_children=True, asyncio_mode=False, snapshot_interval=0.01):
         """Setup for the CallTracer class
         :param output_directory: Where generated provenance will be stored
         :param block_list_mod: block_list of python modules
         :param block_list_func: block_list of python functions
         :param cpython: Whether to record provenance for cpython functions
         :param bootstrap: Whether to record provenance for bootstrapped functions
-        :param store_large_values: Whether to store copies of large values as files"""
+        :param store_large_values: Whether to store copies of large values as files
+        :param hash_cache_size: Number of persistent ids kept in the hash cache, 0 disables the cache
+        :param sample_hash_above: Size in bytes above which buffers (e.g. numpy arrays) get a sampled fingerprint
+        instead of a full hash, None always hashes the full buffer
+        :param hash_algorithm: Algorithm for the entity ids, sha256, blake2b, xxh64 or xxh128 (requires xxhash)
+        :param write_buffer_bytes: Size of the trace write buffer, 0 writes and flushes every event immediately
+        :param write_interval: Maximum time in seconds events are held in the write buffer
+        :param background_writer: Whether to format and write the provenance on a separate thread, the traced thread only
+        queues the raw event with snapshots of its mutable values, which are hashed on the writer thread. Values without
+        a cheap snapshot, e.g. nested containers or large arrays, are hashed on the traced thread and rendered after the
+        call, so an entity mutated straight away may be shown with its mutated value
+        :param writer_queue_size: Maximum number of events waiting for the background writer
+        :param backpressure: What to do when the writer queue is full; block, drop (counted in dropped_events), or
+        sample (keep every backpressure_sample-th overflowing event and drop the rest)
+        :param backpressure_sample: Sampling rate of the sample backpressure
+        :param sampling: Record only a sample of the calls of each function; every (every sample_every-th call),
+        first_per_window (the first sample_limit calls of every sample_window seconds) or first (the first sample_limit
+        calls). Calls left out are summarised with their count and durations
+        :param sample_every: Sampling rate of the every mode
+        :param sample_limit: Number of calls recorded per function by the first_per_window and first modes
+        :param sample_window: Length of the window in seconds
+        :param statistics: Only keep per (module, function, caller) call counts and duration histograms, no inputs or
+        outputs are captured and one summary activity per function is written at close
+        :param large_value_size: Size in characters of the JSON encoding above which values are stored as files when
+        store_large_values is set
+        :param render_cache_size: Number of rendered values remembered by entity id, 0 disables the memo
+        :param deduplicate_entities: Write the value of each entity to the trace once, the first time its id is seen,
+        and only reference it by id in activities afterwards
+        :param trace_format: Format of the raw trace, json lines or the compact binary event log
+        :param intern_symbols: Write repeated names, types and ids of json lines traces once in a symbol table and
+        refer to them by number, the binary event log always interns them
+        :param ttl_workers: Number of processes converting the provenance to turtle at close, 1 converts in this
+        process
+        :param rdf_format: Serialisation of the final provenance; turtle, or ntriples and nquads which have one
+        statement per line and can be split for bulk loading
+        :param rolling_interval: Convert the completed activities every rolling_interval seconds in a separate process
+        while the script runs, so close only converts the last segment and the calls still open. None converts the
+        whole trace at close
+        :param trace_children: Trace child processes (forked, or spawned ones importing praetor with the script) as
+        shards of the session, which are merged into its provenance at close
+        :param asyncio_mode: Record each coroutine execution as one activity from its start to its final return, however
+        often it is suspended, with the number of suspensions (prtr:yieldCount) and the asyncio task running it. The
+        activities of a task follow each other, and the first coroutine of a task was started by the coroutine which
+        created the task
+        :param snapshot_interval: Time in seconds within which calls and returns reuse the previous process monitor
+        snapshot instead of taking a new one, 0 takes a snapshot for every call and return"""
 
         self.record_prov = True
         self.process_monitor = process_monitor
         if self.process_monitor:
-            self.monitor = DynamicProcessMonitor(base_interval=monitor_interval)
+            self.monitor = DynamicProcessMonitor(base_interval=monitor_interval, snapshot_interval=snapshot_interval)
 
         self.calls = {}
-        self.session_id = generate_pipeline_id()  # change praetor to name of pipeline
+        parent = children.parent_session() if trace_children else None
+        if parent is None:
+            self.session_id = generate_pipeline_id()  # change praetor to name of pipeline
+            self.root_session_id = self.session_id
+            self.parent_agent_id = None
+        else:
+            # started by a traced process, this process is traced as a shard of its session
+            self.root_session_id = parent["session"]
+            self.session_id = children.shard_session(self.root_session_id, os.getpid())
+            self.parent_agent_id = parent["agent"]
+            output_directory = parent["output"]
+        self.agent_id = "urn_uuid:{}".format(self.session_id)
         self.prov_id_counter = Counter()
         self.prov_id_cache = dict()
+        self.sample_hash_above = sample_hash_above
+        self.hash_algorithm = hash_algorithm
+        self.hash_factory = get_hash_factory(hash_algorithm)
+        self.hash_cache = HashCache(self.hash_object, max_size=hash_cache_size)
 
         self.store_large_values = store_large_values
+        self.large_value_size = large_value_size
+        self.render_cache = RenderCache(render_cache_size)
+        self.seen_entities = set() if deduplicate_entities else None
+        # weak references to the objects whose entity ids are their memory address, by entity id
+        self.address_entities = {}
         self.prefix = "run:"
         self.dtypes = {'int': 'int', 'unsignedInt': 'unsignedInt', 'hexBinary': 'hexBinary', 'NOTATION': 'NOTATION',
                   'nonPositiveInteger': 'nonPositiveInteger', 'float': 'float', 'ENTITY': 'ENTITY', 'bool': 'boolean',
@@ -178,26 +325,171 @@ class CallTracer:
 
         os.makedirs(self.out_directory + "json/", exist_ok=True)
         os.makedirs(self.out_directory + "big_entities/", exist_ok=True)
-        self.out_handle = open(self.out_directory + "json/" + self.session_id + ".json", "a")
-
-        script_path = os.path.abspath(__file__)
-        script_name = script_path.split("/")[-1]
-        shutil.copy(script_path, self.out_directory + "{}_{}".format(self.session_id, script_name))
-
-        mods = get_non_builtin_modules_versions()
-        self.agent_json = get_modules(self.session_id, self.out_directory, mods)
+        if trace_format not in TRACE_FORMATS:
+            raise ValueError("Unknown trace format {}, choose from {}".format(trace_format, ", ".join(TRACE_FORMATS)))
+        if rdf_format not in RDF_FORMATS:
+            raise ValueError("Unknown rdf format {}, choose from {}".format(rdf_format, ", ".join(RDF_FORMATS)))
+        self.rdf_format = rdf_format
+        self.ttl_workers = ttl_workers
+        self.trace_format = trace_format
+        self.write_buffer_bytes = write_buffer_bytes
+        self.write_interval = write_interval
+        self.intern_symbols = intern_symbols
+        self.ignored_threads = set()
+        self.open_trace()
+
+        self.rolling_conversion = None
+        if self.parent_agent_id is None:
+            script_path = os.path.abspath(__file__)
+            script_name = script_path.split("/")[-1]
+            shutil.copy(script_path, self.out_directory + "{}_{}".format(self.session_id, script_name))
+
+            mods = get_non_builtin_modules_versions()
+            self.clock_anchor = get_clock_anchor()
+            self.agent_json = get_modules(self.session_id, self.out_directory, mods, hash_algorithm, self.clock_anchor)
+            if rolling_interval is not None:
+                self.rolling_conversion = start_rolling_conversion(self.agent_json, self.out_handle.name,
+                                                                   rolling_interval, self.rdf_format)
+        else:
+            # the agent and clock of the session are those of the script, only the agent of this process is recorded
+            self.write_record(children.process_record(self.agent_id, self.parent_agent_id))
 
-        self.last_activity = {"id": None, "end": None, "start": None, "name": None}
         self.activity_counter = {}
         self.bindings = {}
+        # activity ids are numbered per session, with a call stack per thread to find the activity of a return
+        self.activity_ids = itertools.count()
+        self.local = threading.local()
+        # mutable inputs and their captures at each open call, so the return only records inputs which were mutated
+        self.call_inputs = {}
 
         self.block_list_modules = block_list_mod
-        self.block_list_func = block_list_func
+        self.block_list_pattern = compile_block_list(block_list_mod)
+        self.block_list_func = frozenset(block_list_func) if block_list_func else None
         self.cpython = cpython
         self.bootstrap = bootstrap
         self.only_main = only_main
         self.slim = slim
         self.prefixes = ("_", "<")
+        self.tasks = TaskTracker() if asyncio_mode else None
+        self.backend = None
+        # code objects are not kept alive by the cache once their functions are gone
+        self.filter_cache = weakref.WeakKeyDictionary()
+
+        self.statistics = CallStatistics() if statistics else None
+        self.sampler = None
+        if sampling and not statistics:
+            self.sampler = CallSampler(sampling, every=sample_every, limit=sample_limit, window=sample_window)
+
+        self.background_writer = None
+        if background_writer:
+            self.background_writer = BackgroundWriter(self.process_event, max_queue=writer_queue_size,
+                                                      backpressure=backpressure, sample_every=backpressure_sample)
+            self.background_writer.start()
+            self.ignored_threads.add(self.background_writer.thread.ident)
+
+        if trace_children:
+            children.export_session(self.root_session_id, self.agent_id, self.out_directory)
+            children.patch_process_start(self)
+            if hasattr(os, "register_at_fork"):
+                os.register_at_fork(before=self.before_fork, after_in_parent=self.after_fork_in_parent,
+                                    after_in_child=self.after_fork_in_child)
+
+    def open_trace(self):
+        """Open the raw trace of the session with the writer and the symbol table or event log encoder of its format"""
+        if self.trace_format == "binary":
+            self.out_handle = open(self.out_directory + "json/" + self.session_id + ".prtr", "ab")
+        else:
+            self.out_handle = open(self.out_directory + "json/" + self.session_id + ".json", "a")
+        self.writer = BufferedLineWriter(self.out_handle, max_bytes=self.write_buffer_bytes,
+                                         max_interval=self.write_interval)
+        if self.writer.flusher is not None:
+            self.ignored_threads.add(self.writer.flusher.ident)
+        if self.write_buffer_bytes:
+            flush_on_exit(self.writer.flush)
+        # string and symbol definitions bypass the per thread buffers, so they are on disk before any record using them
+        self.event_log = None
+        if self.trace_format == "binary":
+            self.event_log = EventLogEncoder(self.writer.write_now)
+        self.symbol_table = None
+        if self.intern_symbols and self.event_log is None:
+            self.symbol_table = SymbolTable("urn_uuid:{}_".format(self.session_id),
+                                            lambda symbol: self.writer.write_now(json.dumps(symbol) + '\n'))
+
+    def before_fork(self):
+        """Hold the writer and pause recording while the process forks, so the child gets a consistent copy of the
+        tracer and records nothing with it before it has a trace of its own, e.g. the after fork handlers of threading
+        which run first"""
+        if self.close_file_var:
+            self.writer.hold()
+            self.recording_before_fork = self.record_prov
+            self.record_prov = False
+
+    def after_fork_in_parent(self):
+        if self.close_file_var:
+            self.record_prov = self.recording_before_fork
+            self.writer.release()
+
+    def after_fork_in_child(self):
+        """Carry on tracing in a forked child as a shard of the session, with a trace and agent of its own. What the
+        copy of the tracer holds of the parent, its buffers, call stacks, statistics and helper threads, is dropped"""
+        if not self.close_file_var:
+            return
+        activity_id = None if children.forked_by_process_start() else self.current_activity()
+        parent_agent_id = self.agent_id
+        self.writer.abandon()
+        self.session_id = children.shard_session(self.root_session_id, os.getpid())
+        self.agent_id = "urn_uuid:{}".format(self.session_id)
+        self.parent_agent_id = parent_agent_id
+        self.rolling_conversion = None
+        self.local = threading.local()
+        self.activity_ids = itertools.count()
+        self.bindings = {}
+        self.call_inputs = {}
+        if self.tasks is not None:
+            self.tasks = TaskTracker()
+
+        self.ignored_threads = set()
+        self.open_trace()
+        self.write_record(children.process_record(self.agent_id, parent_agent_id))
+        if activity_id is not None:
+            self.write_record(children.spawn_record(self.agent_id, parent_agent_id, activity_id))
+
+        # replaced rather than reset, their locks may have been held by threads which do not exist in the child
+        if self.process_monitor:
+            self.monitor = DynamicProcessMonitor(base_interval=self.monitor.base_interval,
+                                                 snapshot_interval=self.monitor.snapshot_interval)
+        if self.statistics is not None:
+            self.statistics = CallStatistics()
+        if self.sampler is not None:
+            sampler = self.sampler
+            self.sampler = CallSampler(sampler.mode, every=sampler.every, limit=sampler.limit, window=sampler.window)
+        if self.background_writer is not None:
+            writer = self.background_writer
+            self.background_writer = BackgroundWriter(self.process_event, max_queue=writer.queue.maxsize,
+                                                      backpressure=writer.backpressure,
+                                                      sample_every=writer.sample_every)
+            self.background_writer.start()
+            self.ignored_threads.add(self.background_writer.thread.ident)
+
+        children.export_session(self.root_session_id, self.agent_id, self.out_directory)
+        children.close_with_process(self)
+        self.record_prov = self.recording_before_fork
+
+    def current_activity(self):
+        """Message id of the innermost activity open on the current thread, e.g. the activity starting a child process
+        :returns: ID, None outside of recorded calls"""
+        stack = self.thread_state().stack
+        if not stack:
+            return None
+        return "urn_uuid:{}_{}".format(self.session_id, stack[-1][1])
+
+    def record_spawn(self, pid, activity_id):
+        """Link the agent of a child process to the activity which started it
+        :param pid: Process id of the child
+        :param activity_id: Message id of the activity"""
+        if self.record_prov:
+            child_agent_id = "urn_uuid:{}".format(children.shard_session(self.root_session_id, pid))
+            self.write_record(children.spawn_record(child_agent_id, self.agent_id, activity_id))
 
     def __call__(self, frame, event, arg):
         """Method to record metadata for each python call event
@@ -208,101 +500,26 @@ class CallTracer:
 
         if event in ["call", "return"]:
             code = frame.f_code
-            func_name = code.co_name
-            module_name = frame.f_globals.get("__name__", None)
-
-            if self.only_main and module_name != "__main__":
-                return self
-
-            if self.slim:
-                if func_name.startswith(self.prefixes):
-                    return self
-                if "._" in module_name:
-                    return self
-
-            if module_name == "praetor":
-                # print("passing my mod")
-                return self
-
-            if "praetor" in module_name:
-                # print("passing module")
-                return self
-            # #
-            # Ignore module-level frames
-            if func_name == "<module>":
-                return self
-
-            if not self.record_prov:
+            filtered = self.filter_cache.get(code)
+            if filtered is None:
+                filtered = self.cache_filter(code, frame)
+            if filtered or not self.record_prov:
                 return self
 
-            if self.bootstrap and module_name in ["importlib._bootstrap_external", "importlib._bootstrap"]:
-                return self
-
-            if self.block_list_modules:
-                if module_name in self.block_list_modules:
-                    return self
-                for mod in self.block_list_modules:
-                    if module_name.startswith(mod):
-                        return self
-
-
-            if self.block_list_func:
-                if func_name in self.block_list_func:
-                    return self
-
-            argcount = code.co_argcount
-            varnames = code.co_varnames
-
-            if len(varnames) > 0:
-                if self.slim and varnames[0] in ["cls", "self"]:
-                    return self
-
-            inputs = {
-                varnames[i]: frame.f_locals.get(varnames[i])
-                for i in range(argcount)
-            }
-
-            self.name = func_name
-            self.module_name = module_name
-            self.stack_id = str(id(frame))
-
-
-            self.inputs = inputs
-
-            if self.process_monitor:
-                process_stats = self.monitor.high_freq_snapshot(func_name)
-                self.process_count = process_stats["process_count"]
-                self.total_memory = process_stats["total_rss_mb"]
-                self.files_opened = process_stats["newly_opened_files"]
-
-            if event == "call":
-
-                self.start_time = self.date_time_stamp()
-                self.prov_call_in()
-                self.dump_json(mode="call")
-                return self
-
-            elif event == "return":
-                self.output = arg
-                self.end_time = self.date_time_stamp()
-                self.prov_call_out()
-                self.dump_json(mode="return")
-                return self
+            if self.tasks is not None and code.co_flags & COROUTINE_FLAGS:
+                event = self.tasks.profile_event(frame, event)
+            self.record_event(frame, event, arg, code.co_name, frame.f_globals.get("__name__", None))
+            return self
 
         elif event in ["c_call", "c_return"]:
 
-            if not self.cpython:
+            if not self.cpython or not self.record_prov:
                 return self
 
             cfunc = arg
-            key = str(id(cfunc))
             func_name = getattr(cfunc, "__name__", None)
             module_name = getattr(cfunc, "__module__", None)
 
-            self.name = func_name
-            self.module_name = module_name
-            self.stack_id = key
-
             code = frame.f_code
             argcount = code.co_argcount
             varnames = code.co_varnames
@@ -311,30 +528,25 @@ class CallTracer:
                 if self.slim and varnames[0] in ["cls", "self"]:
                     return self
 
+            if event == "c_call":
+                key = self.open_activity(id(cfunc))
+            else:
+                key = self.close_activity(id(cfunc))
+
+            if self.statistics is not None:
+                self.count_event(event, key, func_name, module_name)
+                return self
+
+            if self.sampler is not None and self.sampled_out(event, key, func_name, module_name):
+                return self
+
             inputs = {
                 varnames[i]: frame.f_locals.get(varnames[i])
                 for i in range(argcount)
             }
-            self.inputs = inputs
-
-            if self.process_monitor:
-                process_stats = self.monitor.high_freq_snapshot()
-                self.process_count = process_stats["process_count"]
-                self.total_memory = process_stats["total_rss_mb"]
-                self.files_opened = process_stats["newly_opened_files"]
-
-            if self.cpython and event == "c_call":
-                self.start_time = self.date_time_stamp()
-                self.prov_call_in()
-                self.dump_json(mode="call")
-                return self
 
-            if self.cpython and event == "c_return":
-                self.end_time = self.date_time_stamp()
-                self.output = "None"
-                self.prov_call_out()
-                self.dump_json(mode="return")
-                return self
+            self.submit_event(event, func_name, module_name, key, inputs, "None")
+            return self
 
         # code for if events are to be added
         # elif event == "exception":
@@ -347,40 +559,407 @@ class CallTracer:
 
         return self
 
-    @staticmethod
-    def date_time_stamp():
-        """Generate current date and time stamp
-        :returns: date and time stamp """
-        date_time = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')
-        return date_time
+    def filter_code(self, code, module_name):
+        """Decide whether events for a code object are excluded from the provenance. The decision only depends on the
+        code object and its module so backends may cache it or disable the event source entirely
+        :param code: Python code object
+        :param module_name: Name of the module the code object belongs to
+        :returns: True if the code object should not be recorded"""
+        func_name = code.co_name
+        if module_name is None:
+            module_name = ""
+
+        if self.only_main and module_name != "__main__":
+            return True
+
+        if self.slim:
+            if func_name.startswith(self.prefixes):
+                return True
+            if "._" in module_name:
+                return True
+
+        if "praetor" in module_name:
+            return True
+
+        # Ignore module-level frames
+        if func_name == "<module>":
+            return True
+
+        if self.bootstrap and module_name in ["importlib._bootstrap_external", "importlib._bootstrap"]:
+            return True
+
+        if self.block_list_pattern is not None and self.block_list_pattern.match(module_name):
+            return True
+
+        if self.block_list_func:
+            if func_name in self.block_list_func:
+                return True
+
+        varnames = code.co_varnames
+        if len(varnames) > 0:
+            if self.slim and varnames[0] in ["cls", "self"]:
+                return True
+
+        return False
+
+    def cache_filter(self, code, frame):
+        """Run the filters for a code object not seen before and store the decision in the filter cache
+        :param code: Python code object
+        :param frame: Python frame executing the code object
+        :returns: True if the code object should not be recorded"""
+        filtered = self.filter_code(code, frame.f_globals.get("__name__", None))
+        if len(self.filter_cache) >= FILTER_CACHE_MAX_SIZE:
+            self.filter_cache.clear()
+        self.filter_cache[code] = filtered
+        return filtered
+
+    def record_event(self, frame, event, arg, func_name, module_name):
+        """Record the metadata of a python call or return event which has passed the filters
+        :param frame: Python frame
+        :param event: call or return
+        :param arg: Return value of the frame for return events
+        :param func_name: Name of the function
+        :param module_name: Name of the module the function belongs to"""
+        if self.tasks is not None and frame.f_code.co_flags & COROUTINE_FLAGS:
+            self.record_coroutine_event(frame, event, arg, func_name, module_name)
+            return
+        if event == "call":
+            stack_id = self.open_activity(id(frame))
+        else:
+            stack_id = self.close_activity(id(frame))
+        self.record_frame(frame, event, arg, func_name, module_name, stack_id)
+
+    def record_coroutine_event(self, frame, event, arg, func_name, module_name):
+        """Record an event of a coroutine in asyncio mode. The activity of the coroutine is opened when it starts and
+        closed at its final return, suspensions are only counted and resuming it does not open another activity
+        :param frame: Python frame of the coroutine
+        :param event: call, resume, yield or return
+        :param arg: Return value of the frame for return events
+        :param func_name: Name of the function
+        :param module_name: Name of the module the function belongs to"""
+        tasks = self.tasks
+        if tasks.finished:
+            for coroutine in tasks.take_finished():
+                self.finish_coroutine(coroutine)
+        if event == "call":
+            coroutine = tasks.start(frame, str(next(self.activity_ids)))
+            self.enter_task(coroutine)
+            self.record_frame(frame, event, arg, func_name, module_name, coroutine.activity_id, coroutine)
+        elif event == "resume":
+            coroutine = tasks.resume(frame)
+            if coroutine is not None:
+                self.enter_task(coroutine)
+        elif event == "yield":
+            coroutine = tasks.suspend(frame)
+            if coroutine is not None:
+                self.leave_task(coroutine)
+        else:
+            coroutine = tasks.end(frame)
+            if coroutine is None:
+                # started before tracing, like any other return without a call
+                self.record_frame(frame, event, arg, func_name, module_name, str(next(self.activity_ids)))
+                return
+            self.record_frame(frame, event, arg, func_name, module_name, coroutine.activity_id, coroutine)
+            self.leave_task(coroutine)
+
+    def finish_coroutine(self, coroutine):
+        """Record the return of a coroutine left open when its task was done
+        :param coroutine: CoroutineActivity"""
+        frame = coroutine.frame
+        self.record_frame(frame, "return", None, frame.f_code.co_name, frame.f_globals.get("__name__", None),
+                          coroutine.activity_id, coroutine)
+        self.tasks.forget(coroutine)
+
+    def enter_task(self, coroutine):
+        """Swap in the last activity and statistics call stack of the task of a coroutine starting or resuming, when the
+        task starts running a step
+        :param coroutine: CoroutineActivity"""
+        state = coroutine.task
+        if state is None or not coroutine.top:
+            return
+        thread_state = self.thread_state()
+        state.outer_activity = thread_state.last_activity
+        if state.last_activity is None:
+            state.last_activity = {"id": None, "end": None, "start": None, "name": None}
+        thread_state.last_activity = state.last_activity
+        if self.statistics is not None:
+            state.outer_stack = self.statistics.switch_stack(state.stack)
+
+    def leave_task(self, coroutine):
+        """Give the thread its own last activity and statistics call stack back when the task of a coroutine suspending
+        or returning has finished its step
+        :param coroutine: CoroutineActivity"""
+        state = coroutine.task
+        if state is None or not coroutine.top:
+            return
+        self.thread_state().last_activity = state.outer_activity
+        if self.statistics is not None:
+            self.statistics.switch_stack(state.outer_stack)
+
+    def record_frame(self, frame, event, arg, func_name, module_name, stack_id, coroutine=None):
+        """Count, sample or capture the event of a frame
+        :param frame: Python frame
+        :param event: call or return
+        :param arg: Return value of the frame for return events
+        :param func_name: Name of the function
+        :param module_name: Name of the module the function belongs to
+        :param stack_id: Key of the activity
+        :param coroutine: CoroutineActivity of the event of a coroutine in asyncio mode"""
+        if self.statistics is not None:
+            self.count_event(event, stack_id, func_name, module_name)
+            return
+
+        if self.sampler is not None and self.sampled_out(event, stack_id, func_name, module_name):
+            return
+
+        code = frame.f_code
+        argcount = code.co_argcount
+        varnames = code.co_varnames
+
+        inputs = {
+            varnames[i]: frame.f_locals.get(varnames[i])
+            for i in range(argcount)
+        }
+
+        self.submit_event(event, func_name, module_name, stack_id, inputs, arg, coroutine)
+
+    def thread_state(self):
+        """State of the current thread, created at its first event
+        :returns: ThreadState"""
+        try:
+            return self.local.state
+        except AttributeError:
+            state = self.local.state = ThreadState()
+            return state
+
+    def open_activity(self, key):
+        """Start a new activity for a call, activities are numbered per session and kept on a call stack per thread
+        :param key: id of the frame, or of the C function, making the call
+        :returns: ID of the activity"""
+        activity_id = str(next(self.activity_ids))
+        try:
+            stack = self.local.state.stack
+        except AttributeError:
+            stack = self.thread_state().stack
+        stack.append((key, activity_id))
+        return activity_id
+
+    def close_activity(self, key):
+        """Find the activity of a return on the call stack of the thread. Calls left open above it, e.g. C calls which
+        raised, are discarded along with the inputs kept for them
+        :param key: id of the frame, or of the C function, returning
+        :returns: ID of the activity, or a new ID for returns of calls made before tracing started"""
+        try:
+            stack = self.local.state.stack
+        except AttributeError:
+            stack = self.thread_state().stack
+        for position in range(len(stack) - 1, -1, -1):
+            if stack[position][0] == key:
+                activity_id = stack[position][1]
+                for _, discarded_id in stack[position + 1:]:
+                    self.call_inputs.pop(discarded_id, None)
+                del stack[position:]
+                return activity_id
+        return str(next(self.activity_ids))
+
+    def count_event(self, event, stack_id, func_name, module_name):
+        """Add an event to the call statistics
+        :param event: call, return, c_call or c_return
+        :param stack_id: Key of the activity
+        :param func_name: Name of the function
+        :param module_name: Name of the module the function belongs to"""
+        if event in ("call", "c_call"):
+            self.statistics.call(stack_id, (module_name, func_name))
+        else:
+            self.statistics.returned(stack_id)
+
+    def sampled_out(self, event, stack_id, func_name, module_name):
+        """Apply the sampling mode to an event
+        :param event: call, return, c_call or c_return
+        :param stack_id: Key of the activity
+        :param func_name: Name of the function
+        :param module_name: Name of the module the function belongs to
+        :returns: True if the event is left out of the provenance"""
+        if event in ("call", "c_call"):
+            key = (module_name, func_name)
+            if self.sampler.keep(key):
+                return False
+            self.sampler.skip(stack_id, key)
+            return True
+        return self.sampler.returned(stack_id)
+
+    def submit_event(self, event, func_name, module_name, stack_id, inputs, output, coroutine=None):
+        """Time stamp a captured event and hand it over for processing, either straight away or on the background
+        writer thread
+        :param event: call, return, c_call or c_return
+        :param func_name: Name of the function
+        :param module_name: Name of the module the function belongs to
+        :param stack_id: Key of the activity
+        :param inputs: Dictionary of argument names and values
+        :param output: Return value for return events
+        :param coroutine: CoroutineActivity of the event of a coroutine in asyncio mode"""
+        if self.process_monitor:
+            process_stats = self.monitor.high_freq_snapshot(func_name)
+        else:
+            process_stats = None
+
+        try:
+            last_activity = self.local.state.last_activity
+        except AttributeError:
+            last_activity = self.thread_state().last_activity
+
+        input_captures, changed_inputs, output_capture = self.capture_values(event, stack_id, inputs, output)
+
+        raw_event = (event, func_name, module_name, stack_id, inputs, output, time.perf_counter_ns(), process_stats,
+                     threading.get_ident(), last_activity, coroutine, input_captures, changed_inputs, output_capture)
+        if self.background_writer is not None:
+            self.background_writer.submit(raw_event)
+        else:
+            self.process_event(raw_event)
+
+    def capture_values(self, event, stack_id, inputs, output):
+        """Capture the mutable values of an event as they are when it happens, they may have changed by the time the
+        event is processed on the background writer. Immutable values are hashed when the event is processed
+        :param event: call, return, c_call or c_return
+        :param stack_id: Key of the activity
+        :param inputs: Dictionary of argument names and values
+        :param output: Return value for return events
+        :return: Captures of the mutable inputs by name, None for a return whose call was recorded; (name, value,
+        capture, capture at the call) of the mutable inputs of such a return, None otherwise; capture of a mutable
+        output"""
+        if event in ("call", "c_call"):
+            input_captures = self.capture_mutable(inputs)
+            self.call_inputs[stack_id] = [(key, inputs[key], capture) for key, capture in input_captures.items()]
+            return input_captures, None, None
+
+        output_capture = None if type(output) in IMMUTABLE_TYPES else self.capture(output)
+        captured = self.call_inputs.pop(stack_id, None)
+        if captured is None:
+            # the call was not recorded, so the inputs are only known from the return
+            return self.capture_mutable(inputs), None, output_capture
+        # the objects passed to the call, the argument names may have been rebound since
+        changed_inputs = [(key, value, self.capture(value), call_capture) for key, value, call_capture in captured]
+        return None, changed_inputs, output_capture
+
+    def capture_mutable(self, values):
+        """Capture the values which are not of an immutable type
+        :param values: Dictionary of names and values
+        :return: Dictionary of names and captures"""
+        captures = {}
+        for key, value in values.items():
+            if type(value) not in IMMUTABLE_TYPES:
+                captures[key] = self.capture(value)
+        return captures
+
+    def capture(self, value):
+        """Capture a mutable value, as a snapshot hashed later on the background writer if one is cheap to take, see
+        hashing.snapshot, or otherwise by hashing it straight away
+        :param value: python object
+        :return: Snapshot, or entity id"""
+        if self.background_writer is not None:
+            copy = snapshot(value)
+            if copy is not None:
+                return copy
+        return self.prefix + self.persistent_id(value)
+
+    def captured_id(self, capture):
+        """Entity id of a value captured by capture_values
+        :param capture: Snapshot or entity id
+        :return: Entity id"""
+        if type(capture) is str:
+            return capture
+        return self.prefix + self.persistent_id(capture)
+
+    def captured_binding(self, value, capture):
+        """Entity binding of a value of an event, rendered from its snapshot if one was taken
+        :param value: python object
+        :param capture: Snapshot or entity id taken by capture_values, None for values of immutable types
+        :return: json binding"""
+        if capture is None:
+            return self.entity_binding(value)
+        if type(capture) is str:
+            return self.entity_binding(value, capture)
+        return self.entity_binding(capture, self.captured_id(capture))
+
+    def process_event(self, raw_event):
+        """Format a captured event into json provenance and write it to the trace
+        :param raw_event: Tuple of event, function name, module name, stack id, inputs, output, monotonic time stamp in
+        nanoseconds, process stats, id of the traced thread, the last activity of that thread, the coroutine activity
+        in asyncio mode, and the captures of the mutable inputs, of the inputs of a return and of the output taken by
+        capture_values"""
+        state = self.thread_state()
+        (event, state.name, state.module_name, state.stack_id, state.inputs, output, time_stamp, process_stats,
+         state.thread_id, state.last_activity, state.coroutine, state.input_captures, state.changed_inputs,
+         state.output_capture) = raw_event
+
+        if process_stats is not None:
+            state.process_count = process_stats["process_count"]
+            state.total_memory = process_stats["total_rss_mb"]
+            state.files_opened = process_stats["newly_opened_files"]
+
+        if event in ("call", "c_call"):
+            state.start_time = time_stamp
+            self.prov_call_in(state)
+            self.dump_json(state, mode="call")
+
+        else:
+            state.output = output
+            state.end_time = time_stamp
+            self.prov_call_out(state)
+            self.dump_json(state, mode="return")
 
     @staticmethod
     def remove_quotes_from_string(in_string):
         """Remove quotes from a string
         :param in_string: input string
         :returns in_string without quotes (out_string)"""
-        out_string = [x for x in in_string if x not in ['"', "'"]]
-        out_string = ''.join(out_string)
-        return out_string
+        return remove_quotes(in_string)
 
     @staticmethod
-    def generate_persistent_id(obj):
+    def generate_persistent_id(obj, sample_above=None, hash_factory=hashlib.sha256):
         """Generate persistent id for python objects so that they are consistent across runs
         :param obj: python object
+        :param sample_above: Size in bytes above which buffers are fingerprinted from samples of their memory
+        :param hash_factory: hashlib style constructor of the hash to use
         :return: persistent id """
         try:
             # Try to serialize to JSON, for JSON serializable objects
             serialized = json.dumps(obj, sort_keys=True).encode('utf-8')
         except (TypeError, OverflowError):
+            # Buffers (numpy arrays, bytes, ...) are hashed straight from memory without a copy
+            persistent_id = buffer_digest(obj, sample_above, hash_factory)
+            if persistent_id is not None:
+                return persistent_id
             # Fallback: use pickle for other Python objects
             try:
                 serialized = pickle.dumps(obj)
-            except (pickle.PicklingError, TypeError, AttributeError): # just except all?
+            except Exception:
+                # objects refusing to be pickled, e.g. locks of multiprocessing, raise all kinds of errors
                 return str(id(obj))
-        # Generate SHA-256 hash of serialized representation
-        persistent_id = hashlib.sha256(serialized).hexdigest()
+        # Generate hash of serialized representation
+        persistent_id = hash_factory(serialized).hexdigest()
         return persistent_id
 
+    def is_address_id(self, entity_id):
+        """Check whether an entity id is the memory address generate_persistent_id falls back to for objects which
+        can't be serialised. The address is reused by objects created after the object is freed, so such entities are
+        only deduplicated while the same object is alive and their rendered value isn't remembered
+        :param entity_id: ID of the entity
+        :return: True for an id from the memory address"""
+        return entity_id[len(self.prefix):].isdigit()
+
+    def hash_object(self, obj):
+        """Hash a python object with the settings of this tracer, bypassing the hash cache
+        :param obj: python object
+        :return: persistent id """
+        return self.generate_persistent_id(obj, self.sample_hash_above, self.hash_factory)
+
+    def persistent_id(self, obj):
+        """Persistent id of a python object, served from the hash cache when the object is unchanged
+        :param obj: python object
+        :return: persistent id """
+        return self.hash_cache.persistent_id(obj)
+
     def gen_identifier(self, variable, naming_template="entity"):
         """
         General utility function to create prov ids for python objects
@@ -388,12 +967,13 @@ class CallTracer:
         :param naming_template: Name related to the object in question to include in the id
         :return: ID for target object
         """
+        persistent_id = self.persistent_id(variable)
         try:
-            prov_id = self.prov_id_cache[self.generate_persistent_id(variable)] # change back to id if too slow
+            prov_id = self.prov_id_cache[persistent_id]
         except KeyError:
             self.prov_id_counter[naming_template] += 1
             prov_id = '{}_{}_{}'.format(naming_template, self.session_id, self.prov_id_counter[naming_template])
-            self.prov_id_cache[self.generate_persistent_id(variable)] = prov_id # change back to id if too slow
+            self.prov_id_cache[persistent_id] = prov_id
 
         return prov_id
 
@@ -403,6 +983,12 @@ class CallTracer:
         :param value_id: ID of the input python object
         :return: Type and truncated string representation of the input python object
         """
+        memoize = not self.is_address_id(value_id)
+        if memoize:
+            rendered = self.render_cache.get(value_id)
+            if rendered is not None:
+                return rendered
+
         # mod_list = self.praetor_settings_dict["modules"] # need to get from some place, probably enviro var
         if callable(value) or inspect.ismodule(value) or inspect.isclass(value):#  or type(value).__module__ in mod_list:
             name = getattr(value, '__name__', None)
@@ -410,15 +996,15 @@ class CallTracer:
             prov_type = 'string'
         else:
             out_value = custom_repr.repr(value) # truncating the value, need to not do that
-            try:
-                out_value_full = json.dumps(value, ensure_ascii=False)
-            except (TypeError, OverflowError):
-                out_value_full = out_value
-            out_value = self.remove_quotes_from_string(out_value)
-            # print(out_value, out_value_full)
             if self.store_large_values:
-                if len(out_value_full) > 1024:
+                # only encode as far as needed to know whether the value is large
+                try:
+                    out_value_full = encode_if_larger(value, self.large_value_size)
+                except (TypeError, OverflowError, ValueError):
+                    out_value_full = out_value if len(out_value) > self.large_value_size else None
+                if out_value_full is not None:
                     self.large_object_handling(out_value_full, value_id)
+            out_value = self.remove_quotes_from_string(out_value)
             try:
                 out_type = type(value).__name__
                 if out_type in self.dtypes.keys():
@@ -427,6 +1013,8 @@ class CallTracer:
                     prov_type = 'string'
             except:
                 prov_type = 'string'
+        if memoize:
+            self.render_cache.store(value_id, (out_value, prov_type))
         return out_value, prov_type
 
     def large_object_handling(self, value, object_id):
@@ -447,11 +1035,12 @@ class CallTracer:
         """Trace the python stack to determine if a function was called by another"""
         stack = inspect.stack()
         caller = 'main'
+        last_name = self.thread_state().last_activity['name']
         for frame in stack:
             if frame.function == "<module>":
                 break
-            elif frame.function == self.last_activity['name']:
-                caller = self.last_activity['name']
+            elif frame.function == last_name:
+                caller = last_name
                 break
         return caller
 
@@ -472,107 +1061,253 @@ class CallTracer:
         self.metadata.clear()
         self.monitor.clear()
 
-    def prov_call_in(self):
-        """Format call metadata into json format provenance"""
-        self.bindings['{}'.format(self.stack_id)] = {}
-        self.bindings['{}'.format(self.stack_id)]['messageStartTime'] = {"@type": "xsd:dateTime", "@value": self.start_time}
-        self.bindings['{}'.format(self.stack_id)]['moduleName'] = {"@type": "xsd:string", "@value": self.module_name}
-        self.bindings['{}'.format(self.stack_id)]['activityName'] = {"@type": "xsd:string", "@value": self.name}
-        self.bindings['{}'.format(self.stack_id)]['message'] = {"@id": "urn_uuid:{}_{}".format(self.session_id, self.stack_id)}
+    def prov_call_in(self, state):
+        """Format call metadata into json format provenance
+        :param state: ThreadState holding the call"""
+        bindings = self.bindings[state.stack_id] = {}
+        bindings['messageStartTime'] = {"@type": "xsd:dateTime", "@value": state.start_time}
+        bindings['moduleName'] = self.name_binding(state.module_name)
+        bindings['activityName'] = self.name_binding(state.name)
+        bindings['message'] = self.message_binding(state.stack_id)
+        bindings['thread'] = {"@type": "xsd:long", "@value": state.thread_id}
+        coroutine = state.coroutine
+        if coroutine is not None:
+            if coroutine.task is not None:
+                bindings['task'] = self.name_binding(coroutine.task.name)
+            if coroutine.started_by is not None:
+                bindings['startedBy'] = self.message_binding(coroutine.started_by.activity_id)
         if self.process_monitor:
-            self.bindings['{}'.format(self.stack_id)]['memory_call'] = {"@type": "xsd:float", "@value": self.total_memory}
+            bindings['memory_call'] = {"@type": "xsd:float", "@value": state.total_memory}
 
         # add gate to see if it is on the stack
         # stack_function = self.track_call()
-        if self.last_activity['id']:
-            self.bindings['{}'.format(self.stack_id)]['message2'] = {"@id": "urn_uuid:{}_{}".format(self.session_id, self.last_activity['id'])}
-            self.bindings['{}'.format(self.stack_id)]['message2StartTime'] = {"@type": "xsd:dateTime", "@value":self.last_activity['end']}
-            self.bindings['{}'.format(self.stack_id)]['message2EndTime'] = {"@type": "xsd:dateTime", "@value": self.last_activity['start']}
+        last_activity = state.last_activity
+        if last_activity['id']:
+            bindings['message2'] = self.message_binding(last_activity['id'])
+            bindings['message2StartTime'] = {"@type": "xsd:dateTime", "@value": last_activity['end']}
+            bindings['message2EndTime'] = {"@type": "xsd:dateTime", "@value": last_activity['start']}
 
 
         counter = 0
-        for key, value in self.inputs.items():
-            in_id = self.generate_persistent_id(value)
-            in_value, in_type = self.find_type(value, self.prefix + in_id)
-            self.bindings['{}'.format(self.stack_id)]['input_{}'.format(counter)] = {'@id' : self.prefix + in_id, '@value': in_value,
-                                                                     '@type': "xsd:{}".format(in_type), '@role': key}
+        for key, value in state.inputs.items():
+            in_binding = self.captured_binding(value, state.input_captures.get(key))
+            in_binding['@role'] = key
+            bindings['input_{}'.format(counter)] = in_binding
             counter += 1
 
-        self.last_activity['id'] = self.stack_id
-        self.last_activity['name'] = self.name
-        self.last_activity['end'] = self.start_time
-        self.last_activity['start'] = self.start_time
-
-
-    def prov_call_out(self):
-        """Format return metadata into json format provenance"""
-        self.bindings['{}'.format(self.stack_id)] = {}
-        self.bindings['{}'.format(self.stack_id)]['messageEndTime'] = {"@type": "xsd:dateTime", "@value": self.end_time}
-        self.bindings['{}'.format(self.stack_id)]['moduleName'] = {"@type": "xsd:string",
-                                                                   "@value": self.module_name}
-        self.bindings['{}'.format(self.stack_id)]['activityName'] = {"@type": "xsd:string", "@value": self.name}
-        self.bindings['{}'.format(self.stack_id)]['message'] = {
-            "@id": "urn_uuid:{}_{}".format(self.session_id, self.stack_id)}
+        last_activity['id'] = state.stack_id
+        last_activity['name'] = state.name
+        last_activity['end'] = state.start_time
+        last_activity['start'] = state.start_time
+
+
+    def prov_call_out(self, state):
+        """Format return metadata into json format provenance
+        :param state: ThreadState holding the return"""
+        bindings = self.bindings[state.stack_id] = {}
+        bindings['messageEndTime'] = {"@type": "xsd:dateTime", "@value": state.end_time}
+        bindings['moduleName'] = self.name_binding(state.module_name)
+        bindings['activityName'] = self.name_binding(state.name)
+        bindings['message'] = self.message_binding(state.stack_id)
+        bindings['thread'] = {"@type": "xsd:long", "@value": state.thread_id}
+        coroutine = state.coroutine
+        if coroutine is not None:
+            if coroutine.task is not None:
+                bindings['task'] = self.name_binding(coroutine.task.name)
+            bindings['yields'] = {"@type": "xsd:long", "@value": coroutine.yields}
         if self.process_monitor:
-            self.bindings['{}'.format(self.stack_id)]['memory_return'] = {"@type": "xsd:float", "@value": self.total_memory}
-            if len(self.files_opened) > 0:
-                self.bindings['{}'.format(self.stack_id)]['file_access'] = {"@type": "xsd:string", "@value": self.files_opened}
-
-        counter = 0
-        for key, value in self.inputs.items():
-            in_id = self.generate_persistent_id(value)
-            in_value, in_type = self.find_type(value, self.prefix + in_id)
-            self.bindings['{}'.format(self.stack_id)]['input_{}'.format(counter)] = {'@id': self.prefix + in_id,
-                                                                                     '@value': in_value,
-                                                                                     '@type': "xsd:{}".format(
-                                                                                         in_type), '@role': key}
-            counter += 1
+            bindings['memory_return'] = {"@type": "xsd:float", "@value": state.total_memory}
+            if len(state.files_opened) > 0:
+                bindings['file_access'] = {"@type": "xsd:string", "@value": state.files_opened}
+
+        if state.changed_inputs is None:
+            # the call was not recorded, so the inputs are only known from the return
+            counter = 0
+            for key, value in state.inputs.items():
+                in_binding = self.captured_binding(value, state.input_captures.get(key))
+                in_binding['@role'] = key
+                bindings['input_{}'.format(counter)] = in_binding
+                counter += 1
+        else:
+            counter = 0
+            for key, value, capture, call_capture in state.changed_inputs:
+                in_id = self.captured_id(capture)
+                call_id = self.captured_id(call_capture)
+                if in_id == call_id:
+                    continue
+                in_binding = self.entity_binding(value if type(capture) is str else capture, in_id)
+                in_binding['@role'] = key
+                in_binding['@derivedFrom'] = call_id
+                bindings['mutated_{}'.format(counter)] = in_binding
+                counter += 1
 
-        output_list = [self.output]
+        output_list = [state.output]
         if output_list:
             for i, output_item in enumerate(output_list):
-                out_id = self.generate_persistent_id(output_item)
-                out_value, out_type = self.find_type(output_item, self.prefix + out_id)
-                self.bindings['{}'.format(self.stack_id)]['output_{}'.format(i)] = {
-                    '@id': self.prefix + out_id, '@value': out_value,
-                    '@type': "xsd:{}".format(out_type)}
-
-        if self.last_activity['id']:
-            self.bindings['{}'.format(self.stack_id)]['message2'] = {"@id": "urn_uuid:{}_{}".format(self.session_id, self.last_activity['id'])}
-            self.bindings['{}'.format(self.stack_id)]['message2StartTime'] = {"@type": "xsd:dateTime", "@value":self.last_activity['end']}
-            self.bindings['{}'.format(self.stack_id)]['message2EndTime'] = {"@type": "xsd:dateTime", "@value": self.last_activity['start']}
-
-
-        self.last_activity['id'] = self.stack_id
-        self.last_activity['name'] = self.name
-        try:
-            self.last_activity['end'] = self.end_time
-        except AttributeError:
-            self.last_activity['end'] = "-"
+                bindings['output_{}'.format(i)] = self.captured_binding(output_item, state.output_capture)
+
+        last_activity = state.last_activity
+        if last_activity['id']:
+            bindings['message2'] = self.message_binding(last_activity['id'])
+            bindings['message2StartTime'] = {"@type": "xsd:dateTime", "@value": last_activity['end']}
+            bindings['message2EndTime'] = {"@type": "xsd:dateTime", "@value": last_activity['start']}
+
+
+        last_activity['id'] = state.stack_id
+        last_activity['name'] = state.name
+        last_activity['end'] = state.end_time
+        last_activity['start'] = state.start_time
+
+    def entity_binding(self, value, entity_id=None):
+        """Reference to the entity of a python object for the json provenance of an activity. With deduplication the
+        value is written as a separate entity record the first time the entity is seen and the reference only holds
+        the ID, otherwise the value is included in every reference
+        :param value: python object
+        :param entity_id: ID of the entity if it is already known
+        :return: json binding"""
+        if entity_id is None:
+            entity_id = self.prefix + self.persistent_id(value)
+        if self.seen_entities is None:
+            entity_value, entity_type = self.find_type(value, entity_id)
+            return {'@id': entity_id, '@value': entity_value, '@type': "xsd:{}".format(entity_type)}
+
+        if self.is_address_id(entity_id):
+            seen = self.seen_at_address(entity_id, value)
+        else:
+            seen = entity_id in self.seen_entities
+            if not seen:
+                self.seen_entities.add(entity_id)
+        if not seen:
+            entity_value, entity_type = self.find_type(value, entity_id)
+            entity = self.entity_reference(entity_id)
+            entity['@value'] = entity_value
+            entity['@type'] = "xsd:{}".format(entity_type)
+            new_json = {'@id': entity_id, '@mode': 'entity', '@data': {'entity': entity}}
+            self.write_record(new_json)
+        return self.entity_reference(entity_id)
+
+    def seen_at_address(self, entity_id, value):
+        """Check whether the entity of an object identified by its memory address has been written, i.e. whether the
+        object is the one last seen at that address. Objects without weak references are never taken as seen
+        :param entity_id: ID of the entity, see is_address_id
+        :param value: python object
+        :return: True if the entity of the object has been written"""
+        reference = self.address_entities.get(entity_id)
+        if reference is not None and reference() is value:
+            return True
         try:
-            self.last_activity['start'] = self.start_time
-        except AttributeError:
-            self.last_activity['start'] = "-"
-
-    def dump_json(self, mode):
+            self.address_entities[entity_id] = weakref.ref(value, functools.partial(self.forget_address, entity_id))
+        except TypeError:
+            pass
+        return False
+
+    def forget_address(self, entity_id, reference):
+        """Weak reference callback dropping the entry of an object seen at a memory address once it is freed
+        :param entity_id: ID of the entity
+        :param reference: Weak reference to the freed object"""
+        if self.address_entities.get(entity_id) is reference:
+            self.address_entities.pop(entity_id, None)
+
+    def entity_reference(self, entity_id):
+        """json binding referring to an entity
+        :param entity_id: ID of the entity
+        :return: json binding"""
+        if self.symbol_table is not None:
+            return self.symbol_table.entity(entity_id)
+        return {'@id': entity_id}
+
+    def name_binding(self, value):
+        """json binding of a module or function name
+        :param value: Name
+        :return: json binding"""
+        if self.symbol_table is not None:
+            return self.symbol_table.name(value)
+        return {"@type": "xsd:string", "@value": value}
+
+    def message_binding(self, stack_id):
+        """json binding of the message id of an activity
+        :param stack_id: Key of the activity
+        :return: json binding"""
+        if self.symbol_table is not None:
+            return self.symbol_table.message(stack_id)
+        return {"@id": "urn_uuid:{}_{}".format(self.session_id, stack_id)}
+
+    def dump_json(self, state, mode):
         """dump json provenance to file
+        :param state: ThreadState holding the event
         :param mode: call or return"""
-        json_metadata = self.bindings.pop(self.stack_id, None)
+        json_metadata = self.bindings.pop(state.stack_id, None)
         # print(json_metadata)
-        new_json = {'@id': '{}'.format(self.stack_id), '@mode': mode, '@data': json_metadata}
-        json_str = json.dumps(new_json)
-        self.out_handle.write(json_str + '\n')
-        self.out_handle.flush()
+        new_json = {'@id': '{}'.format(state.stack_id), '@mode': mode, '@data': json_metadata}
+        self.write_record(new_json)
+
+    def write_record(self, record):
+        """Write a record to the raw trace in the trace format of the tracer
+        :param record: Dictionary with @id, @mode and @data"""
+        if self.event_log is not None:
+            self.writer.write(self.event_log.encode(record))
+        else:
+            self.writer.write(json.dumps(record) + '\n')
 
 
+    def dump_summaries(self):
+        """dump a summary activity per function, for every function in statistics mode and for the functions which had
+        calls left out when sampling"""
+        if self.statistics is not None:
+            summaries = self.statistics.summaries()
+            summary_of = "allCalls"
+        else:
+            summaries = {key: (summary, {}) for key, summary in self.sampler.omitted_summaries().items()}
+            summary_of = "omittedCalls"
+
+        summary_ids = {key: "summary_{}".format(counter) for counter, key in enumerate(summaries)}
+        for key, (summary, callers) in summaries.items():
+            caller_links = [("urn_uuid:{}_{}".format(self.session_id, summary_ids[caller]), caller_summary)
+                            for caller, caller_summary in callers.items() if caller in summary_ids]
+            module_name, func_name = key
+            bindings = summary_bindings("urn_uuid:{}_{}".format(self.session_id, summary_ids[key]), module_name,
+                                        func_name, summary, summary_of, caller_links)
+            new_json = {'@id': summary_ids[key], '@mode': 'summary', '@data': bindings}
+            self.write_record(new_json)
+
     def close(self):
         """Close json dump document at end of provenance generation"""
         if self.close_file_var and self.out_handle:
-            self.stop_monitoring()
             self.record_prov = False
-            with open(self.out_directory + "stats.txt", "w") as f:
-                f.write(str(self.monitor.get_stats()))
-            create_full_json(self.agent_json, self.out_handle.name)
-            self.out_handle.close()
+            if self.backend is not None:
+                self.backend.stop()
+            if self.tasks is not None:
+                # coroutines of the last tasks done, which no coroutine event came after
+                for coroutine in self.tasks.take_finished():
+                    self.finish_coroutine(coroutine)
+            if self.background_writer is not None:
+                self.background_writer.stop()
+                if self.background_writer.dropped:
+                    print("praetor: {} events dropped by the background writer".format(self.background_writer.dropped))
+                if self.background_writer.errors:
+                    print("praetor: {} events failed to be recorded by the background writer, the first with:\n{}"
+                          .format(self.background_writer.errors, self.background_writer.first_error))
+            if self.statistics is not None or self.sampler is not None:
+                self.dump_summaries()
+            if self.process_monitor:
+                self.stop_monitoring()
+                if self.parent_agent_id is None:
+                    with open(self.out_directory + "stats.txt", "w") as f:
+                        f.write(str(self.monitor.get_stats()))
+            self.writer.flush()
+            if self.parent_agent_id is not None:
+                # shards of child processes are converted with the trace of the script which started the session
+                pass
+            elif self.rolling_conversion is not None:
+                if not finish_rolling_conversion(self.rolling_conversion):
+                    print("praetor: rolling conversion failed, converting the whole trace")
+                    create_full_json(self.agent_json, self.out_handle.name, rdf_format=self.rdf_format)
+            elif self.ttl_workers > 1:
+                create_full_json_subprocess(self.agent_json, self.out_handle.name, self.ttl_workers, self.rdf_format)
+            else:
+                create_full_json(self.agent_json, self.out_handle.name, rdf_format=self.rdf_format)
+            self.writer.close()
+            # inputs of calls which had not returned when tracing stopped
+            self.call_inputs.clear()
             self.close_file_var = False
 
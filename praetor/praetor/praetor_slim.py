@@ -1,23 +1,39 @@
 import argparse
 import atexit
 
-from praetor.praetor import CallTracer
-import sys
+from praetor.praetor import RDF_FORMATS, TRACE_FORMATS, CallTracer
+from praetor.backends import install_tracer
+from praetor.hashing import HASH_ALGORITHM_NAMES
 import os
 
-def get_output_directory():
+def get_praetor_settings():
     parser = argparse.ArgumentParser(description='Custom praetor settings.')
     parser.add_argument('--praetor-output',required=False, help='Directory for praetor output')
+    parser.add_argument('--praetor-hash', required=False, default='sha256', choices=HASH_ALGORITHM_NAMES,
+                        help='Hash algorithm for entity ids')
+    parser.add_argument('--praetor-format', required=False, default='json', choices=TRACE_FORMATS,
+                        help='Format of the raw trace, json lines or the compact binary event log')
+    parser.add_argument('--praetor-workers', required=False, default=1, type=int,
+                        help='Number of processes converting the provenance to turtle at the end of the run')
+    parser.add_argument('--praetor-rdf-format', required=False, default='turtle', choices=list(RDF_FORMATS),
+                        help='Serialisation of the final provenance, turtle or the line oriented ntriples and nquads')
+    parser.add_argument('--praetor-rolling', required=False, default=None, type=float, metavar='SECONDS',
+                        help='Convert the provenance in segments every SECONDS while the script runs')
+    parser.add_argument('--praetor-asyncio', required=False, action='store_true',
+                        help='Record each coroutine as one activity across its awaits, following asyncio tasks')
     args = parser.parse_args()
 
-    output_directory = args.praetor_output
-    if output_directory is None:
-        output_directory = os.getcwd()
-    return output_directory
+    if args.praetor_output is None:
+        args.praetor_output = os.getcwd()
+    return args
 
 
-out_dir = get_output_directory()
-tracer = CallTracer(output_directory=out_dir, slim=True, process_monitor=True)
-sys.setprofile(tracer)
+settings = get_praetor_settings()
+tracer = CallTracer(output_directory=settings.praetor_output, slim=True, process_monitor=True,
+                    hash_algorithm=settings.praetor_hash, trace_format=settings.praetor_format,
+                    ttl_workers=settings.praetor_workers,
+                    rdf_format=settings.praetor_rdf_format, rolling_interval=settings.praetor_rolling,
+                    asyncio_mode=settings.praetor_asyncio)
+install_tracer(tracer)
 
 atexit.register(tracer.close)
\ No newline at end of file
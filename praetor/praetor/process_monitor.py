@@ -5,15 +5,43 @@ import threading
 
 
 class DynamicProcessMonitor:
-    def __init__(self, base_interval=1.0):
+    """Memory, open files and child processes of the traced process. On Linux the usage of a process is read from
+    /proc/<pid>/statm and /proc/<pid>/fd and its children from the children lists of its threads, elsewhere through
+    psutil Process handles which are kept between snapshots"""
+
+    def __init__(self, base_interval=1.0, snapshot_interval=0.0):
+        """
+        :param base_interval: Time in seconds between the snapshots of the continuous monitoring
+        :param snapshot_interval: Time in seconds within which the last high frequency snapshot is reused rather than
+        a new one taken, 0 takes a snapshot for every event
+        """
         self.parent_pid = os.getpid()
         self.base_interval = base_interval
+        self.snapshot_interval = snapshot_interval
         self.running = False
         self.monitor_thread = None
         self.stats = []
         self.file_history = set()
         self._lock = threading.Lock()
 
+        self.process = psutil.Process(self.parent_pid)
+        self.handles = {}
+        self.use_proc = os.path.isfile("/proc/self/statm")
+        self.proc_children = self.use_proc and os.path.isfile("/proc/{0}/task/{0}/children".format(self.parent_pid))
+        if self.use_proc:
+            self.page_mb = os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+        self.regular_files = {}
+        # descriptors of the traced process, a snapshot is only reused while they stay the same
+        if self.use_proc:
+            self.fd_directory = "/proc/self/fd"
+        elif os.path.isdir("/dev/fd"):
+            self.fd_directory = "/dev/fd"
+        else:
+            self.fd_directory = None
+        self.last_snapshot = None
+        self.last_fds = None
+        self.reused = None
+
     def start(self):
         """Start continuous base monitoring"""
         if self.running:
@@ -30,11 +58,32 @@ class DynamicProcessMonitor:
         self.monitor_thread.start()
 
     def high_freq_snapshot(self, function_name):
-        """Take IMMEDIATE high-frequency snapshot during monitoring"""
+        """Take IMMEDIATE high-frequency snapshot during monitoring. Within snapshot_interval of the last one, and as
+        long as the traced process has the same file descriptors, that snapshot is returned again without its newly
+        opened files"""
+        reused = self.reused
+        if reused is not None and time.monotonic() - self.last_snapshot < self.snapshot_interval \
+                and self.open_fds() == self.last_fds:
+            return reused
         with self._lock:
-            return self._snapshot('high_freq', function_name)
+            snapshot = self._snapshot('high_freq', function_name)
+            if self.snapshot_interval > 0:
+                self.last_snapshot = time.monotonic()
+                self.last_fds = self.open_fds()
+                self.reused = dict(snapshot, newly_opened_files=[])
+        return snapshot
+
+    def open_fds(self):
+        """File descriptors of the traced process, which is much cheaper than finding the files they refer to
+        :return: List of descriptor numbers, None where they cannot be listed"""
+        if self.fd_directory is None:
+            return None
+        try:
+            return os.listdir(self.fd_directory)
+        except OSError:
+            return None
 
-    def _snapshot(self, snapshot_type, function_name):
+    def _snapshot(self, snapshot_type, function_name=None):
         """Internal snapshot method"""
         snapshot = {
             'timestamp': time.time(),
@@ -46,33 +95,37 @@ class DynamicProcessMonitor:
 
         # Parent process
         try:
-            parent_proc = psutil.Process(self.parent_pid)
-            open_files_list = parent_proc.open_files()
+            rss_mb, open_files_list = self.usage(self.parent_pid)
 
             snapshot['processes'][self.parent_pid] = {
-                'rss_mb': parent_proc.memory_info().rss / 1024 / 1024,
+                'rss_mb': rss_mb,
                 'open_files_count': len(open_files_list)
             }
 
             # Only track NEWLY opened files
-            current_files = {f.path for f in open_files_list}
+            current_files = set(open_files_list)
             newly_opened_files = sorted(current_files - self.file_history)
             if snapshot_type == 'high_freq':
                 self.file_history.update(current_files)
 
-        except psutil.NoSuchProcess:
+        except (psutil.NoSuchProcess, OSError):
             pass
 
         # Child processes (track new files too)
-        try:
-            for child in psutil.Process().children(recursive=True):
-                child_open_files = child.open_files()
-                snapshot['processes'][child.pid] = {
-                    'rss_mb': child.memory_info().rss / 1024 / 1024,
-                    'open_files_count': len(child_open_files)
-                }
-        except psutil.NoSuchProcess:
-            pass
+        child_pids = self.child_pids()
+        for child_pid in child_pids:
+            try:
+                rss_mb, child_open_files = self.usage(child_pid)
+            except (psutil.NoSuchProcess, OSError):
+                # exited since it was listed
+                continue
+            snapshot['processes'][child_pid] = {
+                'rss_mb': rss_mb,
+                'open_files_count': len(child_open_files)
+            }
+        for pid in list(self.handles):
+            if pid not in child_pids:
+                del self.handles[pid]
 
         # NEWLY opened files list (across all processes)
         snapshot['newly_opened_files'] = newly_opened_files
@@ -83,6 +136,81 @@ class DynamicProcessMonitor:
         self.stats.append(snapshot)
         return snapshot
 
+    def usage(self, pid):
+        """Resident memory and open regular files of a process
+        :param pid: Process id
+        :return: Resident set size in MB, list of paths"""
+        if self.use_proc:
+            return self.proc_usage(pid)
+        if pid == self.parent_pid:
+            handle = self.process
+        else:
+            handle = self.handles.get(pid)
+            if handle is None:
+                handle = self.handles[pid] = psutil.Process(pid)
+        return handle.memory_info().rss / 1024 / 1024, [f.path for f in handle.open_files()]
+
+    def proc_usage(self, pid):
+        """Resident memory and open regular files of a process read from /proc, the same files psutil reports but
+        without reading the position and mode of every file
+        :param pid: Process id
+        :return: Resident set size in MB, list of paths"""
+        with open("/proc/{}/statm".format(pid), "rb") as f:
+            rss_mb = int(f.read().split()[1]) * self.page_mb
+        fd_directory = "/proc/{}/fd/".format(pid)
+        files = []
+        for fd in os.listdir(fd_directory):
+            try:
+                path = os.readlink(fd_directory + fd)
+            except OSError:
+                # closed since the listing
+                continue
+            if path.startswith("/") and self.is_regular_file(path):
+                files.append(path)
+        return rss_mb, files
+
+    def is_regular_file(self, path):
+        """Whether the target of a file descriptor is a regular file, remembered per path so files kept open are only
+        checked once"""
+        regular = self.regular_files.get(path)
+        if regular is None:
+            regular = self.regular_files[path] = os.path.isfile(path)
+        return regular
+
+    def child_pids(self):
+        """Process ids of all descendants of the traced process
+        :return: List of process ids"""
+        if self.proc_children:
+            return self.proc_child_pids(self.parent_pid)
+        try:
+            return [child.pid for child in self.process.children(recursive=True)]
+        except psutil.NoSuchProcess:
+            return []
+
+    def proc_child_pids(self, pid):
+        """Descendants of a process from the children lists of its threads in /proc, rather than from the parent of
+        every process on the system
+        :param pid: Process id
+        :return: List of process ids"""
+        pids = []
+        task_directory = "/proc/{}/task/".format(pid)
+        try:
+            threads = os.listdir(task_directory)
+        except OSError:
+            # exited since it was listed
+            return pids
+        for thread in threads:
+            try:
+                with open(task_directory + thread + "/children", "rb") as f:
+                    children = f.read().split()
+            except OSError:
+                continue
+            for child in children:
+                child = int(child)
+                pids.append(child)
+                pids.extend(self.proc_child_pids(child))
+        return pids
+
     def stop(self):
         """Stop continuous monitoring"""
         self.running = False
@@ -1,5 +1,6 @@
 from collections import Counter
 from datetime import datetime
+from itertools import islice
 import logging
 import os
 import requests
@@ -14,6 +15,7 @@ from pandas import json_normalize
 DATABASE_HOST_URL = os.environ.get('DATABASE_HOST_URL', 'http://127.0.0.1:3030/')
 REPOSITORY_ID = os.environ.get('REPOSITORY_ID', 'ds')
 SPARQL_REST_URL = DATABASE_HOST_URL + REPOSITORY_ID
+LINE_CONTENT_TYPES = {'.nt': 'application/n-triples', '.nq': 'application/n-quads'}
 
 prefixes = '''
 PREFIX prov: <http://www.w3.org/ns/prov#>
@@ -61,18 +63,37 @@ def query_handler(query):
     return response
 
 
-def upload_provenance(file_name):
+def upload_provenance(file_name, chunk_lines=100000):
     '''
-    Function for uploading provenance files to the database
-    :param file_name: name of provenance file to upload
+    Function for uploading provenance files to the database, N-Triples (.nt) and N-Quads (.nq) files are streamed in
+    chunks of lines rather than read into memory in one go
+    :param file_name: name of provenance file to upload, .ttl, .nt or .nq
+    :param chunk_lines: number of statements per request for N-Triples and N-Quads
     :return: Name of the graph in the database
     '''
     file_name_short = file_name.split('/')[-1]
-    pipeline = 'http://' + file_name_short.replace('.ttl', '')
-    data = open(file_name).read()
-    headers = {'Content-Type': 'text/turtle;charset=utf-8'}
-    url = SPARQL_REST_URL + '/data'
-    requests.post(url, params={'graph': pipeline}, data=data, headers=headers)
+    stem, ext = os.path.splitext(file_name_short)
+    if ext not in LINE_CONTENT_TYPES:
+        pipeline = 'http://' + file_name_short.replace('.ttl', '')
+        data = open(file_name).read()
+        headers = {'Content-Type': 'text/turtle;charset=utf-8'}
+        url = SPARQL_REST_URL + '/data'
+        requests.post(url, params={'graph': pipeline}, data=data, headers=headers)
+        return pipeline
+
+    pipeline = 'http://' + stem
+    headers = {'Content-Type': LINE_CONTENT_TYPES[ext]}
+    if ext == '.nq':
+        # quads carry their graph name, they are posted to the dataset
+        url, params = SPARQL_REST_URL, None
+    else:
+        url, params = SPARQL_REST_URL + '/data', {'graph': pipeline}
+    with open(file_name, 'r', encoding='utf-8') as f:
+        while True:
+            chunk = ''.join(islice(f, chunk_lines))
+            if not chunk:
+                break
+            requests.post(url, params=params, data=chunk.encode('utf-8'), headers=headers)
     return pipeline
 
 def convert_to_datetime_exception(datetime_str):
@@ -81,6 +102,12 @@ def convert_to_datetime_exception(datetime_str):
     :param datetime_str:
     :return: datetime object
     '''
+    # time stamps are written with nanosecond precision, datetime only holds microseconds
+    if '.' in datetime_str:
+        seconds, fraction = datetime_str.split('.', 1)
+        digits = len(fraction) - len(fraction.lstrip('0123456789'))
+        if digits > 6:
+            datetime_str = seconds + '.' + fraction[:6] + fraction[digits:]
     try:
         time = datetime.strptime(datetime_str, '%Y-%m-%dT%H:%M:%S.%f')
     except ValueError:
@@ -335,7 +362,7 @@ def module_query(prov_name, module_name, prefixes=prefixes):
 
 def duration_query(prov_name, prefixes=prefixes):
     query = prefixes + '''
-    SELECT ?start ?end ?funcName ?module
+    SELECT ?start ?end ?funcName ?module ?durationNs
 
     FROM NAMED <''' + prov_name + '''>
     WHERE {
@@ -352,6 +379,9 @@ def duration_query(prov_name, prefixes=prefixes):
 
         ?funcID prov:endedAtTime ?end .
 
+        OPTIONAL {
+        ?funcID prtr:durationNs ?durationNs .
+        }
 
         }
         }
@@ -360,4 +390,9 @@ def duration_query(prov_name, prefixes=prefixes):
     duration = df[['start.value', 'end.value']] = df[['start.value', 'end.value']].apply(pd.to_datetime)
     df['time_diff'] = df['end.value'] - df['start.value']
     df["diff_sec"] = df["time_diff"] / pd.Timedelta(seconds=1)
+    if 'durationNs.value' in df.columns:
+        # exact monotonic durations where the provenance has them
+        duration_ns = pd.to_numeric(df['durationNs.value'])
+        df['time_diff'] = pd.to_timedelta(duration_ns, unit='ns').fillna(df['time_diff'])
+        df["diff_sec"] = (duration_ns / 1e9).fillna(df["diff_sec"])
     return df
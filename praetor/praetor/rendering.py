@@ -0,0 +1,65 @@
+from collections import OrderedDict
+import json
+
+QUOTES = str.maketrans("", "", "\"'")
+CONTAINER_TYPES = (list, tuple, dict)
+
+budget_encoder = json.JSONEncoder(ensure_ascii=False)
+
+
+def remove_quotes(in_string):
+    """Remove single and double quotes from a string in one pass
+    :param in_string: input string
+    :return: in_string without quotes"""
+    return in_string.translate(QUOTES)
+
+
+def encode_if_larger(value, budget):
+    """JSON encode a value, but only if its encoding is longer than budget characters. Containers are encoded
+    incrementally and abandoned as soon as they pass the budget, so a small value is never encoded in full just to
+    find out it is small and a large one is only encoded once
+    :param value: python object
+    :param budget: Size in characters
+    :return: Full JSON encoding if longer than budget, None if not, raises TypeError if the value can not be encoded"""
+    if isinstance(value, CONTAINER_TYPES):
+        size = 0
+        for chunk in budget_encoder.iterencode(value):
+            size += len(chunk)
+            if size > budget:
+                break
+        else:
+            return None
+
+    encoded = json.dumps(value, ensure_ascii=False)
+    if len(encoded) > budget:
+        return encoded
+    return None
+
+
+class RenderCache:
+    """Bounded LRU memo of rendered values keyed by persistent id, so an entity is only rendered the first time it is
+    seen"""
+
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def get(self, value_id):
+        rendered = self.entries.get(value_id)
+        if rendered is not None:
+            try:
+                self.entries.move_to_end(value_id)
+            except KeyError:
+                # evicted by another traced thread since it was read
+                pass
+        return rendered
+
+    def store(self, value_id, rendered):
+        if not self.max_size:
+            return
+        self.entries[value_id] = rendered
+        if len(self.entries) > self.max_size:
+            try:
+                self.entries.popitem(last=False)
+            except KeyError:
+                pass
@@ -0,0 +1,241 @@
+import threading
+import time
+
+
+class CallSummary:
+    """Running count and duration statistics for the calls of one function. Durations are also counted in a histogram
+    of power of two nanosecond buckets"""
+
+    __slots__ = ("count", "total", "minimum", "maximum", "histogram")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.histogram = {}
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        if self.minimum is None or duration < self.minimum:
+            self.minimum = duration
+        if self.maximum is None or duration > self.maximum:
+            self.maximum = duration
+        bucket = int(duration * 1e9).bit_length()
+        self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+
+    def merge(self, other):
+        """Add the calls counted by another summary, e.g. of another thread"""
+        self.count += other.count
+        self.total += other.total
+        if self.minimum is None or (other.minimum is not None and other.minimum < self.minimum):
+            self.minimum = other.minimum
+        if self.maximum is None or (other.maximum is not None and other.maximum > self.maximum):
+            self.maximum = other.maximum
+        for bucket, count in other.histogram.items():
+            self.histogram[bucket] = self.histogram.get(bucket, 0) + count
+
+    def histogram_string(self):
+        """Histogram as space separated upper_bound_ns:count pairs"""
+        return " ".join("{}:{}".format(2 ** bucket, self.histogram[bucket]) for bucket in sorted(self.histogram))
+
+
+def summary_bindings(message_id, module_name, func_name, summary, summary_of, callers=()):
+    """Format call statistics into the json provenance of a summary activity
+    :param message_id: ID of the summary activity
+    :param module_name: Module of the summarised function
+    :param func_name: Name of the summarised function
+    :param summary: CallSummary of the calls
+    :param summary_of: What the summary covers, e.g. omittedCalls or allCalls
+    :param callers: (ID of the calling summary activity, CallSummary of the calls made from it) pairs
+    :return: json bindings"""
+    bindings = {"message": {"@id": message_id},
+                "moduleName": {"@type": "xsd:string", "@value": module_name},
+                "activityName": {"@type": "xsd:string", "@value": func_name},
+                "summaryOf": {"@type": "xsd:string", "@value": summary_of},
+                "callCount": {"@type": "xsd:long", "@value": summary.count},
+                "totalDuration": {"@type": "xsd:double", "@value": summary.total},
+                "minDuration": {"@type": "xsd:double", "@value": summary.minimum},
+                "maxDuration": {"@type": "xsd:double", "@value": summary.maximum},
+                "durationHistogram": {"@type": "xsd:string", "@value": summary.histogram_string()}}
+    for counter, (caller_id, caller_summary) in enumerate(callers):
+        bindings["caller_{}".format(counter)] = {"@id": caller_id, "callCount": caller_summary.count,
+                                                 "totalDuration": caller_summary.total}
+    return bindings
+
+
+class CallSampler:
+    """Decide which calls of each (module, function) are recorded in full. Calls which are left out are timed and
+    summarised so the provenance still accounts for them.
+
+    Modes:
+    - every: record every Nth call of each function
+    - first_per_window: record the first limit calls of each function in every window of seconds
+    - first: record the first limit calls of each function and only summarise the rest
+
+    Whether a call is recorded is decided when it is made, so first_per_window is biased towards the start of each
+    window rather than a uniform sample of it. A reservoir sample would have to take back calls already written.
+
+    The summaries of omitted calls are kept per thread, so traced threads never update the same summary, and combined
+    by omitted_summaries"""
+
+    MODES = ("every", "first_per_window", "first")
+
+    def __init__(self, mode, every=100, limit=100, window=1.0):
+        """
+        :param mode: every, first_per_window or first
+        :param every: Sampling rate of the every mode
+        :param limit: Number of calls recorded per function (per window for the first_per_window mode)
+        :param window: Length of the window in seconds
+        """
+        if mode not in self.MODES:
+            raise ValueError("Unknown sampling mode {}, choose from {}".format(mode, ", ".join(self.MODES)))
+        self.mode = mode
+        self.every = max(1, every)
+        self.limit = limit
+        self.window = window
+        self.calls = {}
+        self.window_start = {}
+        self.skipped = {}
+        self.local = threading.local()
+        self.thread_omitted = []
+
+    def keep(self, key):
+        """Decide whether the next call of a function is recorded
+        :param key: (module name, function name)
+        :return: True if the call should be recorded"""
+        count = self.calls.get(key, 0)
+        if self.mode == "every":
+            self.calls[key] = count + 1
+            return count % self.every == 0
+        if self.mode == "first":
+            self.calls[key] = count + 1
+            return count < self.limit
+
+        now = time.monotonic()
+        if now - self.window_start.get(key, -self.window) >= self.window:
+            self.window_start[key] = now
+            count = 0
+        self.calls[key] = count + 1
+        return count < self.limit
+
+    def skip(self, stack_id, key):
+        """Start timing a call which is not recorded
+        :param stack_id: Key of the activity
+        :param key: (module name, function name)"""
+        self.skipped[stack_id] = (key, time.perf_counter())
+
+    def returned(self, stack_id):
+        """Finish timing a call if it was skipped
+        :param stack_id: Key of the activity
+        :return: True if the call was skipped, so its return should not be recorded either"""
+        skipped = self.skipped.pop(stack_id, None)
+        if skipped is None:
+            return False
+        key, start = skipped
+        omitted = self.omitted
+        summary = omitted.get(key)
+        if summary is None:
+            summary = omitted[key] = CallSummary()
+        summary.add(time.perf_counter() - start)
+        return True
+
+    @property
+    def omitted(self):
+        """Summaries of the calls the current thread left out, by (module name, function name)"""
+        try:
+            return self.local.omitted
+        except AttributeError:
+            omitted = self.local.omitted = {}
+            self.thread_omitted.append(omitted)
+            return omitted
+
+    def omitted_summaries(self):
+        """Combine the summaries of omitted calls of all threads
+        :return: Dictionary of (module name, function name) to CallSummary"""
+        combined = {}
+        for omitted in list(self.thread_omitted):
+            for key, summary in list(omitted.items()):
+                total = combined.get(key)
+                if total is None:
+                    total = combined[key] = CallSummary()
+                total.merge(summary)
+        return combined
+
+
+class CallStatistics:
+    """Aggregate every call into per (module, function, caller) counts and durations instead of recording it. The
+    caller is the closest enclosing call which passed the filters, None for calls made from the main script. Every
+    thread has its own call stack and statistics, which are combined by summaries"""
+
+    def __init__(self):
+        self.local = threading.local()
+        self.thread_functions = []
+
+    def thread_statistics(self):
+        """Call stack and per function statistics of the current thread"""
+        try:
+            return self.local.stack, self.local.functions
+        except AttributeError:
+            self.local.stack = []
+            self.local.functions = {}
+            self.thread_functions.append(self.local.functions)
+            return self.local.stack, self.local.functions
+
+    def switch_stack(self, stack):
+        """Make another call stack the one of the current thread, e.g. the call stack of an asyncio task while it runs
+        :param stack: List used as call stack
+        :return: The call stack the thread had before"""
+        previous = self.thread_statistics()[0]
+        self.local.stack = stack
+        return previous
+
+    def call(self, stack_id, key):
+        """Start timing a call
+        :param stack_id: Key of the activity
+        :param key: (module name, function name)"""
+        stack = self.thread_statistics()[0]
+        caller = stack[-1][1] if stack else None
+        stack.append((stack_id, key, caller, time.perf_counter()))
+
+    def returned(self, stack_id):
+        """Finish timing a call, calls left open below it on the stack are discarded
+        :param stack_id: Key of the activity"""
+        end = time.perf_counter()
+        stack, functions = self.thread_statistics()
+        for position in range(len(stack) - 1, -1, -1):
+            if stack[position][0] == stack_id:
+                break
+        else:
+            return
+        _, key, caller, start = stack[position]
+        del stack[position:]
+
+        callers = functions.get(key)
+        if callers is None:
+            callers = functions[key] = {}
+        summary = callers.get(caller)
+        if summary is None:
+            summary = callers[caller] = CallSummary()
+        summary.add(end - start)
+
+    def summaries(self):
+        """Combine the per caller statistics of each function over all threads
+        :return: Dictionary of (module name, function name) to (CallSummary over all callers, per caller CallSummary)"""
+        functions = {}
+        for thread_functions in list(self.thread_functions):
+            for key, thread_callers in list(thread_functions.items()):
+                callers = functions.setdefault(key, {})
+                for caller, summary in list(thread_callers.items()):
+                    if caller not in callers:
+                        callers[caller] = CallSummary()
+                    callers[caller].merge(summary)
+
+        combined = {}
+        for key, callers in functions.items():
+            total = CallSummary()
+            for summary in callers.values():
+                total.merge(summary)
+            combined[key] = (total, callers)
+        return combined
@@ -0,0 +1,82 @@
+# Symbol table of the JSON lines raw trace
+#
+# Strings which repeat across records are written once as a symbol record, {"@id": number, "@mode": "symbol",
+# "@data": string}, numbered in the order they are first seen. Symbol 0 is the prefix of the message ids of the
+# session. Bindings refer to symbols with # in place of @:
+# - {"#value": 4} is the name binding {"@type": "xsd:string", "@value": symbol 4}
+# - {"#id": 7} is {"@id": symbol 7}, used for entity ids
+# - {"#id": "1234"} is {"@id": symbol 0 + "1234"}, used for message ids
+# Records written without the symbol table, such as entity and summary records, are mixed in unchanged.
+
+import threading
+
+SYMBOL_MODE = "symbol"
+
+
+class SymbolTable:
+    """Intern names and ids while the bindings of trace records are built. Traced threads share the table, a new symbol
+    is numbered and its record written under a lock so symbol records are in the file in the order of their numbers,
+    ahead of any record referring to them"""
+
+    def __init__(self, message_prefix, write):
+        """
+        :param message_prefix: Beginning of the message ids of the session
+        :param write: Function writing a symbol record to the trace straight away, ahead of buffered records
+        """
+        self.numbers = {}
+        self.write = write
+        self.lock = threading.Lock()
+        self.symbol(message_prefix)
+
+    def symbol(self, string):
+        """Number of a string, assigning the next number and writing its symbol record if it is new
+        :param string: String to intern
+        :return: Symbol number"""
+        number = self.numbers.get(string)
+        if number is None:
+            with self.lock:
+                number = self.numbers.get(string)
+                if number is None:
+                    number = len(self.numbers)
+                    self.write({"@id": number, "@mode": SYMBOL_MODE, "@data": string})
+                    # only visible to other threads once the record is written
+                    self.numbers[string] = number
+        return number
+
+    def name(self, value):
+        """Binding of a module or function name"""
+        return {"#value": self.symbol(value)}
+
+    def message(self, stack_id):
+        """Binding of the message id of an activity"""
+        return {"#id": str(stack_id)}
+
+    def entity(self, entity_id):
+        """Binding of an entity id"""
+        return {"#id": self.symbol(entity_id)}
+
+
+def resolve_symbols(records, symbols=None):
+    """Expand the references of a trace written with a symbol table, symbol records are consumed. Records of traces
+    without a symbol table are passed on unchanged
+    :param records: Iterable of records in the order they were written
+    :param symbols: Symbols read so far, to continue a trace which is read in parts; extended with the new symbols
+    :return: Generator of records"""
+    if symbols is None:
+        symbols = []
+    for record in records:
+        if record["@mode"] == SYMBOL_MODE:
+            symbols.append(record["@data"])
+            continue
+        data = record["@data"]
+        if symbols and data is not None:
+            for name, binding in data.items():
+                if "#id" in binding:
+                    reference = binding.pop("#id")
+                    if isinstance(reference, str):
+                        binding["@id"] = symbols[0] + reference
+                    else:
+                        binding["@id"] = symbols[reference]
+                elif "#value" in binding:
+                    data[name] = {"@type": "xsd:string", "@value": symbols[binding["#value"]]}
+        yield record
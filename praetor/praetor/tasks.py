@@ -0,0 +1,183 @@
+import contextvars
+import dis
+import inspect
+import weakref
+
+# asyncio mode
+#
+# A coroutine is suspended at every await which has to wait and resumed later, sys.setprofile reports each suspension
+# as a return and each resumption as a new call (sys.monitoring as PY_YIELD and PY_RESUME). In asyncio mode the tracer
+# records one activity per coroutine execution instead, from its start to its final return, and only counts its
+# suspensions. Coroutines of different tasks run interleaved on one thread, so their bookkeeping is kept per
+# asyncio.Task rather than on the call stack of the thread:
+# - the open activity of a coroutine is found again by its frame, which lives as long as the coroutine
+# - the activities of a task are chained through a last_activity of the task, and call statistics use a call stack of
+#   the task, both swapped in while the task runs
+# - the coroutine running in a task is kept in a context variable. Tasks run in a copy of the context they were
+#   created in, so the first coroutine of a task finds the coroutine which created the task there
+
+COROUTINE_FLAGS = inspect.CO_COROUTINE | inspect.CO_ITERABLE_COROUTINE | inspect.CO_ASYNC_GENERATOR
+YIELD_VALUE = dis.opmap["YIELD_VALUE"]
+# before python 3.11 an await is suspended in YIELD_FROM, which backs up to the instruction in front of it so it is
+# repeated when the coroutine is resumed
+YIELD_FROM = dis.opmap.get("YIELD_FROM")
+# from python 3.13 the frame of a suspended coroutine is already at the RESUME following its yield
+RESUME = dis.opmap.get("RESUME")
+
+running = contextvars.ContextVar("praetor_coroutine", default=None)
+
+
+def suspended(frame):
+    """Whether a coroutine frame leaving with a sys.setprofile return event is suspended rather than finished, it
+    stopped at a yield
+    :param frame: Python frame of the coroutine
+    :return: True for a suspension"""
+    code = frame.f_code.co_code
+    lasti = frame.f_lasti
+    if code[lasti] == YIELD_VALUE:
+        return True
+    if code[lasti] == RESUME:
+        return lasti >= 2 and code[lasti - 2] == YIELD_VALUE
+    return YIELD_FROM is not None and lasti + 2 < len(code) and code[lasti + 2] == YIELD_FROM
+
+
+def task_name(task):
+    """Name of an asyncio task, python 3.7 tasks have none and are named by their id"""
+    get_name = getattr(task, "get_name", None)
+    if get_name is None:
+        return "Task-{}".format(id(task))
+    return get_name()
+
+
+class TaskState:
+    """Provenance state of an asyncio task, swapped in for the state of the thread while the task runs"""
+
+    __slots__ = ("name", "coroutines", "last_activity", "stack", "outer_activity", "outer_stack")
+
+    def __init__(self, name):
+        self.name = name
+        self.coroutines = set()
+        self.last_activity = None
+        self.stack = []
+        self.outer_activity = None
+        self.outer_stack = None
+
+
+class CoroutineActivity:
+    """Activity of a coroutine, open from its start to its final return"""
+
+    __slots__ = ("frame", "activity_id", "task", "started_by", "top", "yields")
+
+    def __init__(self, frame, activity_id, task, started_by):
+        """
+        :param frame: Python frame of the coroutine
+        :param activity_id: ID of the activity
+        :param task: TaskState of the task running the coroutine, None outside of an event loop
+        :param started_by: CoroutineActivity of the coroutine awaiting it or which created its task, if recorded
+        """
+        self.frame = frame
+        self.activity_id = activity_id
+        self.task = task
+        self.started_by = started_by
+        # first recorded coroutine of its task, it is resumed first and suspended last when the task runs a step
+        self.top = started_by is None or started_by.task is not task
+        self.yields = 0
+
+
+class TaskTracker:
+    """Follow the coroutines of asyncio tasks across their suspensions. Coroutines still open when their task is done,
+    e.g. an async generator closed at a yield, which sys.setprofile reports like a suspension, are left in finished
+    for the tracer to close"""
+
+    def __init__(self):
+        # asyncio is only imported by tracers following tasks
+        import asyncio
+        self.current_task = asyncio.current_task
+        self.coroutines = {}
+        self.tasks = weakref.WeakKeyDictionary()
+        self.finished = []
+
+    def profile_event(self, frame, event):
+        """Tell the suspension and resumption of a coroutine apart from its start and final return, sys.setprofile
+        reports both as return and call events
+        :param frame: Python frame of the coroutine
+        :param event: call or return
+        :return: call, resume, yield or return"""
+        if event == "call":
+            return "resume" if id(frame) in self.coroutines else "call"
+        return "yield" if suspended(frame) else "return"
+
+    def start(self, frame, activity_id):
+        """Open the activity of a coroutine which has started, in the task running it
+        :param frame: Python frame of the coroutine
+        :param activity_id: ID of the activity
+        :return: CoroutineActivity"""
+        try:
+            task = self.current_task()
+        except RuntimeError:
+            # driven outside of an event loop
+            task = None
+        state = None
+        if task is not None:
+            state = self.tasks.get(task)
+            if state is None:
+                state = self.tasks[task] = TaskState(task_name(task))
+                task.add_done_callback(self.task_done)
+        coroutine = CoroutineActivity(frame, activity_id, state, running.get())
+        self.coroutines[id(frame)] = coroutine
+        if state is not None:
+            state.coroutines.add(coroutine)
+        running.set(coroutine)
+        return coroutine
+
+    def resume(self, frame):
+        """Activity of a coroutine which is resumed
+        :param frame: Python frame of the coroutine
+        :return: CoroutineActivity, None if the coroutine was started before tracing"""
+        return self.coroutines.get(id(frame))
+
+    def suspend(self, frame):
+        """Count a suspension of a coroutine
+        :param frame: Python frame of the coroutine
+        :return: CoroutineActivity, None if the coroutine was started before tracing"""
+        coroutine = self.coroutines.get(id(frame))
+        if coroutine is not None:
+            coroutine.yields += 1
+        return coroutine
+
+    def end(self, frame):
+        """Close the activity of a coroutine which has returned or raised
+        :param frame: Python frame of the coroutine
+        :return: CoroutineActivity, None if the coroutine was started before tracing"""
+        coroutine = self.coroutines.pop(id(frame), None)
+        if coroutine is not None:
+            self.forget(coroutine)
+            running.set(coroutine.started_by)
+        return coroutine
+
+    def forget(self, coroutine):
+        """Drop a closed coroutine from its task, and its frame so a finished coroutine does not keep its locals alive
+        through the coroutines and tasks it started"""
+        if coroutine.task is not None:
+            coroutine.task.coroutines.discard(coroutine)
+        coroutine.frame = None
+
+    def task_done(self, task):
+        """Done callback of the tasks, hands the coroutines of a task still open over to be closed. The callback runs
+        in the event loop rather than in the tracer, so anything recorded here would be traced itself"""
+        state = self.tasks.pop(task, None)
+        if state is None:
+            return
+        for coroutine in list(state.coroutines):
+            if self.coroutines.get(id(coroutine.frame)) is coroutine:
+                del self.coroutines[id(coroutine.frame)]
+                self.finished.append(coroutine)
+            else:
+                self.forget(coroutine)
+
+    def take_finished(self):
+        """Coroutines handed over by their tasks since the last call
+        :return: List of CoroutineActivity, to be closed and forgotten"""
+        finished = self.finished
+        self.finished = []
+        return finished
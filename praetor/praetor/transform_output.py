@@ -1,35 +1,318 @@
+import argparse
+import concurrent.futures
 import json
 import os
+import shutil
+import subprocess
+import sys
+import threading
 
+from praetor import children
 from praetor import match_json
 from praetor import json_to_ttl
+from praetor import json_to_nquads
 
-def create_full_json(agent_json, main_json):
+# file extension of each rdf serialisation, the line oriented formats can be split between any two lines
+RDF_FORMATS = {"turtle": ".ttl", "ntriples": ".nt", "nquads": ".nq"}
+
+
+def shard_ranges(file_path, shards):
+    """Split a file into byte ranges which each start at the beginning of a line
+    :param file_path: Path of the file
+    :param shards: Number of ranges
+    :return: List of (start, end) byte offsets, fewer than shards for small files"""
+    size = os.path.getsize(file_path)
+    bounds = [0]
+    with open(file_path, "rb") as f:
+        for shard in range(1, shards):
+            f.seek(max(size * shard // shards - 1, bounds[-1]))
+            # finish the line the offset falls in, so the next range starts on a new line
+            f.readline()
+            bounds.append(f.tell())
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+
+def session_iri(main_json):
+    """IRI of a session, the graph name its provenance is uploaded to
+    :param main_json: Path of the raw trace
+    :return: IRI"""
+    return "http://" + os.path.splitext(os.path.basename(main_json))[0]
+
+
+def make_converter(rdf_format, graph):
+    """Converter writing one of RDF_FORMATS
+    :param rdf_format: turtle, ntriples or nquads
+    :param graph: IRI of the session
+    :return: Converter"""
+    if rdf_format == "turtle":
+        return json_to_ttl.Converter({})
+    return json_to_nquads.QuadConverter({}, graph, quads=rdf_format == "nquads")
+
+
+def convert_lines(lines, write_to, agent_id, clock_anchor, blank_prefix="blank", rdf_format="turtle", graph=None):
+    """Convert flattened json provenance to rdf, one record per line
+    :param lines: Iterable of json lines
+    :param write_to: Open text file to write the triples to
+    :param agent_id: ID of the agent of the session
+    :param clock_anchor: Clock anchor of the session
+    :param blank_prefix: Prefix of the blank node labels
+    :param rdf_format: One of RDF_FORMATS
+    :param graph: IRI of the session, the graph name of nquads"""
+    converter = make_converter(rdf_format, graph)
+    converter.agent_id = agent_id
+    converter.clock_anchor = clock_anchor
+    converter.blank_prefix = blank_prefix
+    for line in lines:
+        converter.bindings = json.loads(line)
+        converter.write_line_triples(write_to)
+
+
+def convert_shard(flat_json, start, end, shard_ttl, agent_id, clock_anchor, shard, rdf_format="turtle", graph=None,
+                  blank_prefix="blank"):
+    """Convert one byte range of the flattened json provenance to rdf, run in a worker process
+    :param flat_json: Path of the flattened json provenance
+    :param start: Byte offset of the first line of the shard
+    :param end: Byte offset after the last line of the shard
+    :param shard_ttl: Path to write the triples of the shard to
+    :param agent_id: ID of the agent of the session
+    :param clock_anchor: Clock anchor of the session
+    :param shard: Number of the shard, namespaces its blank nodes
+    :param rdf_format: One of RDF_FORMATS
+    :param graph: IRI of the session
+    :param blank_prefix: Prefix of the blank node labels of the flattened json provenance
+    :return: shard_ttl"""
+    with open(flat_json, "rb") as f:
+        f.seek(start)
+        lines = f.read(end - start).decode("utf-8").split("\n")
+    with open(shard_ttl, "w") as write_to:
+        convert_lines((line for line in lines if line), write_to, agent_id, clock_anchor,
+                      blank_prefix="s{}_{}".format(shard, blank_prefix), rdf_format=rdf_format, graph=graph)
+    return shard_ttl
+
+
+def convert_parallel(flat_json, write_to, agent_id, clock_anchor, workers, rdf_format="turtle", graph=None,
+                     blank_prefix="blank"):
+    """Convert the flattened json provenance to rdf in shards on a pool of processes, the shard outputs are appended
+    to write_to in order
+    :param flat_json: Path of the flattened json provenance
+    :param write_to: Open text file to write the triples to
+    :param agent_id: ID of the agent of the session
+    :param clock_anchor: Clock anchor of the session
+    :param workers: Number of processes
+    :param rdf_format: One of RDF_FORMATS
+    :param graph: IRI of the session
+    :param blank_prefix: Prefix of the blank node labels, each shard adds its number"""
+    # several shards per worker keep the pool busy when shards convert at different speeds
+    ranges = shard_ranges(flat_json, workers * 4)
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        futures = [executor.submit(convert_shard, flat_json, start, end, "{}.shard{}".format(flat_json, shard),
+                                   agent_id, clock_anchor, shard, rdf_format, graph, blank_prefix)
+                   for shard, (start, end) in enumerate(ranges)]
+        for future in futures:
+            shard_ttl = future.result()
+            write_to.flush()
+            with open(shard_ttl, "r") as to_read:
+                shutil.copyfileobj(to_read, write_to)
+            os.remove(shard_ttl)
+
+
+def convert_process_shards(main_json, write_to, clock_anchor, workers=1, rdf_format="turtle", graph=None):
+    """Merge the raw traces of the child processes of a session into its rdf, the activities of each child are
+    associated with the agent of its process
+    :param main_json: Path of the raw trace of the session
+    :param write_to: Open text file of the rdf of the session
+    :param clock_anchor: Clock anchor of the session
+    :param workers: Number of processes converting in parallel, 1 converts in this process
+    :param rdf_format: One of RDF_FORMATS
+    :param graph: IRI of the session
+    :return: Number of child traces merged"""
+    shards = children.shard_paths(main_json)
+    for shard_json in shards:
+        root, ext = os.path.splitext(shard_json)
+        shard_session = os.path.basename(root)
+        agent_id = "urn_uuid:" + shard_session
+        # blank nodes of every process are labelled apart, e.g. p1234_blank0
+        blank_prefix = shard_session.rpartition("_")[2] + "_blank"
+        out_json = root + '_flattend.json'
+        match_json.stream_pairs(shard_json, out_json)
+        if workers > 1:
+            convert_parallel(out_json, write_to, agent_id, clock_anchor, workers, rdf_format, graph, blank_prefix)
+        else:
+            with open(out_json, "r") as to_read:
+                convert_lines(to_read, write_to, agent_id, clock_anchor, blank_prefix, rdf_format, graph)
+    return len(shards)
+
+
+def rdf_header(agent_json, rdf_format, graph):
+    """Beginning of the rdf file of a session, the turtle prefixes and the agent
+    :param agent_json: Path of agent_json.json of the session
+    :param rdf_format: One of RDF_FORMATS
+    :param graph: IRI of the session
+    :return: String"""
+    if rdf_format == "turtle":
+        agent_triple, agent_id = json_to_ttl.generate_agent_triple(agent_json)
+        return json_to_ttl.Converter.context + agent_triple
+    return make_converter(rdf_format, graph).generate_agent_triple(agent_json)
+
+
+def create_full_json(agent_json, main_json, workers=1, rdf_format="turtle"):
+    """Merge the raw trace into the flattened json provenance and convert it to rdf, together with the traces of the
+    child processes of the session
+    :param agent_json: Path of agent_json.json of the session
+    :param main_json: Path of the raw trace
+    :param workers: Number of processes converting in parallel, 1 converts in this process
+    :param rdf_format: One of RDF_FORMATS; turtle, or the line oriented ntriples and nquads (graph name the session)"""
     root, ext = os.path.splitext(main_json)
-    main_ttl = root + '.ttl'
+    main_rdf = root + RDF_FORMATS[rdf_format]
+    graph = session_iri(main_json)
     agent_triple, agent_id = json_to_ttl.generate_agent_triple(agent_json)
+    clock_anchor = json_to_ttl.read_clock_anchor(agent_json)
 
     out_json = root + '_flattend.json'
-    line_index = match_json.json_concat(main_json)
-    output = match_json.read_pairs_adaptive_return(main_json, out_json, line_index)
-
-    with open(main_ttl, "w") as write_to:
-        with open(out_json, "r") as to_read:
-            counter = 0
-            for line in to_read:
-                json_line = json.loads(line)
-                if counter == 0:
-                    converter = json_to_ttl.Converter(json_line)
-                    converter.agent_id = agent_id
-                    write_to.write(converter.context)
-                    write_to.write(agent_triple)
-                    counter += 1
-                else:
-                    converter.bindings = json_line
-                    converter.triple_string = ""
-                line_triple = converter.generate_line_triples()
-                # print(len(line_triple))
-                write_to.write(line_triple)
-                counter += 1
-                # print("##### {} #####".format(counter))
+    match_json.stream_pairs(main_json, out_json)
+
+    with open(main_rdf, "w") as write_to:
+        write_to.write(rdf_header(agent_json, rdf_format, graph))
+        if workers > 1:
+            convert_parallel(out_json, write_to, agent_id, clock_anchor, workers, rdf_format, graph)
+        else:
+            with open(out_json, "r") as to_read:
+                convert_lines(to_read, write_to, agent_id, clock_anchor, rdf_format=rdf_format, graph=graph)
+        convert_process_shards(main_json, write_to, clock_anchor, workers, rdf_format, graph)
+
+
+def create_full_json_subprocess(agent_json, main_json, workers, rdf_format="turtle"):
+    """Run create_full_json in a new interpreter. Process pools can not be started from atexit handlers, where the
+    tracer creates the provenance, so a parallel conversion at exit is handed to a child process
+    :param agent_json: Path of agent_json.json of the session
+    :param main_json: Path of the raw trace
+    :param workers: Number of processes converting in parallel
+    :param rdf_format: One of RDF_FORMATS"""
+    subprocess.run([sys.executable, "-m", "praetor.transform_output", agent_json, main_json, "--workers", str(workers),
+                    "--rdf-format", rdf_format],
+                   env=subprocess_environment(), check=True)
+
+
+def subprocess_environment():
+    """Environment for running praetor modules in a new interpreter, with this copy of praetor importable
+    :return: Dictionary of environment variables"""
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    python_path = os.pathsep.join(path for path in (package_root, os.environ.get("PYTHONPATH")) if path)
+    return dict(os.environ, PYTHONPATH=python_path)
+
+
+class RollingConversion:
+    """Convert the activities of a raw trace to flattened json and rdf in segments while the trace is still being
+    written. Each segment appends the records completed since the previous one, calls which are still open wait for
+    their return and are only written, without an end time, when the conversion is closed. The output is the same as
+    create_full_json produces for the finished trace"""
+
+    def __init__(self, agent_json, main_json, rdf_format="turtle"):
+        """
+        :param agent_json: Path of agent_json.json of the session
+        :param main_json: Path of the raw trace
+        :param rdf_format: One of RDF_FORMATS
+        """
+        root, ext = os.path.splitext(main_json)
+        graph = session_iri(main_json)
+        self.main_json = main_json
+        self.rdf_format = rdf_format
+        self.graph = graph
+        self.tail = match_json.TraceTail(main_json)
+        self.merger = match_json.PairMerger()
+        self.converter = make_converter(rdf_format, graph)
+        self.converter.agent_id = json_to_ttl.generate_agent_triple(agent_json)[1]
+        self.converter.clock_anchor = json_to_ttl.read_clock_anchor(agent_json)
+        self.written = 0
+
+        self.out_json = open(root + '_flattend.json', "w", encoding='utf-8')
+        self.write_to = open(root + RDF_FORMATS[rdf_format], "w")
+        self.write_to.write(rdf_header(agent_json, rdf_format, graph))
+
+    def write(self, data):
+        """Write the bindings of one record to both outputs"""
+        self.out_json.write(json.dumps(data) + "\n")
+        self.converter.bindings = data
+        self.converter.write_line_triples(self.write_to)
+        self.written += 1
+
+    def convert_segment(self):
+        """Convert everything completed since the last segment
+        :return: Number of records written"""
+        written = self.written
+        for record in self.tail.read():
+            data = self.merger.add(record)
+            if data is not None:
+                self.write(data)
+        self.out_json.flush()
+        self.write_to.flush()
+        return self.written - written
+
+    def close(self):
+        """Convert the last segment, the calls which are still open and the traces of the child processes"""
+        self.convert_segment()
+        for data in self.merger.finish():
+            self.write(data)
+        convert_process_shards(self.main_json, self.write_to, self.converter.clock_anchor, rdf_format=self.rdf_format,
+                               graph=self.graph)
+        self.out_json.close()
+        self.write_to.close()
+        print(f"Merged {self.written} records")
+
+
+def follow_trace(agent_json, main_json, interval, rdf_format="turtle"):
+    """Convert a trace in segments every interval seconds until standard input is closed, which the traced process
+    does at close and the operating system does when it is killed, then convert the rest
+    :param agent_json: Path of agent_json.json of the session
+    :param main_json: Path of the raw trace
+    :param interval: Seconds between segments
+    :param rdf_format: One of RDF_FORMATS"""
+    conversion = RollingConversion(agent_json, main_json, rdf_format)
+    finished = threading.Event()
+
+    def wait_for_end():
+        sys.stdin.buffer.read()
+        finished.set()
+
+    threading.Thread(target=wait_for_end, daemon=True).start()
+    while not finished.wait(interval):
+        conversion.convert_segment()
+    conversion.close()
+
+
+def start_rolling_conversion(agent_json, main_json, interval, rdf_format="turtle"):
+    """Start follow_trace in a new interpreter, outside of the traced process so it neither competes with the traced
+    script nor is lost with it
+    :param agent_json: Path of agent_json.json of the session
+    :param main_json: Path of the raw trace
+    :param interval: Seconds between segments
+    :param rdf_format: One of RDF_FORMATS
+    :return: subprocess.Popen of the conversion, pass it to finish_rolling_conversion at the end of the run"""
+    # own session, so an interrupt of the traced script does not stop the conversion before the end of the trace
+    return subprocess.Popen([sys.executable, "-m", "praetor.transform_output", agent_json, main_json, "--follow",
+                             str(interval), "--rdf-format", rdf_format],
+                            stdin=subprocess.PIPE, env=subprocess_environment(), start_new_session=True)
+
+
+def finish_rolling_conversion(process):
+    """Tell a rolling conversion the trace is complete and wait for it to convert the rest
+    :param process: subprocess.Popen returned by start_rolling_conversion
+    :return: True if the conversion finished successfully"""
+    process.stdin.close()
+    return process.wait() == 0
+
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert a praetor raw trace to flattened json and rdf provenance.')
+    parser.add_argument('agent_json', help='agent_json.json of the session')
+    parser.add_argument('main_json', help='Raw trace of the session')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of conversion processes')
+    parser.add_argument('--rdf-format', default='turtle', choices=list(RDF_FORMATS), help='Serialisation of the provenance')
+    parser.add_argument('--follow', type=float, metavar='INTERVAL',
+                        help='Convert a trace which is still being written every INTERVAL seconds, until stdin closes')
+    args = parser.parse_args()
+    if args.follow is not None:
+        follow_trace(args.agent_json, args.main_json, args.follow, rdf_format=args.rdf_format)
+    else:
+        create_full_json(args.agent_json, args.main_json, workers=args.workers, rdf_format=args.rdf_format)
@@ -0,0 +1,267 @@
+import atexit
+import os
+import queue
+import signal
+import threading
+import time
+import traceback
+
+# signals which terminate the process without running atexit handlers, the buffer is flushed before they are re-raised
+FATAL_SIGNALS = tuple(getattr(signal, name) for name in ("SIGTERM", "SIGHUP") if hasattr(signal, name))
+# how long the flush of a signal handler waits for the file lock. The handler runs on the main thread, which may be the
+# thread it interrupted while holding the lock, so the flush is skipped rather than waiting forever
+SIGNAL_FLUSH_TIMEOUT = 1.0
+
+
+class BufferedLineWriter:
+    """Collect JSON lines in memory and write them to the trace file in large blocks, rather than one write and flush
+    per event. The buffer is written once it holds max_bytes or max_interval seconds have passed since the last
+    write, so a crash loses at most one window of events.
+
+    Every thread has its own buffer, so traced threads never wait for each other and only take the file lock to write
+    a full buffer as one block. Buffers of threads which have ended are written with the next block of any thread, and
+    a flusher thread writes all buffers every max_interval seconds, so lines of threads which stopped writing, e.g.
+    while they wait for something, are not held back"""
+
+    def __init__(self, handle, max_bytes=1024 * 1024, max_interval=1.0):
+        """
+        :param handle: Open text file to write to, or a binary file to write bytes to
+        :param max_bytes: Size of the buffer in characters, 0 writes and flushes every line immediately
+        :param max_interval: Maximum time in seconds lines are held before being written
+        """
+        self.handle = handle
+        self.name = handle.name
+        self.max_bytes = max_bytes
+        self.max_interval = max_interval
+        self.empty = b"" if "b" in handle.mode else ""
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.buffers = []
+        self.stop_flushing = threading.Event()
+        self.flusher = None
+        if max_bytes and max_interval:
+            self.flusher = threading.Thread(target=self.flush_periodically, name="praetor-flusher", daemon=True)
+            self.flusher.start()
+
+    def buffer(self):
+        """Buffer of the current thread"""
+        try:
+            return self.local.buffer
+        except AttributeError:
+            buffer = self.local.buffer = LineBuffer(threading.current_thread())
+            with self.lock:
+                self.buffers.append(buffer)
+            return buffer
+
+    def write(self, line):
+        """Add a line (including its newline) to the buffer of the current thread
+        :param line: Line to write"""
+        if not self.max_bytes:
+            with self.lock:
+                self.handle.write(line)
+                self.handle.flush()
+            return
+        try:
+            buffer = self.local.buffer
+        except AttributeError:
+            buffer = self.buffer()
+        buffer.lines.append(line)
+        buffer.size += len(line)
+        if buffer.size >= self.max_bytes or time.monotonic() - buffer.last_flush >= self.max_interval:
+            self.flush_buffer(buffer)
+
+    def write_now(self, line):
+        """Write a line straight to the file, ahead of the lines still held in any buffer, e.g. a definition the
+        buffered lines of every thread may refer to
+        :param line: Line to write"""
+        with self.lock:
+            if not self.handle.closed:
+                self.handle.write(line)
+
+    def flush_buffer(self, buffer):
+        """Write the buffer of a thread, and the buffers of threads which have ended, to disk"""
+        with self.lock:
+            if self.handle.closed:
+                return
+            self.write_lines(buffer)
+            finished = [other for other in self.buffers if not other.thread.is_alive()]
+            for other in finished:
+                self.write_lines(other)
+                self.buffers.remove(other)
+            self.handle.flush()
+
+    def write_lines(self, buffer):
+        """Move the lines of a buffer to the file, with the lock held. The thread of the buffer may be adding lines at
+        the same time, so the lines written are cut from the front of the list rather than the list replaced"""
+        lines = buffer.lines
+        count = len(lines)
+        if count:
+            self.handle.write(self.empty.join(lines[:count]))
+            del lines[:count]
+            buffer.size = 0
+        buffer.last_flush = time.monotonic()
+
+    def flush(self, timeout=None):
+        """Write everything in the buffers of all threads to disk
+        :param timeout: Maximum time in seconds to wait for the file lock before giving up, None waits as long as it
+        takes"""
+        if not self.lock.acquire(timeout=-1 if timeout is None else timeout):
+            return
+        try:
+            if self.handle.closed:
+                return
+            for buffer in self.buffers:
+                self.write_lines(buffer)
+            self.handle.flush()
+        finally:
+            self.lock.release()
+
+    def flush_periodically(self):
+        """Run by the flusher thread until the writer is closed"""
+        while not self.stop_flushing.wait(self.max_interval):
+            self.flush()
+
+    def close(self):
+        self.stop_flushing.set()
+        if self.flusher is not None:
+            self.flusher.join()
+        self.flush()
+        with self.lock:
+            self.handle.close()
+
+    def hold(self):
+        """Take the file lock and empty the file object before the process forks, so the child neither inherits the
+        lock held by another thread nor data which the parent is still going to write"""
+        self.lock.acquire()
+        if not self.handle.closed:
+            self.handle.flush()
+
+    def release(self):
+        """Release the lock taken by hold, in the parent after the fork"""
+        self.lock.release()
+
+    def abandon(self):
+        """Let go of a writer copied into a forked child, its buffers and file belong to the parent. The file object
+        was emptied by hold, so closing it writes nothing. The flusher thread was not copied into the child"""
+        self.stop_flushing.set()
+        self.buffers = []
+        self.local = threading.local()
+        self.handle.close()
+        self.lock.release()
+
+    @property
+    def closed(self):
+        return self.handle.closed
+
+
+class LineBuffer:
+    """Lines of one thread waiting to be written"""
+
+    __slots__ = ("thread", "lines", "size", "last_flush")
+
+    def __init__(self, thread):
+        self.thread = thread
+        self.lines = []
+        self.size = 0
+        self.last_flush = time.monotonic()
+
+
+class BackgroundWriter:
+    """Process captured events on a dedicated thread so the traced thread only pays for putting a tuple on a bounded
+    queue. Events are processed in the order they were submitted"""
+
+    BACKPRESSURE = ("block", "drop", "sample")
+    stop_event = object()
+
+    def __init__(self, process, max_queue=100000, backpressure="block", sample_every=10):
+        """
+        :param process: Function called on the writer thread with each submitted event
+        :param max_queue: Maximum number of events waiting to be processed
+        :param backpressure: Behaviour when the queue is full; block until there is space, drop the event, or sample
+        (block for every sample_every-th overflowing event and drop the others)
+        :param sample_every: Sampling rate of the sample backpressure
+        """
+        if backpressure not in self.BACKPRESSURE:
+            raise ValueError("Unknown backpressure {}, choose from {}".format(backpressure,
+                                                                              ", ".join(self.BACKPRESSURE)))
+        self.process = process
+        self.queue = queue.Queue(max_queue)
+        self.backpressure = backpressure
+        self.sample_every = max(1, sample_every)
+        self.overflowed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.first_error = None
+        self.thread = threading.Thread(target=self.run, name="praetor-writer", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def submit(self, event):
+        """Queue an event for processing, applying the backpressure policy if the queue is full
+        :param event: Event to process"""
+        try:
+            self.queue.put_nowait(event)
+            return
+        except queue.Full:
+            pass
+
+        if self.backpressure == "block":
+            self.queue.put(event)
+        elif self.backpressure == "drop":
+            self.dropped += 1
+        else:
+            self.overflowed += 1
+            if self.overflowed % self.sample_every == 0:
+                self.queue.put(event)
+            else:
+                self.dropped += 1
+
+    def run(self):
+        while True:
+            event = self.queue.get()
+            if event is self.stop_event:
+                return
+            try:
+                self.process(event)
+            except Exception:
+                # keep draining the queue so the traced thread never blocks on a dead writer
+                if not self.errors:
+                    self.first_error = traceback.format_exc()
+                self.errors += 1
+
+    def stop(self):
+        """Process everything still queued and stop the writer thread"""
+        if self.thread.is_alive():
+            self.queue.put(self.stop_event)
+            self.thread.join()
+
+
+def flush_on_exit(flush, signals=FATAL_SIGNALS):
+    """Make sure a buffer is flushed when the interpreter exits or is killed by a fatal signal. Existing signal handlers
+    are called afterwards, default handlers are restored and the signal re-raised so the process still terminates
+    :param flush: Function flushing the buffer, signal handlers pass it a timeout for the lock of the buffer
+    :param signals: Signals to intercept"""
+    atexit.register(flush)
+
+    for signum in signals:
+        try:
+            previous = signal.getsignal(signum)
+        except ValueError:
+            continue
+        if previous == signal.SIG_IGN:
+            continue
+
+        def handler(received, frame, previous=previous):
+            flush(timeout=SIGNAL_FLUSH_TIMEOUT)
+            if callable(previous):
+                previous(received, frame)
+            else:
+                signal.signal(received, signal.SIG_DFL)
+                os.kill(os.getpid(), received)
+
+        try:
+            signal.signal(signum, handler)
+        except ValueError:
+            # signal handlers can only be installed from the main thread
+            return
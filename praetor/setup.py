@@ -10,6 +10,7 @@ setup(name='praetor',
       license='MIT',
       packages=['praetor'],
       install_requires=['pandas', 'prov', 'requests'],
+      extras_require={'xxhash': ['xxhash']},
       scripts=[],
       zip_safe=False)
 
@@ -0,0 +1,45 @@
+import io
+
+from praetor.eventlog import MAGIC, EventLogEncoder, read_frames
+
+SESSION = "urn_uuid:work_provenance_4f1c2a9e-0d5b-4c3e-9a7f-2b8e6d1c0f3a_"
+
+
+def activity_records(count):
+    records = []
+    for number in range(count):
+        data = {
+            "message": {"@id": SESSION + str(number)},
+            "moduleName": {"@type": "xsd:string", "@value": "work"},
+            "activityName": {"@type": "xsd:string", "@value": "step"},
+            "input_0": {"@id": "run:{:064x}".format(number * 7919), "@role": "items"},
+            "startTime": {"@value": 1700000000000000000 + number},
+        }
+        records.append({"@id": str(number + 1), "@mode": "call", "@data": data})
+    records.append({"@id": "run:00ff", "@mode": "entity",
+                    "@data": {"entity": {"@id": "run:00ff", "@value": "[1, 2]", "@type": "list"}}})
+    records.append({"@id": "process", "@mode": "process", "@data": None})
+    return records
+
+
+def encode_all(records):
+    written = io.BytesIO()
+    encoder = EventLogEncoder(written.write)
+    for record in records:
+        written.write(encoder.encode(record))
+    written.seek(0)
+    return written, encoder
+
+
+def test_records_are_decoded_unchanged():
+    records = activity_records(300)
+    written, _ = encode_all(records)
+    assert written.read(len(MAGIC)) == MAGIC
+    decoded = [record for record in read_frames(written, []) if record is not None]
+    assert decoded == records
+
+
+def test_ids_used_once_do_not_grow_the_string_table():
+    _, few = encode_all(activity_records(2))
+    _, many = encode_all(activity_records(300))
+    assert len(many.symbols) == len(few.symbols)
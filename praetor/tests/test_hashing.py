@@ -0,0 +1,111 @@
+import pytest
+
+from praetor.hashing import SNAPSHOT_MAX_BYTES, HashCache, content_key, frozen_version, snapshot
+from praetor.praetor import CallTracer
+
+np = pytest.importorskip("numpy")
+
+
+def counting_cache():
+    calls = []
+
+    def hash_function(obj):
+        calls.append(obj)
+        return CallTracer.generate_persistent_id(obj)
+
+    return HashCache(hash_function), calls
+
+
+def test_writeable_array_is_hashed_every_time():
+    cache, calls = counting_cache()
+    array = np.zeros(1000)
+    before = cache.persistent_id(array)
+    array[500] = 1
+    assert cache.persistent_id(array) != before
+    assert len(calls) == 2
+
+
+def test_read_only_array_is_cached():
+    cache, calls = counting_cache()
+    array = np.arange(1000.0)
+    array.flags.writeable = False
+    first = cache.persistent_id(array)
+    assert cache.persistent_id(array) == first
+    assert len(calls) == 1
+
+
+def test_reshaped_read_only_array_is_hashed_again():
+    cache, _ = counting_cache()
+    array = np.arange(12.0)
+    array.flags.writeable = False
+    before = cache.persistent_id(array)
+    array.shape = (3, 4)
+    assert cache.persistent_id(array) != before
+
+
+def test_read_only_view_of_writeable_array_is_not_cached():
+    base = np.arange(12.0)
+    view = base[:]
+    view.flags.writeable = False
+    assert frozen_version(view) is None
+
+
+def test_short_containers_are_cached_by_contents():
+    cache, calls = counting_cache()
+    values = [1, "a", None]
+    first = cache.persistent_id(values)
+    assert cache.persistent_id(list(values)) == first
+    assert len(calls) == 1
+    values.append(2)
+    assert cache.persistent_id(values) != first
+
+
+def test_content_key_keeps_types_apart():
+    assert content_key([1]) != content_key([True])
+    assert content_key([[1]]) is None
+    assert content_key({"a": 1}) == content_key({"a": 1})
+
+
+def test_read_only_data_frame_is_cached_until_renamed():
+    pandas = pytest.importorskip("pandas")
+    data = np.arange(12.0).reshape(4, 3).copy()
+    data.flags.writeable = False
+    frame = pandas.DataFrame(data, copy=False)
+    cache, calls = counting_cache()
+    first = cache.persistent_id(frame)
+    assert cache.persistent_id(frame) == first
+    assert len(calls) == 1
+    frame.columns = ["a", "b", "c"]
+    assert cache.persistent_id(frame) != first
+
+
+def test_writeable_data_frame_is_not_cached():
+    pandas = pytest.importorskip("pandas")
+    assert frozen_version(pandas.DataFrame({"x": np.arange(3.0)})) is None
+
+
+def test_snapshot_has_the_persistent_id_of_the_object_when_taken():
+    values = [0.5, "a", None]
+    array = np.arange(10.0)
+    for obj in (values, {"a": 1.5}, array, bytearray(b"abc")):
+        before = CallTracer.generate_persistent_id(obj)
+        copy = snapshot(obj)
+        assert copy is not obj
+        assert CallTracer.generate_persistent_id(copy) == before
+    copy = snapshot(array)
+    array[0] = 1
+    assert CallTracer.generate_persistent_id(copy) != CallTracer.generate_persistent_id(array)
+
+
+def test_snapshot_is_not_taken_of_nested_containers_or_large_arrays():
+    assert snapshot([[1]]) is None
+    assert snapshot(np.zeros(SNAPSHOT_MAX_BYTES // 8 + 1)) is None
+
+
+@pytest.mark.parametrize("length", [1024 * 1024, 16 * 1024 * 1024])
+def test_write_deep_inside_a_large_array_changes_its_persistent_id(length):
+    cache, _ = counting_cache()
+    array = np.zeros(length)
+    before = cache.persistent_id(array)
+    array[12345] += 1
+    assert cache.persistent_id(array) != before
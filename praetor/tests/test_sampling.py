@@ -0,0 +1,18 @@
+import time
+
+import pytest
+
+from praetor.sampling import CallSampler
+
+
+def test_first_per_window_keeps_the_first_calls_of_each_window():
+    sampler = CallSampler("first_per_window", limit=2, window=0.2)
+    key = ("module", "function")
+    assert [sampler.keep(key) for _ in range(4)] == [True, True, False, False]
+    time.sleep(0.3)
+    assert [sampler.keep(key) for _ in range(3)] == [True, True, False]
+
+
+def test_unknown_mode_is_rejected():
+    with pytest.raises(ValueError):
+        CallSampler("window")
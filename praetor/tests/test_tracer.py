@@ -0,0 +1,177 @@
+import gc
+import json
+import threading
+import time
+import weakref
+
+import pytest
+
+from praetor.backends import install_tracer
+from praetor.praetor import CallTracer
+
+WRITER_MODES = [pytest.param(False, id="inline"), pytest.param(True, id="background_writer")]
+
+
+def new_tracer(directory, **settings):
+    return CallTracer(output_directory=str(directory), trace_children=False, intern_symbols=False, **settings)
+
+
+def read_lines(tracer):
+    """Lines of the raw json trace written so far, parsed only after tracing, as the parsing is traced too"""
+    with open(tracer.out_handle.name) as f:
+        return f.readlines()
+
+
+def parse_records(lines):
+    return [json.loads(line) for line in lines if line.endswith("\n")]
+
+
+def trace(directory, function, *args, **settings):
+    """Trace a single call of a function
+    :return: Records of the raw json trace"""
+    tracer = new_tracer(directory, **settings)
+    install_tracer(tracer)
+    try:
+        function(*args)
+    finally:
+        tracer.close()
+    return parse_records(read_lines(tracer))
+
+
+def returns_of(records, name):
+    return [record["@data"] for record in records
+            if record["@mode"] == "return" and record["@data"]["activityName"]["@value"] == name]
+
+
+def mutated_inputs(data):
+    return [binding for key, binding in data.items() if key.startswith("mutated_")]
+
+
+def grow(items, value):
+    items.append(value)
+    return len(items)
+
+
+def size(items):
+    return len(items)
+
+
+def write_element(array, index):
+    array[index] += 1
+
+
+def calls_on_list():
+    items = [1, 2, 3]
+    grow(items, 4)
+    size(items)
+
+
+@pytest.mark.parametrize("background_writer", WRITER_MODES)
+def test_appended_list_is_recorded_as_mutated(tmp_path, background_writer):
+    records = trace(tmp_path, calls_on_list, background_writer=background_writer)
+    grown, = returns_of(records, "grow")
+    mutated, = mutated_inputs(grown)
+    assert mutated["@role"] == "items"
+    assert mutated["@derivedFrom"] != mutated["@id"]
+    unchanged, = returns_of(records, "size")
+    assert not mutated_inputs(unchanged)
+
+
+@pytest.mark.parametrize("background_writer", WRITER_MODES)
+@pytest.mark.parametrize("length", [16, 1024 * 1024])
+def test_element_written_into_array_is_recorded_as_mutated(tmp_path, background_writer, length):
+    np = pytest.importorskip("numpy")
+    array = np.zeros(length)
+    records = trace(tmp_path, write_element, array, length // 2, background_writer=background_writer)
+    written, = returns_of(records, "write_element")
+    mutated, = mutated_inputs(written)
+    assert mutated["@role"] == "array"
+
+
+def test_calls_of_an_idle_thread_reach_the_trace(tmp_path):
+    tracer = new_tracer(tmp_path, write_interval=0.1)
+    called = threading.Event()
+    release = threading.Event()
+
+    def worker():
+        for i in range(5):
+            size([i])
+        called.set()
+        release.wait()
+
+    install_tracer(tracer)
+    thread = threading.Thread(target=worker)
+    try:
+        thread.start()
+        called.wait()
+        time.sleep(1.0)
+        lines = read_lines(tracer)
+    finally:
+        release.set()
+        thread.join()
+        tracer.close()
+    assert len(returns_of(parse_records(lines), "size")) == 5
+
+
+def raise_in_c_call(items):
+    try:
+        items.index(-1)
+    except ValueError:
+        pass
+    return len(items)
+
+
+def test_inputs_of_calls_left_open_are_dropped(tmp_path):
+    tracer = new_tracer(tmp_path, cpython=True)
+    install_tracer(tracer)
+    try:
+        raise_in_c_call([1, 2])
+        tracer.backend.stop()
+        # the call of stop is still open, the index call which raised was discarded at the return of raise_in_c_call
+        open_activities = {activity_id for _, activity_id in tracer.thread_state().stack}
+        assert set(tracer.call_inputs) <= open_activities
+    finally:
+        tracer.close()
+    assert not tracer.call_inputs
+
+
+class Guarded:
+    """Object which can't be pickled, its persistent id is its memory address"""
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return self.name
+
+
+def test_entity_with_an_address_id_is_written_again_for_a_new_object_at_the_address(tmp_path):
+    tracer = new_tracer(tmp_path)
+    first = Guarded("first")
+    address_id = tracer.prefix + tracer.persistent_id(first)
+    assert tracer.is_address_id(address_id)
+    tracer.entity_binding(first, address_id)
+    tracer.entity_binding(first, address_id)
+    # an object created after the first is freed can get the same address
+    tracer.entity_binding(Guarded("second"), address_id)
+    tracer.close()
+    entities = [record["@data"]["entity"]["@value"] for record in parse_records(read_lines(tracer))
+                if record["@mode"] == "entity" and record["@id"] == address_id]
+    assert entities == ["first", "second"]
+
+
+def test_filter_cache_does_not_keep_code_objects_alive(tmp_path):
+    namespace = {}
+    exec("def generated(items):\n    return len(items)\n", namespace)
+    code = weakref.ref(namespace["generated"].__code__)
+    tracer = new_tracer(tmp_path)
+    install_tracer(tracer)
+    try:
+        namespace["generated"]([1])
+    finally:
+        tracer.close()
+    assert code() in tracer.filter_cache
+    namespace.clear()
+    gc.collect()
+    assert code() is None
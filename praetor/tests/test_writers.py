@@ -0,0 +1,46 @@
+import sys
+import threading
+import time
+
+from praetor.writers import BufferedLineWriter
+
+
+def test_lines_of_an_idle_thread_reach_the_file(tmp_path):
+    path = tmp_path / "trace.json"
+    written = threading.Event()
+    release = threading.Event()
+    with open(path, "a") as handle:
+        writer = BufferedLineWriter(handle, max_bytes=1024 * 1024, max_interval=0.1)
+
+        def worker():
+            for i in range(5):
+                writer.write("line {}\n".format(i))
+            written.set()
+            release.wait()
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        try:
+            written.wait()
+            time.sleep(1.0)
+            assert path.read_text().count("line") == 5
+        finally:
+            release.set()
+            thread.join()
+            writer.close()
+
+
+def test_no_line_is_lost_while_the_flusher_writes_a_buffer_being_filled(tmp_path):
+    path = tmp_path / "trace.json"
+    switch_interval = sys.getswitchinterval()
+    # switch threads as often as possible, so the flusher runs between any two steps of the writing thread
+    sys.setswitchinterval(1e-6)
+    try:
+        with open(path, "a") as handle:
+            writer = BufferedLineWriter(handle, max_bytes=1024 * 1024, max_interval=0.001)
+            for i in range(200000):
+                writer.write("{}\n".format(i))
+            writer.close()
+    finally:
+        sys.setswitchinterval(switch_interval)
+    assert path.read_text().splitlines() == [str(i) for i in range(200000)]